@@ -1,5 +1,8 @@
 """Support to control a Zehnder ComfoAir Q350/450/600 ventilation unit."""
 import logging
+import threading
+import time
+from datetime import timedelta
 
 #from pycomfoconnect import Bridge, ComfoConnect
 import voluptuous as vol
@@ -7,14 +10,27 @@ import voluptuous as vol
 from homeassistant.const import (
     CONF_TYPE,
     CONF_HOST,
+    CONF_ID,
     CONF_NAME,
+    CONF_PATH,
     CONF_PORT,
+    CONF_TIMEOUT,
     EVENT_HOMEASSISTANT_STOP,
+    WEEKDAYS,
 )
-from homeassistant.helpers import discovery
+from homeassistant.config_entries import ConfigEntry, SOURCE_IMPORT
+from homeassistant.core import SupportsResponse, callback
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.event import async_track_state_change_event
+from homeassistant.helpers.reload import async_integration_yaml_config
+from homeassistant.helpers.storage import Store
+from homeassistant.util import slugify
+import homeassistant.util.dt as dt_util
 from homeassistant.helpers.dispatcher import *
-from .izzi.controller import IzziEthBridge, IzziSerialBridge, IzziController
+# Controller modules are imported at first setup, see _load_controller()
+from .izzi.publish import PublishPolicy, PUBLISH_SENSOR_KEYS
+from .izzi.history import DEFAULT_HISTORY_WINDOW
+from .izzi.cf import CfCurve, CF_ENGINES, DEFAULT_CF_ENGINE
 from .izzi.const import IZZY_SENSOR_EXTRACT_CORRECTION_STATE_ID
 
 _LOGGER = logging.getLogger(__name__)
@@ -24,20 +40,40 @@ CONF_CORRECTION = "extract_correction"
 CONF_BYPASS_MODE = "bypass_mode"
 CONF_BYPASS_TEMP = "bypass_temp"
 CONF_CF_PARAMS_MAX = "cf_params_max"
+CONF_CF_ENGINE = "cf_engine"
+CONF_CF_UPDATE_INTERVAL = "cf_update_interval"
+CONF_CF_SUPPLY_SENSOR = "cf_supply_sensor"
+CONF_CF_EXTRACT_SENSOR = "cf_extract_sensor"
+CONF_CF_UDP_PORT = "cf_udp_port"
+CONF_CF_UDP_HOST = "cf_udp_host"
+CONF_SCHEDULE = "schedule"
+CONF_BAUDRATE = "baudrate"
+CONF_LOW_LATENCY = "low_latency"
+CONF_CAPTURE_FILE = "capture_file"
+CONF_METRICS_PORT = "metrics_port"
+CONF_PUBLISH = "publish"
+CONF_HISTORY_WINDOW = "history_window"
+CONF_REPLAY_FILE = "file"
+CONF_REPLAY_SPEED = "speed"
 
 DOMAIN = "izzifast"
 
-SIGNAL_IZZIFAST_UPDATE_RECEIVED = "izzifast_update_received_{}"
-
 DEFAULT_NAME = "iZZi ERV 300"
 DEFAULT_PORT = 8234
+DEFAULT_CF_UDP_HOST = "127.0.0.1"
 DEFAULT_CORRECTION = 0.0
 DEFAULT_BYPASS_TEMP = 23
 DEFAULT_BYPASS_MODE = "auto"
 DEFAULT_CF_PARAMS_MAX = 0.0
+DEFAULT_REPLAY_SPEED = 1.0
+DEFAULT_CONNECT_TIMEOUT = 2.0
+DEFAULT_BAUDRATE = 9600
+DEFAULT_OVERRIDE_NAME = "override"
 
 CONF_TYPE_SERIAL = "serial"
 CONF_TYPE_TCP = "tcp"
+CONF_TYPE_REPLAY = "replay"
+CONF_TYPE_UNIX = "unix"
 
 CONF_MODE_MASTER = "master"
 CONF_MODE_SLAVE = "slave"
@@ -47,34 +83,113 @@ vent_mode_list = ["none", "fireplace", "open windows", "cooker hood"]
 
 DEVICE = None
 
-SERIAL_SCHEMA = {
-    vol.Required(CONF_TYPE): CONF_TYPE_SERIAL,
-    vol.Required(CONF_PORT): cv.string,
+ATTR_SPEED_NAME = "speed"
+ATTR_SUPPLY_NAME = "supply"
+ATTR_EXTRACT_NAME = "extract"
+ATTR_VENT_MODE_NAME = "vent_mode"
+ATTR_BYPASS_MODE_NAME = "bypass_mode"
+ATTR_DAYS_NAME = "days"
+ATTR_AT_NAME = "at"
+
+
+def _time_of_day(value):
+    """Validates a time of day, kept as string so it can be stored in the config entry."""
+    return str(cv.time(value))
+
+
+# Targets of program steps and overrides, see izzi.schedule
+SCHEDULE_TARGETS_SCHEMA = {
+    vol.Optional(ATTR_SPEED_NAME): vol.All(vol.Coerce(int), vol.Range(min=20, max=100)),
+    vol.Optional(ATTR_SUPPLY_NAME): vol.All(vol.Coerce(int), vol.Range(min=0, max=100)),
+    vol.Optional(ATTR_EXTRACT_NAME): vol.All(vol.Coerce(int), vol.Range(min=0, max=100)),
+    vol.Optional(ATTR_VENT_MODE_NAME): vol.In(vent_mode_list),
+    vol.Optional(ATTR_BYPASS_MODE_NAME): vol.In(bypass_mode_list),
+}
+
+SCHEDULE_ENTRY_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_DAYS_NAME, default=list(WEEKDAYS)): vol.All(cv.ensure_list, [vol.In(WEEKDAYS)]),
+    vol.Required(ATTR_AT_NAME): _time_of_day,
+    **SCHEDULE_TARGETS_SCHEMA,
+})
+
+PUBLISH_POLICY_SCHEMA = vol.Schema({
+    vol.Optional("deadband", default=0.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional("relative", default=0.0): vol.All(vol.Coerce(float), vol.Range(min=0, max=1)),
+    vol.Optional("min_interval", default=0.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional("max_interval"): vol.All(vol.Coerce(float), vol.Range(min=1)),
+    vol.Optional("hysteresis", default=0): vol.All(vol.Coerce(int), vol.Range(min=0, max=10)),
+})
+
+# 0 disables the history
+HISTORY_WINDOW_SCHEMA = vol.Any(0, vol.All(vol.Coerce(float), vol.Range(min=120, max=7 * 24 * 3600)))
+
+# Options of every unit whatever the transport
+UNIT_OPTIONS = {
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+    vol.Optional(CONF_ID): cv.slug,
     vol.Optional(CONF_MODE, default=CONF_MODE_MASTER): cv.string,
     vol.Optional(CONF_CORRECTION, default=DEFAULT_CORRECTION): vol.All(vol.Coerce(int), vol.Range(min=-50, max=50)),
     vol.Optional(CONF_BYPASS_MODE, default=DEFAULT_BYPASS_MODE): vol.In(bypass_mode_list),
     vol.Optional(CONF_BYPASS_TEMP, default=DEFAULT_BYPASS_TEMP): vol.All(vol.Coerce(int), vol.Range(min=17, max=24)),
     vol.Optional(CONF_CF_PARAMS_MAX, default=DEFAULT_CF_PARAMS_MAX): vol.All(vol.Coerce(int), vol.Range(min=0, max=500)),
+    vol.Optional(CONF_CF_ENGINE, default=DEFAULT_CF_ENGINE): vol.In(list(CF_ENGINES)),
+    vol.Optional(CONF_CF_UPDATE_INTERVAL): vol.All(vol.Coerce(float), vol.Range(min=0.5, max=60)),
+    vol.Optional(CONF_CF_SUPPLY_SENSOR): cv.entity_id,
+    vol.Optional(CONF_CF_EXTRACT_SENSOR): cv.entity_id,
+    vol.Optional(CONF_CF_UDP_PORT): cv.port,
+    vol.Optional(CONF_CF_UDP_HOST, default=DEFAULT_CF_UDP_HOST): cv.string,
+    vol.Optional(CONF_SCHEDULE, default=[]): [SCHEDULE_ENTRY_SCHEMA],
+    vol.Optional(CONF_METRICS_PORT): cv.port,
+    vol.Optional(CONF_PUBLISH, default={}): {vol.In(list(PUBLISH_SENSOR_KEYS)): PUBLISH_POLICY_SCHEMA},
+    vol.Optional(CONF_HISTORY_WINDOW, default=DEFAULT_HISTORY_WINDOW): HISTORY_WINDOW_SCHEMA,
+}
+
+# Frames of a real bridge can be recorded, a replayed capture not
+BRIDGE_OPTIONS = {
+    **UNIT_OPTIONS,
+    vol.Optional(CONF_CAPTURE_FILE): cv.string,
+}
+
+SERIAL_SCHEMA = {
+    **BRIDGE_OPTIONS,
+    vol.Required(CONF_TYPE): CONF_TYPE_SERIAL,
+    vol.Required(CONF_PORT): cv.string,
+    vol.Optional(CONF_BAUDRATE, default=DEFAULT_BAUDRATE): vol.In([1200, 2400, 4800, 9600, 19200, 38400, 57600, 115200]),
+    vol.Optional(CONF_LOW_LATENCY, default=True): cv.boolean,
 }
 
 ETHERNET_SCHEMA = {
+    **BRIDGE_OPTIONS,
     vol.Required(CONF_TYPE): CONF_TYPE_TCP,
     vol.Required(CONF_HOST): cv.string,
     vol.Required(CONF_PORT, default=DEFAULT_PORT): cv.positive_int,
-    vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
-    vol.Optional(CONF_MODE, default=CONF_MODE_MASTER): cv.string,
-    vol.Optional(CONF_CORRECTION, default=DEFAULT_CORRECTION): vol.All(vol.Coerce(int), vol.Range(min=-50, max=50)),
-    vol.Optional(CONF_BYPASS_MODE, default=DEFAULT_BYPASS_MODE): vol.In(bypass_mode_list),
-    vol.Optional(CONF_BYPASS_TEMP, default=DEFAULT_BYPASS_TEMP): vol.All(vol.Coerce(int), vol.Range(min=17, max=24)),
-    vol.Optional(CONF_CF_PARAMS_MAX, default=DEFAULT_CF_PARAMS_MAX): vol.All(vol.Coerce(int), vol.Range(min=0, max=500)),
+    vol.Optional(CONF_TIMEOUT, default=DEFAULT_CONNECT_TIMEOUT): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=60)),
+}
+
+UNIX_SCHEMA = {
+    **BRIDGE_OPTIONS,
+    vol.Required(CONF_TYPE): CONF_TYPE_UNIX,
+    vol.Required(CONF_PATH): cv.string,
+    vol.Optional(CONF_TIMEOUT, default=DEFAULT_CONNECT_TIMEOUT): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=60)),
+}
+
+REPLAY_SCHEMA = {
+    **UNIT_OPTIONS,
+    vol.Required(CONF_TYPE): CONF_TYPE_REPLAY,
+    vol.Required(CONF_REPLAY_FILE): cv.string,
+    vol.Optional(CONF_REPLAY_SPEED, default=DEFAULT_REPLAY_SPEED): vol.All(vol.Coerce(float), vol.Range(min=0)),
 }
 
 
+UNIT_SCHEMA = vol.Schema(vol.Any(SERIAL_SCHEMA, ETHERNET_SCHEMA, UNIX_SCHEMA, REPLAY_SCHEMA))
+
 CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Any(SERIAL_SCHEMA, ETHERNET_SCHEMA)
+    DOMAIN: vol.All(cv.ensure_list, [UNIT_SCHEMA])
 }, extra=vol.ALLOW_EXTRA)
 
+DATA_METRICS_SERVERS = "izzifast_metrics_servers"
+
+ATTR_UNIT_NAME = "unit"
 ATTR_MODE_NAME = "mode"
 ATTR_TEMP_NAME = "temp"
 ATTR_CORRECTION_NAME = "value"
@@ -83,13 +198,93 @@ TEMP_DEFAULT_VAL = 23
 CORRECTION_DEFAULT_VAL = 0
 VENT_DEFAULT_NAME = "none"
 
-ATTR_SUPPLY_NAME = "supply"
-ATTR_EXTRACT_NAME = "extract"
-
-def setup(hass, config):
-    """Set up the izzi bridge."""
+ATTR_SENSOR_NAME = "sensor"
+ATTR_WINDOW_NAME = "window"
+ATTR_START_NAME = "start"
+ATTR_END_NAME = "end"
+ATTR_PERCENTILES_NAME = "percentiles"
+
+ATTR_SPEEDS_NAME = "speeds"
+ATTR_SETTLE_TIME_NAME = "settle_time"
+ATTR_SAMPLE_TIME_NAME = "sample_time"
+ATTR_CANCEL_NAME = "cancel"
+ATTR_OVERRIDE_NAME = "name"
+ATTR_DURATION_NAME = "duration"
+
+CF_CURVES_STORAGE_VERSION = 1
+OVERRIDES_STORAGE_VERSION = 1
+
+NAN = float("nan")
+
+AGGREGATE_SCHEMA = vol.Schema({
+    vol.Required(ATTR_SENSOR_NAME): vol.In(list(PUBLISH_SENSOR_KEYS)),
+    vol.Exclusive(ATTR_WINDOW_NAME, "range"): cv.positive_time_period,
+    vol.Exclusive(ATTR_START_NAME, "range"): cv.datetime,
+    vol.Optional(ATTR_END_NAME): cv.datetime,
+    vol.Optional(ATTR_PERCENTILES_NAME, default=[]): vol.All(cv.ensure_list, [vol.All(vol.Coerce(float), vol.Range(min=0, max=100))]),
+    vol.Optional(ATTR_UNIT_NAME): cv.string,
+})
+
+CF_CALIBRATE_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_SPEEDS_NAME): vol.All(cv.ensure_list, [vol.All(vol.Coerce(int), vol.Range(min=15, max=100))]),
+    vol.Optional(ATTR_SETTLE_TIME_NAME): vol.All(vol.Coerce(float), vol.Range(min=0, max=600)),
+    vol.Optional(ATTR_SAMPLE_TIME_NAME): vol.All(vol.Coerce(float), vol.Range(min=1, max=600)),
+    vol.Optional(ATTR_CANCEL_NAME, default=False): cv.boolean,
+    vol.Optional(ATTR_UNIT_NAME): cv.string,
+})
+
+OVERRIDE_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_OVERRIDE_NAME): cv.string,
+    vol.Optional(ATTR_DURATION_NAME): cv.positive_time_period,
+    **SCHEDULE_TARGETS_SCHEMA,
+    vol.Optional(ATTR_CANCEL_NAME, default=False): cv.boolean,
+    vol.Optional(ATTR_UNIT_NAME): cv.string,
+})
+
+def _unit_id(conf):
+    """Returns id of a configured unit."""
+    return conf.get(CONF_ID, slugify(conf[CONF_NAME]))
+
+
+def _schedule_values(data):
+    """Returns schedule targets by name given in service or configuration data, modes as numbers."""
+    values = {key: data[key] for key in (ATTR_SPEED_NAME, ATTR_SUPPLY_NAME, ATTR_EXTRACT_NAME) if key in data}
+    if ATTR_VENT_MODE_NAME in data:
+        values[ATTR_VENT_MODE_NAME] = vent_mode_list.index(data[ATTR_VENT_MODE_NAME])
+    if ATTR_BYPASS_MODE_NAME in data:
+        values[ATTR_BYPASS_MODE_NAME] = bypass_mode_list.index(data[ATTR_BYPASS_MODE_NAME])
+    return values
+
+
+def _platforms(izzibridge):
+    if izzibridge.is_master:
+        return ["fan", "sensor", "binary_sensor"]
+    return ["sensor", "binary_sensor"]
+
+
+def _load_controller():
+    """Imports the controller modules, run in the executor at first setup."""
+    from .izzi import capture, controller, metrics
+
+
+def _service_bridges(hass, call):
+    """Returns master bridges addressed by the service call, all of them if no unit given."""
+    bridges = hass.data[DOMAIN]
+    unit = call.data.get(ATTR_UNIT_NAME)
+    if unit is None:
+        return [b for b in bridges.values() if b.is_master]
+    izzibridge = bridges.get(unit)
+    if izzibridge is None or not izzibridge.is_master:
+        _LOGGER.error("Unknown master unit '%s'", unit)
+        return []
+    return [izzibridge]
+
+
+async def _async_setup_unit(hass, conf, unit_id, legacy):
+    """Set up bridge of a single unit."""
+    from .izzi.capture import IzziFrameRecorder, IzziRecordingBridge, IzziReplayBridge
+    from .izzi.controller import IzziEthBridge, IzziSerialBridge, IzziUnixBridge
 
-    conf = config[DOMAIN]
     type = conf[CONF_TYPE]
     name = conf[CONF_NAME]
     mode = conf[CONF_MODE]
@@ -104,14 +299,25 @@ def setup(hass, config):
         _LOGGER.debug("Setting up Ethernet bridge")
         host = conf[CONF_HOST]
         port = conf[CONF_PORT]
-        bridge = IzziEthBridge(host, port)
+        bridge = IzziEthBridge(host, port, conf[CONF_TIMEOUT])
     elif CONF_TYPE_SERIAL == type:
         _LOGGER.debug("Setting up Serial bridge")
         port = conf[CONF_PORT]
-        bridge = IzziSerialBridge(port)
+        bridge = IzziSerialBridge(port, conf[CONF_BAUDRATE], conf[CONF_LOW_LATENCY])
+    elif CONF_TYPE_UNIX == type:
+        _LOGGER.debug("Setting up Unix socket bridge")
+        bridge = IzziUnixBridge(conf[CONF_PATH], conf[CONF_TIMEOUT])
+    elif CONF_TYPE_REPLAY == type:
+        _LOGGER.debug("Setting up Replay bridge")
+        bridge = IzziReplayBridge(conf[CONF_REPLAY_FILE], conf[CONF_REPLAY_SPEED], loop_playback=True)
     else:
         _LOGGER.error("Wrong bridge type '%s'", type)
-        return false
+        return None
+    
+    if conf.get(CONF_CAPTURE_FILE) is not None:
+        _LOGGER.debug("Recording frames to %s", conf[CONF_CAPTURE_FILE])
+        recorder = await hass.async_add_executor_job(IzziFrameRecorder, conf[CONF_CAPTURE_FILE])
+        bridge = IzziRecordingBridge(bridge, recorder)
     
     
     if CONF_MODE_MASTER == mode:
@@ -125,143 +331,379 @@ def setup(hass, config):
         _LOGGER.error("Wrong controller mode, defaulting to master")
     
     # Setup Izzi Bridge
-    izzibridge = IzzifastBridge(hass, bridge, name, correction, is_master)
-    hass.data[DOMAIN] = izzibridge
+    izzibridge = IzzifastBridge(hass, bridge, name, correction, is_master, unit_id, legacy)
+    izzibridge.metrics_port = conf.get(CONF_METRICS_PORT)
 
     izzibridge.set_bypass_temp(bypass_temp);
     izzibridge.set_bypass_mode(bypass_mode_list.index(bypass_mode));
+    izzibridge.set_cf_engine(conf[CONF_CF_ENGINE], conf.get(CONF_CF_UPDATE_INTERVAL))
     izzibridge.set_cf_params_max(cf_max_params);
+    await izzibridge.async_load_cf_curves()
+    if is_master:
+        try:
+            izzibridge.set_program(conf[CONF_SCHEDULE])
+        except ValueError as exc:
+            _LOGGER.error("Schedule invalid: %s", exc)
+        await izzibridge.async_load_overrides()
+    await izzibridge.async_start_cf_ingestion(conf.get(CONF_CF_SUPPLY_SENSOR), conf.get(CONF_CF_EXTRACT_SENSOR),
+                                              conf.get(CONF_CF_UDP_PORT), conf[CONF_CF_UDP_HOST])
+    
+    for key, policy in conf[CONF_PUBLISH].items():
+        izzibridge.controller.set_publish_policy(PUBLISH_SENSOR_KEYS[key], PublishPolicy(**policy))
+    
+    if conf[CONF_HISTORY_WINDOW]:
+        izzibridge.controller.enable_history(conf[CONF_HISTORY_WINDOW])
     
-    # Start connection with bridge
+    # Connection is made by the controller task, setup doesn't wait for it
     izzibridge.connect()
+    return izzibridge
+
+
+async def _async_start_metrics(hass, izzibridge):
+    """Serve metrics of the unit, units configured with the same port share the server."""
+    from .izzi.metrics import IzziMetricsServer
+
+    port = izzibridge.metrics_port
+    servers = hass.data.setdefault(DATA_METRICS_SERVERS, {})
+    if port is None or port in servers:
+        return
+    server = IzziMetricsServer(
+        lambda: [(unit_id, b.controller.collect_metrics()) for unit_id, b in hass.data[DOMAIN].items() if b.metrics_port == port],
+        port=port)
+    try:
+        await server.start()
+        servers[port] = server
+    except OSError as exc:
+        _LOGGER.error("Can't serve metrics on port %d: %s", port, exc)
+
+
+def _release_metrics(hass, izzibridge):
+    """Stop metrics server of the unit when no other unit uses it."""
+    port = izzibridge.metrics_port
+    servers = hass.data.get(DATA_METRICS_SERVERS, {})
+    if port in servers and not any(b.metrics_port == port for b in hass.data[DOMAIN].values()):
+        servers.pop(port).close()
+
+
+async def _async_import_units(hass, units) -> bool:
+    """Create or update a config entry for every unit configured in YAML."""
+    unit_ids = [_unit_id(conf) for conf in units]
+    if len(set(unit_ids)) != len(unit_ids):
+        _LOGGER.error("Units must have unique names or ids: %s", unit_ids)
+        return False
+
+    # Entries of units removed from YAML go away as well
+    for entry in hass.config_entries.async_entries(DOMAIN):
+        if entry.source == SOURCE_IMPORT and entry.unique_id not in unit_ids:
+            await hass.config_entries.async_remove(entry.entry_id)
+
+    for conf, unit_id in zip(units, unit_ids):
+        data = dict(conf)
+        # Single unit configured the old way keeps its entity ids
+        if len(units) > 1:
+            data[CONF_ID] = unit_id
+        hass.async_create_task(hass.config_entries.flow.async_init(
+            DOMAIN, context={"source": SOURCE_IMPORT}, data=data))
+    return True
+
 
-    # Schedule disconnect on shutdown
-    def _shutdown(_event):
-        izzibridge.disconnect()
+async def async_setup(hass, config):
+    """Register the services and import units configured in YAML."""
 
-    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, _shutdown)
+    hass.data.setdefault(DOMAIN, {})
+    _register_services(hass)
+    if DOMAIN in config:
+        return await _async_import_units(hass, config[DOMAIN])
+    return True
+
+
+async def async_setup_entry(hass, entry: ConfigEntry):
+    """Set up one unit, the bridge connects in the background."""
+
+    started = time.perf_counter()
+    # Fills in defaults of options added after the entry was created
+    conf = UNIT_SCHEMA(dict(entry.data))
+    unit_id = entry.unique_id or _unit_id(conf)
+    await hass.async_add_executor_job(_load_controller)
     
+    izzibridge = await _async_setup_unit(hass, conf, unit_id, CONF_ID not in entry.data)
+    if izzibridge is None:
+        return False
+    hass.data.setdefault(DOMAIN, {})[unit_id] = izzibridge
+    await _async_start_metrics(hass, izzibridge)
+
+    async def _shutdown(_event):
+        await izzibridge.disconnect()
+
+    entry.async_on_unload(hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _shutdown))
+    await hass.config_entries.async_forward_entry_setups(entry, _platforms(izzibridge))
+    
+    izzibridge.controller.metrics.setup_seconds = time.perf_counter() - started
+    _LOGGER.debug("Unit %s set up in %.1f ms", unit_id, izzibridge.controller.metrics.setup_seconds * 1000.0)
+    return True
+
+
+async def async_unload_entry(hass, entry: ConfigEntry):
+    """Unload one unit, also used when the entry is reloaded."""
+
+    unit_id = entry.unique_id or _unit_id(entry.data)
+    izzibridge = hass.data[DOMAIN].get(unit_id)
+    if izzibridge is None:
+        return True
+    if not await hass.config_entries.async_unload_platforms(entry, _platforms(izzibridge)):
+        return False
+    del hass.data[DOMAIN][unit_id]
+    _release_metrics(hass, izzibridge)
+    await izzibridge.disconnect()
+    return True
+
+
+def _register_services(hass):
+    """Services address the units set up at call time."""
+    
+
+
+    @callback
     def handle_set_bypass_mode(call):
         """Handle the service call."""
-        try:
-            mode = call.data.get(ATTR_MODE_NAME, BYPASS_DEFAULT_NAME)
-            if izzibridge.set_bypass_mode(bypass_mode_list.index(mode)) != True:
-                _LOGGER.error("Bypass mode invalid %s", mode)
-        except Exception:
-            _LOGGER.error("Bypass mode failed %s", mode)
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                mode = call.data.get(ATTR_MODE_NAME, BYPASS_DEFAULT_NAME)
+                if izzibridge.set_bypass_mode(bypass_mode_list.index(mode)) != True:
+                    _LOGGER.error("Bypass mode invalid %s", mode)
+            except Exception:
+                _LOGGER.error("Bypass mode failed %s", mode)
             
+    @callback
     def handle_set_bypass_temp(call):
         """Handle the service call."""
-        try:
-            temp = call.data.get(ATTR_TEMP_NAME, TEMP_DEFAULT_VAL)
-            if izzibridge.set_bypass_temp(int(temp)) != True:
-                _LOGGER.error("Bypass temp invalid %d", temp)
-        except Exception:
-            _LOGGER.error("Bypass temp failed %d", temp)
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                temp = call.data.get(ATTR_TEMP_NAME, TEMP_DEFAULT_VAL)
+                if izzibridge.set_bypass_temp(int(temp)) != True:
+                    _LOGGER.error("Bypass temp invalid %d", temp)
+            except Exception:
+                _LOGGER.error("Bypass temp failed %d", temp)
                 
+    @callback
     def handle_set_correction(call):
         """Handle the service call."""
-        try:
-            value = call.data.get(ATTR_CORRECTION_NAME, CORRECTION_DEFAULT_VAL)
-            if izzibridge.set_correction(int(value)) != True:
-                _LOGGER.error("Correction invalid %d", value)
-        except Exception:
-            _LOGGER.error("Correction set failed %d", value)
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                value = call.data.get(ATTR_CORRECTION_NAME, CORRECTION_DEFAULT_VAL)
+                if izzibridge.set_correction(int(value)) != True:
+                    _LOGGER.error("Correction invalid %d", value)
+            except Exception:
+                _LOGGER.error("Correction set failed %d", value)
             
+    @callback
     def handle_set_cf_params(call):
         """Handle the service call."""
-        try:
-            supply_pd = call.data.get(ATTR_SUPPLY_NAME, 0)
-            extract_pd = call.data.get(ATTR_EXTRACT_NAME, 0)
-            if izzibridge.set_cf_params(float(supply_pd), float(extract_pd)) != True:
-                _LOGGER.error("CF params invalid %f:%f", supply_pd, extract_pd)
-        except Exception:
-            _LOGGER.error("CF params set failed %s:%s", str(supply_pd), str(extract_pd))
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                supply_pd = call.data.get(ATTR_SUPPLY_NAME, 0)
+                extract_pd = call.data.get(ATTR_EXTRACT_NAME, 0)
+                if izzibridge.set_cf_params(float(supply_pd), float(extract_pd)) != True:
+                    _LOGGER.error("CF params invalid %f:%f", supply_pd, extract_pd)
+            except Exception:
+                _LOGGER.error("CF params set failed %s:%s", str(supply_pd), str(extract_pd))
+    @callback
     def handle_set_cf_supply_param(call):
         """Handle the service call."""
-        try:
-            supply_pd = call.data.get(ATTR_SUPPLY_NAME, 0)
-            if izzibridge.set_cf_supply_param(float(supply_pd)) != True:
-                _LOGGER.error("CF supply param invalid %f", supply_pd)
-        except Exception:
-            _LOGGER.error("CF supply param set failed %s", str(supply_pd)) 
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                supply_pd = call.data.get(ATTR_SUPPLY_NAME, 0)
+                if izzibridge.set_cf_supply_param(float(supply_pd)) != True:
+                    _LOGGER.error("CF supply param invalid %f", supply_pd)
+            except Exception:
+                _LOGGER.error("CF supply param set failed %s", str(supply_pd)) 
             
+    @callback
     def handle_set_cf_extract_param(call):
         """Handle the service call."""
-        try:
-            extract_pd = call.data.get(ATTR_EXTRACT_NAME, 0)
-            if izzibridge.set_cf_extract_param(float(extract_pd)) != True:
-                _LOGGER.error("CF extract param invalid %f", extract_pd)
-        except Exception:
-            _LOGGER.error("CF extract param set failed %s", str(extract_pd))    
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                extract_pd = call.data.get(ATTR_EXTRACT_NAME, 0)
+                if izzibridge.set_cf_extract_param(float(extract_pd)) != True:
+                    _LOGGER.error("CF extract param invalid %f", extract_pd)
+            except Exception:
+                _LOGGER.error("CF extract param set failed %s", str(extract_pd))    
             
+    @callback
     def handle_set_vent_mode(call):
         """Handle the service call."""
-        try:
-            mode = call.data.get(ATTR_MODE_NAME, VENT_DEFAULT_NAME)
-            if izzibridge.set_vent_mode(vent_mode_list.index(mode)) != True:
-                _LOGGER.error("Vent mode invalid to %s", mode)
-        except Exception:
-            _LOGGER.error("Vent mode failed %s", mode)
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                mode = call.data.get(ATTR_MODE_NAME, VENT_DEFAULT_NAME)
+                if izzibridge.set_vent_mode(vent_mode_list.index(mode)) != True:
+                    _LOGGER.error("Vent mode invalid to %s", mode)
+            except Exception:
+                _LOGGER.error("Vent mode failed %s", mode)
     
+    @callback
     def handle_set_speed_raw(call):
         """Handle the service call."""
-        try:
-            supply = value = call.data.get(ATTR_SUPPLY_NAME, -1)
-            extract = call.data.get(ATTR_EXTRACT_NAME, -1)
-            if extract < 0 or supply < 0:
-                _LOGGER.error("Raw speed missing supply or extract attribute")
-                
-            if izzibridge.set_fan_speed_raw(int(supply), int(extract)) != True:
-                _LOGGER.error("Raw speed invalid supply %d, extract %d", supply, extract)
-        except Exception:
-            _LOGGER.error("Raw speed set failed %d", value)
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                supply = value = call.data.get(ATTR_SUPPLY_NAME, -1)
+                extract = call.data.get(ATTR_EXTRACT_NAME, -1)
+                if extract < 0 or supply < 0:
+                    _LOGGER.error("Raw speed missing supply or extract attribute")
+                    
+                if izzibridge.set_fan_speed_raw(int(supply), int(extract)) != True:
+                    _LOGGER.error("Raw speed invalid supply %d, extract %d", supply, extract)
+            except Exception:
+                _LOGGER.error("Raw speed set failed %d", value)
             
-    if is_master :    
-        hass.services.register(DOMAIN, "bypass_mode", handle_set_bypass_mode)
-        hass.services.register(DOMAIN, "bypass_temp", handle_set_bypass_temp)
-        hass.services.register(DOMAIN, "correction", handle_set_correction)
-        hass.services.register(DOMAIN, "vent_mode", handle_set_vent_mode)
-        hass.services.register(DOMAIN, "speed_raw", handle_set_speed_raw)
-        hass.services.register(DOMAIN, "cf_params", handle_set_cf_params)
-        # Load platforms
-        discovery.load_platform(hass, "fan", DOMAIN, {}, config)
-
-    discovery.load_platform(hass, "sensor", DOMAIN, {}, config)
-    discovery.load_platform(hass, "binary_sensor", DOMAIN, {}, config)
-
-    return True
+    @callback
+    def handle_aggregate(call):
+        """Handle the service call, answered from the history kept in memory."""
+        unit = call.data.get(ATTR_UNIT_NAME)
+        if unit is not None and unit not in hass.data[DOMAIN]:
+            _LOGGER.error("Unknown unit '%s'", unit)
+            return {"units": {}}
+        
+        now = time.time()
+        if ATTR_START_NAME in call.data:
+            start = dt_util.as_timestamp(call.data[ATTR_START_NAME])
+        else:
+            start = now - call.data.get(ATTR_WINDOW_NAME, timedelta(hours=1)).total_seconds()
+        end = dt_util.as_timestamp(call.data[ATTR_END_NAME]) if ATTR_END_NAME in call.data else None
+        sensor_id = PUBLISH_SENSOR_KEYS[call.data[ATTR_SENSOR_NAME]]
+        percentiles = call.data[ATTR_PERCENTILES_NAME]
+        
+        units = {}
+        for unit_id, izzibridge in hass.data[DOMAIN].items():
+            if unit is not None and unit_id != unit:
+                continue
+            result = izzibridge.controller.aggregate(sensor_id, start, end, percentiles)
+            if result is not None:
+                result["start"] = dt_util.utc_from_timestamp(result["start"]).isoformat()
+                if "percentiles" in result:
+                    result["percentiles"] = {"p%g" % p: value for p, value in result["percentiles"].items()}
+            units[unit_id] = result
+        return {"units": units}
+    
+    @callback
+    def handle_cf_calibrate(call):
+        """Handle the service call, the fitted curves are stored when the sweep ends."""
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                if call.data[ATTR_CANCEL_NAME]:
+                    izzibridge.cancel_cf_calibration()
+                elif not izzibridge.start_cf_calibration(call.data.get(ATTR_SPEEDS_NAME),
+                                                         call.data.get(ATTR_SETTLE_TIME_NAME),
+                                                         call.data.get(ATTR_SAMPLE_TIME_NAME)):
+                    _LOGGER.error("CF calibration needs the unit on and no calibration running")
+            except ValueError as exc:
+                _LOGGER.error("CF calibration invalid: %s", exc)
+
+    hass.services.async_register(DOMAIN, "cf_calibrate", handle_cf_calibrate, schema=CF_CALIBRATE_SCHEMA)
+
+    @callback
+    def handle_override(call):
+        """Handle the service call, the targets revert when the duration is over."""
+        for izzibridge in _service_bridges(hass, call):
+            try:
+                if call.data[ATTR_CANCEL_NAME]:
+                    izzibridge.cancel_override(call.data.get(ATTR_OVERRIDE_NAME))
+                elif ATTR_DURATION_NAME not in call.data:
+                    _LOGGER.error("Override needs a duration")
+                else:
+                    izzibridge.start_override(call.data.get(ATTR_OVERRIDE_NAME, DEFAULT_OVERRIDE_NAME),
+                                              _schedule_values(call.data),
+                                              call.data[ATTR_DURATION_NAME].total_seconds())
+            except ValueError as exc:
+                _LOGGER.error("Override invalid: %s", exc)
+
+    hass.services.async_register(DOMAIN, "override", handle_override, schema=OVERRIDE_SCHEMA)
+
+    hass.services.async_register(DOMAIN, "aggregate", handle_aggregate, schema=AGGREGATE_SCHEMA,
+                                 supports_response=SupportsResponse.ONLY)
+
+    async def handle_reload(call):
+        """Re-read YAML configuration, changed units are reloaded in place."""
+        config = await async_integration_yaml_config(hass, DOMAIN)
+        if config is None:
+            return
+        await _async_import_units(hass, config.get(DOMAIN, []))
+
+    hass.services.async_register(DOMAIN, "bypass_mode", handle_set_bypass_mode)
+    hass.services.async_register(DOMAIN, "bypass_temp", handle_set_bypass_temp)
+    hass.services.async_register(DOMAIN, "correction", handle_set_correction)
+    hass.services.async_register(DOMAIN, "vent_mode", handle_set_vent_mode)
+    hass.services.async_register(DOMAIN, "speed_raw", handle_set_speed_raw)
+    hass.services.async_register(DOMAIN, "cf_params", handle_set_cf_params)
+    hass.services.async_register(DOMAIN, "cf_supply_param", handle_set_cf_supply_param)
+    hass.services.async_register(DOMAIN, "cf_extract_param", handle_set_cf_extract_param)
+    hass.services.async_register(DOMAIN, "reload", handle_reload)
 
 
 class IzzifastBridge:
     """Representation of a IZZI bridge."""
 
-    def __init__(self, hass, bridge, name, correction, is_master):
+    def __init__(self, hass, bridge, name, correction, is_master, unit_id=None, legacy=True):
         """Initialize the IZZI bridge."""
         self.data = {}
         self.name = name
         self.hass = hass
-        self.unique_id = "_iZZi_300_ERV_FE"
+        self.unit_id = unit_id
+        self.is_master = is_master
+        self.legacy = legacy
+        self.metrics_port = None
+        if legacy:
+            self.unique_id = "_iZZi_300_ERV_FE"
+        else:
+            self.unique_id = "_iZZi_300_ERV_" + unit_id
         self.correction = correction
         self.speed = 0
+        self._bridge = bridge
+        
+        # Sensor id -> tuple of entity update handlers
+        self._subscribers = {}
+        # Latest values not yet delivered to the event loop
+        self._pending_updates = {}
+        self._pending_lock = threading.Lock()
+        self._flush_scheduled = False
+
+        from .izzi.controller import IzziController
 
         self.controller = IzziController(
             bridge=bridge,
             is_master=is_master
         )
-        self.controller.callback_sensor = self.sensor_callback
+        self.controller.callback_update = self.publish_updates
+        self.controller.callback_cf_calibrated = self._cf_calibrated
+        self.controller.callback_schedule_changed = self._schedule_changed
+        # Stops pressure sensor subscriptions and the UDP endpoint
+        self._cf_ingestion = []
+        self._cf_sensors = {}
+        self._cf_curves_store = Store(hass, CF_CURVES_STORAGE_VERSION, "%s.%s.cf_curves" % (DOMAIN, unit_id or "default"))
+        self._overrides_store = Store(hass, OVERRIDES_STORAGE_VERSION, "%s.%s.overrides" % (DOMAIN, unit_id or "default"))
         
         self.sensor_callback(IZZY_SENSOR_EXTRACT_CORRECTION_STATE_ID, self.correction)
 
+    def entity_name(self, name):
+        """Returns entity name, prefixed with unit name when several units are set up."""
+        if self.legacy:
+            return name
+        return name.replace("iZZi", self.name, 1)
+
     def connect(self):
         """Connect with the bridge."""
         _LOGGER.debug("Connecting with bridge")
         self.controller.connect()
 
-    def disconnect(self):
+    async def disconnect(self):
         """Disconnect from the bridge."""
         _LOGGER.debug("Disconnecting from bridge")
-        self.controller.disconnect()
+        while self._cf_ingestion:
+            self._cf_ingestion.pop()()
+        await self.controller.disconnect()
+        # Capture file of a recording bridge, the unit may be set up again on the same file
+        close = getattr(self._bridge, 'close', None)
+        if close is not None:
+            await self.hass.async_add_executor_job(close)
  
     def force_update(self, sensor):
         if sensor == IZZY_SENSOR_EXTRACT_CORRECTION_STATE_ID :
@@ -269,11 +711,15 @@ class IzzifastBridge:
         else:
             self.controller.force_update(sensor)
 
+    def snapshot(self):
+        """Returns consistent copy of current sensor values."""
+        return self.controller.snapshot()
+
     def set_bypass_mode(self, mode) -> bool:
         return self.controller.set_bypass_mode(mode)
         
     def set_cf_max_param(self, param_max : float) -> bool:
-        return self.controller.set_cf_max_param(param_max)
+        return self.controller.set_cf_params_max(param_max)
             
     def set_vent_mode(self, mode) -> bool:
         return self.controller.set_vent_mode(mode)
@@ -312,12 +758,164 @@ class IzzifastBridge:
     def set_cf_params(self, supply : float, extract : float) -> bool:
         return self.controller.set_cf_params(supply, extract)
 
+    def set_cf_supply_param(self, supply : float) -> bool:
+        self.controller.add_cf_samples((0.0,), (supply,), (NAN,))
+        return True
+
+    def set_cf_extract_param(self, extract : float) -> bool:
+        self.controller.add_cf_samples((0.0,), (NAN,), (extract,))
+        return True
+
+    async def async_start_cf_ingestion(self, supply_sensor=None, extract_sensor=None, udp_port=None,
+                                       udp_host=DEFAULT_CF_UDP_HOST):
+        """Take pressures from sensor entities and UDP sample batches, bypassing the services."""
+        if supply_sensor:
+            self._cf_sensors[supply_sensor] = ATTR_SUPPLY_NAME
+        if extract_sensor:
+            self._cf_sensors[extract_sensor] = ATTR_EXTRACT_NAME
+        if self._cf_sensors:
+            self._cf_ingestion.append(async_track_state_change_event(
+                self.hass, list(self._cf_sensors), self._cf_sensor_changed))
+        if udp_port is not None:
+            from .izzi.ingest import start_pressure_endpoint
+
+            try:
+                transport = await start_pressure_endpoint(self.controller, udp_host, udp_port)
+                self._cf_ingestion.append(transport.close)
+            except OSError as exc:
+                _LOGGER.error("Can't receive CF samples on %s port %d: %s", udp_host, udp_port, exc)
+
+    @callback
+    def _cf_sensor_changed(self, event):
+        state = event.data.get("new_state")
+        if state is None:
+            return
+        try:
+            value = float(state.state)
+        except ValueError:
+            # unknown or unavailable
+            return
+        timestamp = state.last_updated.timestamp()
+        if self._cf_sensors[state.entity_id] == ATTR_SUPPLY_NAME:
+            self.controller.add_cf_samples((timestamp,), (value,), (NAN,))
+        else:
+            self.controller.add_cf_samples((timestamp,), (NAN,), (value,))
+
     def set_cf_params_max(self, max_param : float) -> bool:
         return self.controller.set_cf_params_max(max_param)
+
+    async def async_load_cf_curves(self):
+        """Restore the CF curves of the last calibration."""
+        data = await self._cf_curves_store.async_load()
+        if data:
+            self.controller.set_cf_curves(CfCurve.from_dict(data[ATTR_SUPPLY_NAME]), CfCurve.from_dict(data[ATTR_EXTRACT_NAME]))
+
+    def start_cf_calibration(self, speeds=None, settle_time=None, sample_time=None) -> bool:
+        from .izzi.calibration import CfCalibration, CALIBRATION_SPEEDS
+
+        calibration = CfCalibration(speeds or CALIBRATION_SPEEDS,
+                                    CfCalibration.SETTLE_TIME if settle_time is None else settle_time,
+                                    CfCalibration.SAMPLE_TIME if sample_time is None else sample_time)
+        return self.controller.start_cf_calibration(calibration)
+
+    def cancel_cf_calibration(self) -> bool:
+        return self.controller.cancel_cf_calibration()
+
+    def _cf_calibrated(self, supply, extract):
+        if supply is None:
+            return
+        self.hass.async_create_task(self._cf_curves_store.async_save(
+            {ATTR_SUPPLY_NAME: supply.as_dict(), ATTR_EXTRACT_NAME: extract.as_dict()}))
+
+    def set_cf_engine(self, name : str, update_interval : float = None) -> bool:
+        return self.controller.set_cf_engine(name, update_interval)
+
+    def set_program(self, entries) -> bool:
+        """Weekly program from the schedule configuration."""
+        from .izzi.schedule import ScheduleEntry, schedule_targets
+
+        program = []
+        for entry in entries:
+            at = cv.time(entry[ATTR_AT_NAME])
+            program.append(ScheduleEntry([WEEKDAYS.index(day) for day in entry[ATTR_DAYS_NAME]],
+                                         at.hour * 3600 + at.minute * 60 + at.second,
+                                         schedule_targets(_schedule_values(entry))))
+        return self.controller.set_program(program)
+
+    def start_override(self, name : str, values, duration : float) -> bool:
+        """Hold targets given by name for duration seconds, see izzi.schedule."""
+        from .izzi.schedule import schedule_targets
+
+        return self.controller.start_override(name, schedule_targets(values), duration)
+
+    def cancel_override(self, name : str = None) -> bool:
+        return self.controller.cancel_override(name)
+
+    async def async_load_overrides(self):
+        """Restart overrides which were active before a restart for the time they have left."""
+        data = await self._overrides_store.async_load()
+        now = time.time()
+        for override in data or ():
+            left = override["until"] - now
+            if left > 0:
+                targets = {int(sensor_id): value for sensor_id, value in override["targets"]}
+                self.controller.start_override(override[ATTR_OVERRIDE_NAME], targets, left)
+
+    def _schedule_changed(self):
+        self._overrides_store.async_delay_save(self._overrides_data, 1.0)
+
+    def _overrides_data(self):
+        now = time.time()
+        return [{ATTR_OVERRIDE_NAME: name, "targets": list(targets.items()), "until": now + left}
+                for name, targets, left in self.controller.get_overrides()]
         
     def sensor_callback(self, var, value):
         """Notify listeners that we have received an update."""
-        _LOGGER.debug("Received update for %s: %s", var, value)
-        dispatcher_send(
-            self.hass, SIGNAL_IZZIFAST_UPDATE_RECEIVED.format(var), value
-        )
+        self.publish_updates({var: value})
+
+    def subscribe(self, sensor_id, handler):
+        """Register entity handler for sensor updates, returns unsubscribe function."""
+        self._subscribers[sensor_id] = self._subscribers.get(sensor_id, ()) + (handler,)
+
+        def _unsubscribe():
+            handlers = tuple(h for h in self._subscribers.get(sensor_id, ()) if h is not handler)
+            if handlers:
+                self._subscribers[sensor_id] = handlers
+            else:
+                self._subscribers.pop(sensor_id, None)
+
+        return _unsubscribe
+
+    def publish_updates(self, updates):
+        """Queue a batch of sensor updates for delivery on the event loop.
+
+        Safe to call from any thread. Batches arriving before the loop got to
+        the previous one are merged, only the latest value of a sensor is kept.
+        """
+        with self._pending_lock:
+            self._pending_updates.update(updates)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.hass.loop.call_soon_threadsafe(self._flush_updates)
+
+    @callback
+    def _flush_updates(self):
+        """Deliver pending updates to subscribed entities."""
+        with self._pending_lock:
+            updates = self._pending_updates
+            self._pending_updates = {}
+            self._flush_scheduled = False
+
+        _LOGGER.debug("Received updates %s", updates)
+        started = time.perf_counter()
+        try:
+            for sensor_id, value in updates.items():
+                for handler in self._subscribers.get(sensor_id, ()):
+                    # One failing entity mustn't keep the rest of the batch from the others
+                    try:
+                        handler(value)
+                    except Exception:
+                        _LOGGER.exception("Update of sensor %s to %s failed", sensor_id, value)
+        finally:
+            self.controller.metrics.fanout_seconds.observe(time.perf_counter() - started)
@@ -1,13 +1,14 @@
 """Support for the for Danfoss Air HRV binary sensors."""
 import logging
 from homeassistant.helpers.dispatcher import *
+from homeassistant.core import callback
 from homeassistant.components.binary_sensor import BinarySensorEntity 
 from homeassistant.const import (
     STATE_ON,
     STATE_OFF,
 )
 
-from . import DOMAIN, SIGNAL_IZZIFAST_UPDATE_RECEIVED, IzzifastBridge
+from . import DOMAIN, IzzifastBridge
 from .izzi.const import *
 
 from . import *
@@ -15,9 +16,9 @@ from .izzi import *
 
 _LOGGER = logging.getLogger(__name__)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     """Set up the available Danfoss Air sensors etc."""
-    izzibridge = hass.data[DOMAIN]
+    izzibridge = hass.data[DOMAIN][entry.unique_id]
 
     sensors = [
         ["iZZi Bypass", IZZY_SENSOR_BYPASS_STATE_ID, "opening", IZZI_STATUS_MSG_BYPASS_STATE_OPEN],
@@ -28,9 +29,9 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     dev = []
 
     for sensor in sensors:
-        dev.append(IzzifastBinarySensor(izzibridge, sensor[0], sensor[1], sensor[2], sensor[3]))
+        dev.append(IzzifastBinarySensor(izzibridge, izzibridge.entity_name(sensor[0]), sensor[1], sensor[2], sensor[3]))
 
-    add_entities(dev, True)
+    async_add_entities(dev, True)
 
 
 class IzzifastBinarySensor(BinarySensorEntity):
@@ -50,17 +51,14 @@ class IzzifastBinarySensor(BinarySensorEntity):
         _LOGGER.debug(
             "Registering for binary sensor %s", self._sensor_type
         )
-        self._remove_signal_update = async_dispatcher_connect(
-            self.hass,
-            SIGNAL_IZZIFAST_UPDATE_RECEIVED.format(self._sensor_type),
-            self._handle_update,
-        )
+        self._remove_signal_update = self._izzibridge.subscribe(self._sensor_type, self._handle_update)
         self._izzibridge.force_update(self._sensor_type)
         
     async def async_will_remove_from_hass(self) -> None:
         """Call when entity will be removed from hass."""
         self._remove_signal_update()
     
+    @callback
     def _handle_update(self, value):
         """Handle update callbacks."""
         _LOGGER.debug(
@@ -69,7 +67,7 @@ class IzzifastBinarySensor(BinarySensorEntity):
             value,
         )
         self._izzibridge.data[self._sensor_type] = value
-        self.schedule_update_ha_state()
+        self.async_write_ha_state()
 
     @property
     def name(self):
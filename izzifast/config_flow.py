@@ -0,0 +1,86 @@
+"""Config flow of the iZZi ERV 300 integration."""
+import logging
+
+import voluptuous as vol
+
+from homeassistant import config_entries
+from homeassistant.const import (
+    CONF_TYPE,
+    CONF_HOST,
+    CONF_ID,
+    CONF_NAME,
+    CONF_PATH,
+    CONF_PORT,
+)
+from homeassistant.util import slugify
+
+from . import (
+    DOMAIN,
+    DEFAULT_NAME,
+    DEFAULT_PORT,
+    CONF_MODE,
+    CONF_MODE_MASTER,
+    CONF_MODE_SLAVE,
+    CONF_TYPE_SERIAL,
+    CONF_TYPE_TCP,
+    CONF_TYPE_UNIX,
+    UNIT_SCHEMA,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class IzzifastConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
+    """Adds a unit from the UI or from YAML configuration."""
+
+    VERSION = 1
+
+    def __init__(self):
+        self._data = {}
+
+    async def async_step_user(self, user_input=None):
+        """Name, bridge type and mode of the unit."""
+        if user_input is not None:
+            self._data = dict(user_input)
+            self._data[CONF_ID] = slugify(user_input[CONF_NAME])
+            await self.async_set_unique_id(self._data[CONF_ID])
+            self._abort_if_unique_id_configured()
+            return await self.async_step_connection()
+
+        schema = vol.Schema({
+            vol.Required(CONF_NAME, default=DEFAULT_NAME): str,
+            vol.Required(CONF_TYPE, default=CONF_TYPE_TCP): vol.In([CONF_TYPE_TCP, CONF_TYPE_SERIAL, CONF_TYPE_UNIX]),
+            vol.Required(CONF_MODE, default=CONF_MODE_MASTER): vol.In([CONF_MODE_MASTER, CONF_MODE_SLAVE]),
+        })
+        return self.async_show_form(step_id="user", data_schema=schema)
+
+    async def async_step_connection(self, user_input=None):
+        """Address of the bridge, the connection itself is made after setup."""
+        type = self._data[CONF_TYPE]
+        errors = {}
+        if user_input is not None:
+            try:
+                data = UNIT_SCHEMA({**self._data, **user_input})
+            except vol.Invalid as exc:
+                _LOGGER.debug("Invalid unit configuration: %s", exc)
+                errors["base"] = "invalid_config"
+            else:
+                return self.async_create_entry(title=data[CONF_NAME], data=data)
+
+        if type == CONF_TYPE_TCP:
+            schema = vol.Schema({
+                vol.Required(CONF_HOST): str,
+                vol.Required(CONF_PORT, default=DEFAULT_PORT): int,
+            })
+        elif type == CONF_TYPE_SERIAL:
+            schema = vol.Schema({vol.Required(CONF_PORT, default="/dev/ttyUSB0"): str})
+        else:
+            schema = vol.Schema({vol.Required(CONF_PATH): str})
+        return self.async_show_form(step_id="connection", data_schema=schema, errors=errors)
+
+    async def async_step_import(self, import_config):
+        """Unit configured in YAML, changes update and reload the existing entry."""
+        unit_id = import_config.get(CONF_ID, slugify(import_config[CONF_NAME]))
+        await self.async_set_unique_id(unit_id)
+        self._abort_if_unique_id_configured(updates=import_config)
+        return self.async_create_entry(title=import_config[CONF_NAME], data=import_config)
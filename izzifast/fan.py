@@ -8,19 +8,20 @@ from homeassistant.components.fan import (
 )
 
 from homeassistant.helpers.dispatcher import *
+from homeassistant.core import callback
 
-from . import DOMAIN, SIGNAL_IZZIFAST_UPDATE_RECEIVED, IzzifastBridge
+from . import DOMAIN, IzzifastBridge
 from .izzi.const import *
 from . import *
 from .izzi import *
 
 _LOGGER = logging.getLogger(__name__)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     """Set up the Izzi fan platform."""
-    izzibridge = hass.data[DOMAIN]
+    izzibridge = hass.data[DOMAIN][entry.unique_id]
 
-    add_entities([IzzifastFan("iZZi Fan", izzibridge)], True)
+    async_add_entities([IzzifastFan(izzibridge.entity_name("iZZi Fan"), izzibridge)], True)
 
 
 class IzzifastFan(FanEntity):
@@ -34,24 +35,21 @@ class IzzifastFan(FanEntity):
     async def async_added_to_hass(self):
         """Register for sensor updates."""
         _LOGGER.debug("Registering for fan speed")
-        self._remove_signal_update = async_dispatcher_connect(
-            self.hass,
-            SIGNAL_IZZIFAST_UPDATE_RECEIVED.format(IZZY_SENSOR_FAN_MODE_ID),
-            self._handle_update,
-        )
+        self._remove_signal_update = self._izzibridge.subscribe(IZZY_SENSOR_FAN_MODE_ID, self._handle_update)
         self._izzibridge.force_update(IZZY_SENSOR_FAN_MODE_ID)
         
     async def async_will_remove_from_hass(self) -> None:
         """Call when entity will be removed from hass."""
         self._remove_signal_update()
 
+    @callback
     def _handle_update(self, value):
         """Handle update callbacks."""
         _LOGGER.debug(
             "Handle update for fan speed (%d): %s", IZZY_SENSOR_FAN_MODE_ID, value
         )
         self._izzibridge.data[IZZY_SENSOR_FAN_MODE_ID] = value
-        self.schedule_update_ha_state()
+        self.async_write_ha_state()
 
     @property
     def should_poll(self) -> bool:
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+"""Performance benchmarks of the frame pipeline.
+
+Uses stand-in bridges instead of hardware and writes machine readable
+results, so runs of different versions can be compared. Run from the
+izzifast directory:
+
+    python -m izzi.benchmark --output results.json
+    python -m izzi.benchmark --compare results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tty
+
+from .const import *
+from .controller import IzziBridge, IzziStreamBridge, IzziSerialBridge, IzziController
+from .history import IzziHistory
+from .ingest import IzziPressureProtocol, encode_cf_samples
+from .protocol import IzziFrameDecoder, IZZI_MESSAGE_LENGTH
+from .registers import IzziRegisterStore
+from .publish import PUBLISH_SENSOR_KEYS
+
+_LOGGER = logging.getLogger('izzibenchmark')
+
+BENCHMARK_VERSION = 1
+
+
+def status_message(counter: int) -> bytes:
+    """Status frame with temperatures changing with counter."""
+    message = bytearray(IZZI_MESSAGE_LENGTH)
+    message[IZZI_STATUS_MSG_ID_INDEX] = IZZI_STATUS_MESSAGE_ID
+    message[IZZI_STATUS_MSG_OUTDOR_AIR_TEMP_INDEX] = counter % 10
+    message[IZZI_STATUS_MSG_EXHAUST_AIR_TEMP_INDEX] = 5 + counter % 3
+    message[IZZI_STATUS_MSG_SUPPLY_AIR_TEMP_INDEX] = 18 + counter % 4
+    message[IZZI_STATUS_MSG_EXTRACT_AIR_TEMP_INDEX] = 22
+    message[IZZI_STATUS_MSG_BYPASS_STATE_INDEX] = IZZI_STATUS_MSG_BYPASS_STATE_CLOSED
+    return bytes(message)
+
+
+def _publish_all(controller):
+    """Measure the whole pipeline, not the rate limiting of publish policies."""
+    for sensor_id in PUBLISH_SENSOR_KEYS.values():
+        controller.set_publish_policy(sensor_id, None)
+
+
+def _summary(samples, unit: str, scale: float = 1.0):
+    samples = sorted(s * scale for s in samples)
+    return {
+        'unit': unit,
+        'count': len(samples),
+        'mean': statistics.fmean(samples),
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+class BenchStreamBridge(IzziStreamBridge):
+    """Stream bridge fed by the benchmark instead of a transport."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._connected = False
+        self.on_write = None
+
+    async def connect(self) -> bool:
+        self._loop = asyncio.get_running_loop()
+        self._connected = True
+        return True
+
+    def disconnect(self) -> bool:
+        self._connected = False
+        self._wakeup()
+        return True
+
+    def is_connected(self):
+        return self._connected
+
+    def inject(self, data: bytes):
+        """Deliver data the way a transport does."""
+        data = memoryview(data)
+        while len(data) > 0:
+            buffer = self._get_buffer()
+            count = min(len(buffer), len(data))
+            buffer[:count] = data[:count]
+            self._buffer_updated(count)
+            data = data[count:]
+
+    def write_message(self, message: b'') -> bool:
+        if self.on_write is not None:
+            self.on_write(bytes(message))
+        return True
+
+
+class BenchQueueBridge(IzziBridge):
+    """Returns prepared frames as fast as the controller asks for them."""
+
+    def __init__(self, messages, controller_ref) -> None:
+        self._messages = messages
+        self._index = 0
+        self._controller_ref = controller_ref
+        self.written = 0
+
+    async def connect(self) -> bool:
+        return True
+
+    def disconnect(self) -> bool:
+        return True
+
+    def is_connected(self):
+        return True
+
+    async def read_message(self, timeout=3.0) -> b'':
+        if self._index >= len(self._messages):
+            self._controller_ref()._stopping = True
+            await asyncio.sleep(0)
+            return self._messages[-1]
+        message = self._messages[self._index]
+        self._index += 1
+        return message
+
+    def write_message(self, message: b'') -> bool:
+        self.written += 1
+        return True
+
+
+def bench_decode(frames: int = 200000, chunk: int = 64):
+    """Decoder throughput on a stream with some garbage between frames."""
+    stream = bytearray()
+    for counter in range(frames):
+        if counter % 50 == 0:
+            stream += b'\x00\xff\x13'
+        stream += status_message(counter)
+    stream = bytes(stream)
+
+    decoder = IzziFrameDecoder()
+    decoded = 0
+    started = time.perf_counter()
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(stream):
+        # Same contract as recv_into(), at most the free space is filled
+        buffer = decoder.get_buffer()
+        count = min(chunk, len(buffer), len(stream) - offset)
+        buffer[:count] = view[offset:offset + count]
+        offset += count
+        decoder.buffer_updated(count)
+        for frame in decoder.frames():
+            decoded += 1
+    elapsed = time.perf_counter() - started
+    return {'unit': 'frames/s', 'value': decoded / elapsed, 'frames': decoded, 'skipped_bytes': decoder.skipped}
+
+
+async def bench_processing(frames: int = 20000, distinct: int = 16):
+    """Controller processing cost per status frame."""
+    messages = [status_message(counter % distinct) for counter in range(frames)]
+    controller = None
+    bridge = BenchQueueBridge(messages, lambda: controller)
+    controller = IzziController(bridge, False)
+    _publish_all(controller)
+    # History is on by default, measure it as part of the pipeline
+    controller.enable_history()
+    updates = []
+    controller.callback_update = updates.append
+
+    started = time.perf_counter()
+    await controller._connection_loop()
+    elapsed = time.perf_counter() - started
+    return {'unit': 'us/frame', 'value': elapsed / frames * 1e6, 'frames': frames, 'update_batches': len(updates)}
+
+
+def bench_import(runs: int = 5):
+    """Time to import the controller in a fresh interpreter, part of integration setup."""
+    # Home Assistant has the standard library modules loaded already
+    code = ('import asyncio, logging, socket, time; t = time.perf_counter(); '
+            'import izzi.controller; print(time.perf_counter() - t)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    samples = []
+    # First run compiles the modules
+    for _ in range(runs + 1):
+        output = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                                capture_output=True, text=True).stdout
+        samples.append(float(output))
+    return _summary(samples[1:], 'ms', 1e3)
+
+
+def bench_history(queries: int = 2000):
+    """Aggregate query latency over a day of 1 s frames."""
+    registers = IzziRegisterStore()
+    history = IzziHistory()
+    now = 1.7e9
+    start = now - 24 * 3600
+    for counter in range(24 * 3600):
+        registers.set(IZZY_SENSOR_TEMPERATURE_EXHAUST_ID, 5 + counter % 7)
+        history.record(start + counter, registers)
+
+    results = {}
+    for name, window, percentiles in (('history_aggregate_hour', 3600, ()),
+                                      ('history_aggregate_day', 24 * 3600, ()),
+                                      ('history_percentiles_hour', 3600, (50, 95))):
+        samples = []
+        for _ in range(queries):
+            started = time.perf_counter()
+            history.aggregate(IZZY_SENSOR_TEMPERATURE_EXHAUST_ID, now - window, None, percentiles)
+            samples.append(time.perf_counter() - started)
+        results[name] = _summary(samples, 'us', 1e6)
+    return results
+
+
+async def bench_serial_wakeups(frames: int = 50, chunks: int = 5, gap: float = 0.002):
+    """Serial bridge wakeups per frame over a pty, frames arriving in chunks like from an adapter.
+
+    Compared with a port woken up by every byte (min_read 1).
+    """
+    results = {}
+    for name, min_read in (('value', IZZI_MESSAGE_LENGTH), ('per_byte', 1)):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        bridge = IzziSerialBridge(os.ttyname(slave), low_latency=False, min_read=min_read)
+        await bridge.connect()
+        size = -(-IZZI_MESSAGE_LENGTH // chunks)
+        try:
+            for counter in range(frames):
+                message = status_message(counter)
+                for offset in range(0, len(message), size):
+                    os.write(master, message[offset:offset + size])
+                    await asyncio.sleep(gap)
+                if await bridge.read_message(1.0) is None:
+                    raise RuntimeError("Frame lost on pty")
+        finally:
+            bridge.disconnect()
+            os.close(master)
+            os.close(slave)
+        results[name] = bridge.rx_wakeups / frames
+    results['unit'] = 'wakeups/frame'
+    results['chunks'] = chunks
+    return results
+
+
+def bench_cf_ingest(samples: int = 100000, batch: int = 10):
+    """CF pressure ingestion cost per sample, one call each and UDP batches."""
+    controller = IzziController(IzziBridge(), True)
+    controller.set_cf_params_max(150)
+    now = time.time()
+
+    started = time.perf_counter()
+    for counter in range(samples):
+        controller.set_cf_params(40.0, 38.0)
+    single = time.perf_counter() - started
+
+    protocol = IzziPressureProtocol(controller)
+    datagrams = [encode_cf_samples([now + i * 0.1 for i in range(batch)], [40.0] * batch, [38.0] * batch)
+                 for _ in range(samples // batch)]
+    started = time.perf_counter()
+    for datagram in datagrams:
+        protocol.datagram_received(datagram, None)
+    batched = time.perf_counter() - started
+    return {'unit': 'us/sample', 'value': batched / samples * 1e6, 'single': single / samples * 1e6,
+            'batch': batch, 'samples': samples}
+
+
+async def bench_rx_latency(samples: int = 200):
+    """Latency from bytes arriving on the bridge to the state update callback."""
+    bridge = BenchStreamBridge()
+    controller = IzziController(bridge, False)
+    _publish_all(controller)
+    received = []
+    controller.callback_update = lambda updates: received.append(time.perf_counter())
+    controller.connect()
+    await asyncio.sleep(0)
+
+    latencies = []
+    for counter in range(samples):
+        count = len(received)
+        started = time.perf_counter()
+        bridge.inject(status_message(counter))
+        while len(received) == count:
+            await asyncio.sleep(0)
+        latencies.append(received[-1] - started)
+        await asyncio.sleep(0.001)
+
+    await controller.disconnect()
+    return _summary(latencies, 'us', 1e6)
+
+
+async def bench_command_latency(samples: int = 20, period: float = 0.25):
+    """Latency from a service call to the command frame written on the bus."""
+    bridge = BenchStreamBridge()
+    controller = IzziController(bridge, True)
+    controller.set_unit_on(True)
+    controller.set_fan_speed(30, 30)
+
+    written = []
+    bridge.on_write = lambda message: written.append((time.perf_counter(), message))
+
+    async def unit():
+        counter = 0
+        while True:
+            bridge.inject(status_message(counter))
+            counter += 1
+            await asyncio.sleep(period)
+
+    controller.connect()
+    unit_task = asyncio.get_running_loop().create_task(unit())
+    await asyncio.sleep(3 * period)
+
+    fan_latencies = []
+    bypass_latencies = []
+    for counter in range(samples):
+        # Service call speed_raw
+        speed = 40 + counter % 20
+        started = time.perf_counter()
+        controller.set_fan_speed(speed, speed)
+        fan_latencies.append(await _wait_written(written, started, IZZI_CMD_MSG_SUPPLY_FAN_SPEED_INDEX, speed) - started)
+
+        # Service call bypass_mode
+        mode = IZZY_CMD_BYPASS_MODE_OPEN if counter % 2 == 0 else IZZY_CMD_BYPASS_MODE_CLOSED
+        started = time.perf_counter()
+        controller.set_bypass_mode(mode)
+        bypass_latencies.append(await _wait_written(written, started, IZZI_CMD_MSG_BYPASS_MODE_INDEX, mode) - started)
+
+    unit_task.cancel()
+    await controller.disconnect()
+    result = {
+        'speed_raw': _summary(fan_latencies, 'ms', 1e3),
+        'bypass_mode': _summary(bypass_latencies, 'ms', 1e3),
+    }
+    for value in result.values():
+        value['frame_period_ms'] = period * 1e3
+    return result
+
+
+async def bench_command_coalescing(threads: int = 4, commands: int = 500, period: float = 0.02):
+    """Fan speeds set from executor threads while frames come in.
+
+    Reports written frames per published command, commands superseded
+    before they were written and frames with supply and extract of
+    different calls, which must be none.
+    """
+    bridge = BenchStreamBridge()
+    controller = IzziController(bridge, True)
+    controller.set_unit_on(True)
+
+    counts = {'writes': 0, 'torn': 0}
+
+    def on_write(message):
+        counts['writes'] += 1
+        if message[IZZI_CMD_MSG_SUPPLY_FAN_SPEED_INDEX] != message[IZZI_CMD_MSG_EXTRACT_FAN_SPEED_INDEX]:
+            counts['torn'] += 1
+    bridge.on_write = on_write
+
+    async def unit():
+        counter = 0
+        while True:
+            bridge.inject(status_message(counter))
+            counter += 1
+            await asyncio.sleep(period)
+
+    def publish(offset):
+        for counter in range(commands):
+            speed = 20 + (7 * counter + offset) % 81
+            controller.set_fan_speed(speed, speed)
+            time.sleep(0.0005)
+
+    loop = asyncio.get_running_loop()
+    controller.connect()
+    unit_task = loop.create_task(unit())
+    await asyncio.sleep(3 * period)
+    counts['writes'] = 0
+    await asyncio.gather(*[loop.run_in_executor(None, publish, offset) for offset in range(threads)])
+    await asyncio.sleep(3 * period)
+    unit_task.cancel()
+    await controller.disconnect()
+
+    published = controller._commands.published
+    return {'unit': 'writes/command', 'value': counts['writes'] / published, 'published': published,
+            'superseded': controller.metrics.commands_superseded, 'torn': counts['torn'],
+            'frame_period_ms': period * 1e3}
+
+
+async def _wait_written(written, started, index, value, timeout=10.0):
+    while True:
+        for timestamp, message in reversed(written):
+            if timestamp < started:
+                break
+            if message[index] == value:
+                return timestamp
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError("Command not written")
+        await asyncio.sleep(0.001)
+
+
+async def run_all(args):
+    results = {}
+    results['decode_throughput'] = bench_decode(args.frames)
+    results['frame_processing'] = await bench_processing(args.frames // 10)
+    results['controller_import'] = bench_import()
+    results.update(bench_history(args.samples))
+    results['cf_ingest'] = bench_cf_ingest()
+    results['rx_to_state_latency'] = await bench_rx_latency(args.samples)
+    results['serial_wakeups'] = await bench_serial_wakeups()
+    command = await bench_command_latency(args.command_samples, args.period)
+    results['service_to_wire_latency_speed_raw'] = command['speed_raw']
+    results['service_to_wire_latency_bypass_mode'] = command['bypass_mode']
+    results['command_coalescing'] = await bench_command_coalescing()
+    results['burst_recovery'] = await bench_burst_recovery()
+    return results
+
+
+async def bench_burst_recovery(frames: int = 30, period: float = 0.1):
+    """Two frames back to back after connect, then frames every period.
+
+    Reports watchdog timeouts, which must be none. A period learned from
+    the burst made the watchdog fire between every frame.
+    """
+    bridge = BenchStreamBridge()
+    controller = IzziController(bridge, True)
+    controller.connect()
+    await asyncio.sleep(0.01)
+    bridge.inject(status_message(0) + status_message(1))
+    for counter in range(2, frames):
+        await asyncio.sleep(period)
+        bridge.inject(status_message(counter))
+    await asyncio.sleep(period)
+    metrics = controller.collect_metrics()
+    learned = controller._bus.period
+    await controller.disconnect()
+    return {'unit': 'timeouts', 'value': metrics.read_timeouts, 'connects': metrics.connects,
+            'period': learned}
+
+
+def _headline(result) -> float:
+    return result['value'] if 'value' in result else result['median']
+
+
+def compare(results, baseline, threshold: float) -> bool:
+    """Print change against baseline, returns False on regression."""
+    ok = True
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        old = _headline(baseline['results'][name])
+        new = _headline(result)
+        # Throughput is better when higher, everything else when lower
+        higher_is_better = result['unit'].endswith('/s')
+        if min(old, new) <= 0:
+            # Counts which should stay at zero
+            regressed = new < old if higher_is_better else new > old
+        else:
+            ratio = (old / new) if higher_is_better else (new / old)
+            regressed = ratio > 1.0 + threshold
+        ok = ok and not regressed
+        print("%-40s %12.3f -> %12.3f %-8s %s" % (name, old, new, result['unit'], "REGRESSION" if regressed else ""))
+    return ok
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the iZZi frame pipeline.")
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--samples', type=int, default=200, help="rx latency samples")
+    parser.add_argument('--command-samples', type=int, default=20)
+    parser.add_argument('--period', type=float, default=0.25, help="emulated status frame period [s]")
+    parser.add_argument('--output', help="write results to this json file")
+    parser.add_argument('--compare', help="compare with results of a previous run")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative change reported as regression")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run_all(args))
+    report = {
+        'benchmark_version': BENCHMARK_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
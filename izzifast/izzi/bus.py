@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import logging
+
+from .protocol import IZZI_MESSAGE_LENGTH
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+
+class IzziBusScheduler(object):
+    """Finds slots on the RS485 bus where a command can be written.
+
+    The unit sends a status frame every period and the line stays quiet until
+    the next one. Period and jitter are learned from frame arrival times the
+    same way TCP estimates round trip time, the command is written after a
+    short turnaround and must end before the earliest expected next frame.
+    Gaps shorter than a frame time are frames read together, not the
+    period. The period is taken once a few gaps agree and learned again when
+    the gaps keep falling far from it, so one odd gap can't skew the cycle.
+    A written command keeps the line busy for one frame time, the next one
+    waits for it instead of queueing up in the transmit buffer.
+    """
+
+    DEFAULT_PERIOD = 1.0
+
+    # Line turnaround after the status frame [s]
+    TURNAROUND = 0.05
+
+    # Status frames between keep-alive writes
+    KEEPALIVE_FRAMES = 2
+
+    # Read timeout until the frame period is known [s]
+    DEFAULT_READ_TIMEOUT = 3.0
+
+    # Shortest watchdog timeout whatever the learned period [s]
+    MIN_READ_TIMEOUT = DEFAULT_READ_TIMEOUT / 2.0
+
+    # Status frame is missing after this many periods
+    WATCHDOG_PERIODS = 1.5
+
+    PERIOD_GAIN = 0.125
+    JITTER_GAIN = 0.25
+
+    # Consecutive gaps which have to agree before the period is taken
+    PERIOD_SAMPLES = 3
+    # Relative spread allowed between them
+    PERIOD_TOLERANCE = 0.25
+    # Consecutive gaps outside of half to 2.5 periods after which it's learned again
+    RELEARN_GAPS = 4
+
+    def __init__(self, baudrate: int = 9600, turnaround: float = TURNAROUND) -> None:
+        # 8N1, 10 bits per byte
+        self.frame_time = IZZI_MESSAGE_LENGTH * 10.0 / baudrate
+        self.turnaround = turnaround
+        self.period = None
+        self.jitter = 0.0
+        self.last_frame = None
+        self.frames = 0
+        self.busy_until = 0.0
+        self._gaps = []
+        self._outliers = 0
+
+    def reset(self):
+        """Forget frame timing after reconnect, it's learned again from the new link."""
+        self.period = None
+        self.jitter = 0.0
+        self.last_frame = None
+        self.frames = 0
+        self.busy_until = 0.0
+        self._gaps = []
+        self._outliers = 0
+
+    def frame_received(self, timestamp: float):
+        """Update timing estimate with arrival time of a status frame."""
+        if self.last_frame is not None:
+            interval = timestamp - self.last_frame
+            if interval < self.frame_time:
+                # Burst after connect, a buffering bridge or a fast replay
+                pass
+            elif self.period is None:
+                self._learn(interval)
+            elif 0.5 * self.period < interval < 2.5 * self.period:
+                self._outliers = 0
+                error = interval - self.period
+                self.period += self.PERIOD_GAIN * error
+                self.jitter += self.JITTER_GAIN * (abs(error) - self.jitter)
+            else:
+                # Longer intervals are missed frames, not jitter, unless they keep coming
+                self._outliers += 1
+                if self._outliers >= self.RELEARN_GAPS:
+                    _LOGGER.debug("Frame period %.3f s no longer fits, learning it again", self.period)
+                    self.period = None
+                    self.jitter = 0.0
+                    self._outliers = 0
+                    self._learn(interval)
+        self.last_frame = timestamp
+        self.frames += 1
+
+    def _learn(self, interval: float):
+        gaps = self._gaps
+        gaps.append(interval)
+        del gaps[:-self.PERIOD_SAMPLES]
+        if len(gaps) < self.PERIOD_SAMPLES or max(gaps) > (1.0 + self.PERIOD_TOLERANCE) * min(gaps):
+            return
+        self.period = sorted(gaps)[len(gaps) // 2]
+        self.jitter = (max(gaps) - min(gaps)) / 2.0
+        del gaps[:]
+        _LOGGER.debug("Frame period %.3f s", self.period)
+
+    def read_timeout(self, now: float) -> float:
+        """Returns time left until the next status frame is overdue."""
+        if self.period is None:
+            return self.DEFAULT_READ_TIMEOUT
+        timeout = max(self.MIN_READ_TIMEOUT, self.WATCHDOG_PERIODS * self.period + 4.0 * self.jitter)
+        if self.last_frame is None:
+            return timeout
+        return max(0.0, self.last_frame + timeout - now)
+
+    def keepalive_due(self) -> bool:
+        return self.frames % self.KEEPALIVE_FRAMES == 0
+
+    def window(self):
+        """Returns (start, end) of the current quiet window or None before the first frame."""
+        if self.last_frame is None:
+            return None
+        period = self.period if self.period is not None else self.DEFAULT_PERIOD
+        turnaround = min(self.turnaround, period / 4.0)
+        start = self.last_frame + turnaround
+        end = self.last_frame + period - 4.0 * self.jitter - self.frame_time - turnaround
+        # Too short windows still get a best effort slot right after turnaround
+        return start, max(start + self.frame_time, end)
+
+    def slot_delay(self, now: float):
+        """Returns delay until command can be written or None if the window is missed.
+
+        When None is returned the command has to wait for the next status frame.
+        """
+        window = self.window()
+        if window is None:
+            return None
+        start, end = window
+        start = max(start, self.busy_until)
+        if start > end:
+            return None
+        if now < start:
+            return start - now
+        if now <= end:
+            return 0.0
+        return None
+
+    def written(self, now: float):
+        """A command was written at now."""
+        self.busy_until = now + self.frame_time
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import logging
+from array import array
+
+from .cf import CfCurve
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+# Fan speeds of the sweep [%]
+CALIBRATION_SPEEDS = (20, 30, 40, 50, 60, 70, 80, 90, 100)
+
+
+class CfCalibration(object):
+    """Steps both fans through a speed sweep and fits their pressure curves.
+
+    At every speed the fans get settle_time seconds to get there, pressure
+    samples taken in the following sample_time seconds are kept, late ones
+    are told apart by their timestamps. A speed without samples of both fans
+    is skipped after a few more sample times. When the sweep is done
+    fit() fits a polynomial per fan by least squares and tabulates it.
+    """
+
+    SETTLE_TIME = 20.0
+    SAMPLE_TIME = 30.0
+    MIN_SAMPLES = 3
+    DEGREE = 3
+
+    def __init__(self, speeds=CALIBRATION_SPEEDS, settle_time: float = SETTLE_TIME,
+                 sample_time: float = SAMPLE_TIME, degree: int = DEGREE) -> None:
+        speeds = sorted(set(int(speed) for speed in speeds))
+        if len(speeds) < degree + 1:
+            raise ValueError("Calibration needs at least %d speeds" % (degree + 1))
+        if speeds[0] < 15 or speeds[-1] > 100:
+            raise ValueError("Calibration speeds must be within 15 and 100 %")
+        self.speeds = tuple(speeds)
+        self.settle_time = settle_time
+        self.sample_time = sample_time
+        self.degree = degree
+        self.skipped = []
+        self._step = 0
+        self._step_start = None
+        # Supply and extract, speeds and pressures of each
+        self._step_samples = [0, 0]
+        self._samples = ((array('d'), array('d')), (array('d'), array('d')))
+
+    @property
+    def speed(self):
+        """Fan speed of the current step, None when done."""
+        if self._step >= len(self.speeds):
+            return None
+        return self.speeds[self._step]
+
+    def done(self) -> bool:
+        return self._step >= len(self.speeds)
+
+    def start(self, now: float):
+        self._step = 0
+        self._step_start = now
+        self._step_samples = [0, 0]
+        self.skipped = []
+        for speeds, pressures in self._samples:
+            del speeds[:], pressures[:]
+        _LOGGER.info("CF calibration started, speed %d", self.speed)
+
+    def add_samples(self, timestamps, supply, extract) -> int:
+        """Pressures measured at timestamps, NaN if not measured.
+
+        Only samples taken after the fans settled at the current speed are
+        kept, returns their number.
+        """
+        if self._step_start is None or self.done():
+            return 0
+        settled = self._step_start + self.settle_time
+        speed = self.speed
+        taken = 0
+        for channel, values in enumerate((supply, extract)):
+            speeds, pressures = self._samples[channel]
+            count = len(pressures)
+            for timestamp, value in zip(timestamps, values):
+                if value == value and timestamp >= settled:
+                    pressures.append(value)
+            count = len(pressures) - count
+            speeds.extend([speed] * count)
+            self._step_samples[channel] += count
+            taken += count
+        return taken
+
+    def advance(self, now: float) -> bool:
+        """Move to the next speed when the current one is sampled, returns whether it did."""
+        if self._step_start is None or self.done():
+            return False
+        elapsed = now - self._step_start - self.settle_time
+        if elapsed < self.sample_time:
+            return False
+        if min(self._step_samples) < self.MIN_SAMPLES:
+            if elapsed < 3 * self.sample_time:
+                return False
+            _LOGGER.warning("No CF params at speed %d, skipped", self.speed)
+            self.skipped.append(self.speed)
+        self._step += 1
+        self._step_start = now
+        self._step_samples = [0, 0]
+        if self.done():
+            _LOGGER.info("CF calibration sweep done, %d samples", sum(len(pressures) for speeds, pressures in self._samples))
+        else:
+            _LOGGER.debug("CF calibration speed %d", self.speed)
+        return True
+
+    def fit(self):
+        """Returns fitted supply and extract CfCurve, loads numpy.
+
+        Curves are made non-decreasing from the top speed down and never
+        negative, the scale is the pressure at 100 %.
+        """
+        import numpy as np
+
+        grid = np.arange(101) / 100.0
+        curves = []
+        for speeds, pressures in self._samples:
+            speeds = np.frombuffer(speeds) / 100.0
+            if len(np.unique(speeds)) < self.degree + 1:
+                raise ValueError("CF calibration has samples at %d speeds only" % len(np.unique(speeds)))
+            coefficients = np.polyfit(speeds, np.frombuffer(pressures), self.degree)
+            table = np.minimum.accumulate(np.polyval(coefficients, grid)[::-1])[::-1]
+            table = np.maximum(table, 0.0)
+            if table[100] <= 0.0:
+                raise ValueError("CF calibration measured no pressure")
+            curves.append(CfCurve(table.tolist(), float(table[100]), calibrated=True))
+        return tuple(curves)
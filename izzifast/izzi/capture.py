@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""Raw frame capture files and deterministic playback.
+
+A capture file starts with a short header followed by fixed size records,
+each holding the monotonic receive time in nanoseconds, the direction and
+the raw 15 byte frame.
+"""
+
+import asyncio
+import logging
+import mmap
+import struct
+import time
+from collections import deque
+
+from .const import *
+from .controller import IzziBridge
+from .protocol import IZZI_MESSAGE_LENGTH
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+CAPTURE_MAGIC = b'IZZC'
+CAPTURE_VERSION = 1
+
+CAPTURE_DIRECTION_RX = 0
+CAPTURE_DIRECTION_TX = 1
+
+# Magic, version, record size
+_HEADER = struct.Struct('<4sHH')
+# Monotonic time [ns], direction, frame
+_RECORD = struct.Struct('<QB%ds' % IZZI_MESSAGE_LENGTH)
+
+
+class IzziFrameRecorder(object):
+    """Appends frames to a capture file."""
+
+    def __init__(self, path: str, buffering: int = 64 * _RECORD.size) -> None:
+        self.path = path
+        self._file = open(path, 'ab', buffering=buffering)
+        if self._file.tell() == 0:
+            self._file.write(_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, _RECORD.size))
+        self._record = bytearray(_RECORD.size)
+        self.count = 0
+
+    def record(self, message, direction: int = CAPTURE_DIRECTION_RX):
+        _RECORD.pack_into(self._record, 0, time.monotonic_ns(), direction, bytes(message))
+        self._file.write(self._record)
+        self.count += 1
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+
+class IzziRecordingBridge(IzziBridge):
+    """Wraps any bridge and records every frame read from or written to it."""
+
+    def __init__(self, bridge: IzziBridge, recorder: IzziFrameRecorder) -> None:
+        self._bridge = bridge
+        self._recorder = recorder
+
+    async def connect(self) -> bool:
+        return await self._bridge.connect()
+
+    def disconnect(self) -> bool:
+        self._recorder.flush()
+        return self._bridge.disconnect()
+
+    def close(self):
+        """Close the capture file, disconnect() only flushes it as the controller reconnects."""
+        self._recorder.close()
+
+    def is_connected(self):
+        return self._bridge.is_connected()
+
+    @property
+    def skipped_bytes(self) -> int:
+        return getattr(self._bridge, 'skipped_bytes', 0)
+
+    @property
+    def rx_wakeups(self) -> int:
+        return getattr(self._bridge, 'rx_wakeups', 0)
+
+    @property
+    def baudrate(self) -> int:
+        return self._bridge.baudrate
+
+    async def read_message(self, timeout=3.0) -> b'':
+        message = await self._bridge.read_message(timeout)
+        if message is not None:
+            self._recorder.record(message, CAPTURE_DIRECTION_RX)
+        return message
+
+    def write_message(self, message: b'') -> bool:
+        self._recorder.record(message, CAPTURE_DIRECTION_TX)
+        return self._bridge.write_message(message)
+
+
+class IzziCapture(object):
+    """Memory mapped, read only view of a capture file."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as capture_file:
+            self._mmap = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = _HEADER.unpack_from(self._mmap, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION or record_size != _RECORD.size:
+            self._mmap.close()
+            raise ValueError("Unsupported capture file %s" % path)
+        # Ignore partially written last record
+        self._count = (len(self._mmap) - _HEADER.size) // _RECORD.size
+        self._view = memoryview(self._mmap)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def record(self, index: int):
+        """Returns (timestamp_ns, direction, frame view) of record."""
+        offset = _HEADER.size + index * _RECORD.size
+        timestamp, direction = struct.unpack_from('<QB', self._mmap, offset)
+        frame_offset = offset + 9
+        return timestamp, direction, self._view[frame_offset:frame_offset + IZZI_MESSAGE_LENGTH]
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+
+class IzziReplayBridge(IzziBridge):
+    """Plays a capture file back as if it was received from the unit.
+
+    speed 1.0 replays in real time, other positive values scale the time
+    between frames and 0 replays as fast as possible. Only received frames
+    are played back, the latest written messages are kept in `written`.
+    """
+
+    MAX_WRITTEN_MESSAGES = 1024
+
+    def __init__(self, path: str, speed: float = 1.0, loop_playback: bool = False) -> None:
+        self.path = path
+        self.speed = speed
+        self.loop_playback = loop_playback
+        self.written = deque([], self.MAX_WRITTEN_MESSAGES)
+        self._capture = None
+        self._index = 0
+        self._start_capture = None
+        self._start_time = None
+
+    async def connect(self) -> bool:
+        if self._capture is None:
+            # Playback resumes where it stopped, timing restarts from now
+            self._capture = IzziCapture(self.path)
+            self._start_capture = None
+        return True
+
+    def disconnect(self) -> bool:
+        if self._capture is not None:
+            self._capture.close()
+        self._capture = None
+        return True
+
+    def is_connected(self):
+        return self._capture is not None
+
+    def is_finished(self) -> bool:
+        return self._capture is not None and self._index >= len(self._capture)
+
+    async def read_message(self, timeout=3.0) -> b'':
+        if self._capture is None:
+            raise Exception('Broken pipe')
+
+        while True:
+            if self._index >= len(self._capture):
+                if not self.loop_playback or len(self._capture) == 0:
+                    # Behave like an idle line
+                    await asyncio.sleep(timeout)
+                    return None
+                self._index = 0
+                self._start_capture = None
+
+            timestamp, direction, frame = self._capture.record(self._index)
+            self._index += 1
+            if direction == CAPTURE_DIRECTION_RX:
+                break
+
+        if self._start_capture is None:
+            self._start_capture = timestamp
+            self._start_time = time.monotonic_ns()
+        elif self.speed > 0:
+            due = self._start_time + (timestamp - self._start_capture) / self.speed
+            delay = (due - time.monotonic_ns()) / 1e9
+            if delay > timeout:
+                await asyncio.sleep(timeout)
+                self._index -= 1
+                return None
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif self._index % 64 == 0:
+            # Let other tasks run when replaying as fast as possible
+            await asyncio.sleep(0)
+        return bytes(frame)
+
+    def write_message(self, message: b'') -> bool:
+        if self._capture is None:
+            raise Exception('Not connected!')
+        self.written.append(bytes(message))
+        return True
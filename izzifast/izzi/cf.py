@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+
+import logging
+import math
+import time
+from array import array
+
+from .stats import RunningWindow
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+
+def expected_param(params_max: float, speed: float) -> float:
+    """Pressure expected at fan speed [%] with clean filters."""
+    norm = speed / 100.0
+    return max(0.0, params_max * (norm * norm * norm) + 40.0 * norm - 6.0)
+
+
+class CfCurve(object):
+    """Expected pressure of one fan, read from a table per integer speed 0-100 %.
+
+    Pressure errors are taken in percent of scale. Curves from params_max
+    follow the default formula, calibrated ones are fitted on the installation
+    and aren't replaced when params_max changes.
+    """
+
+    __slots__ = ('table', 'scale', 'calibrated')
+
+    def __init__(self, table, scale: float, calibrated: bool = False) -> None:
+        if len(table) != 101:
+            raise ValueError("CF curve needs 101 values")
+        self.table = array('d', table)
+        self.scale = scale
+        self.calibrated = calibrated
+
+    @classmethod
+    def from_params_max(cls, params_max: float) -> 'CfCurve':
+        return cls([expected_param(params_max, speed) for speed in range(101)], params_max)
+
+    def expected(self, speed) -> float:
+        return self.table[min(max(int(speed), 0), 100)]
+
+    def as_dict(self) -> dict:
+        return {'table': list(self.table), 'scale': self.scale, 'calibrated': self.calibrated}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'CfCurve':
+        return cls(data['table'], data['scale'], data.get('calibrated', True))
+
+
+class CfEngine(object):
+    """Constant flow engine, corrects fan speeds from the measured pressures.
+
+    get_*_speed() is called with the target speed whenever the command is
+    computed, at least once per status frame, and returns the speed to write.
+    """
+
+    def set_enabled(self, enabled: bool):
+        """Turn the correction on or off."""
+        pass
+    def is_enabled(self) -> bool:
+        """Returns whether speeds are corrected."""
+        pass
+
+    def set_params_max(self, params_max: float):
+        """Pressure at 100 % the default curves are scaled to."""
+        pass
+    def get_params_max(self) -> float:
+        pass
+
+    def set_curves(self, supply: CfCurve, extract: CfCurve):
+        """Expected pressures of both fans, params_max doesn't change calibrated curves."""
+        pass
+    def get_curves(self):
+        """Returns supply and extract CfCurve."""
+        pass
+
+    def set_current_params(self, supply: float, extract: float):
+        """Pressures measured now."""
+        pass
+    def add_samples(self, timestamps, supply, extract) -> int:
+        """Pressures measured at timestamps (on the engine clock), NaN if not measured.
+
+        Returns number of pressure values taken.
+        """
+        pass
+
+    def get_supply_speed(self, exp_speed: int) -> int:
+        """Returns supply speed to write for target speed exp_speed."""
+        pass
+    def get_extract_speed(self, exp_speed: int) -> int:
+        """Returns extract speed to write for target speed exp_speed."""
+        pass
+
+    def get_supply_correction(self) -> int:
+        """Returns current supply correction in %."""
+        pass
+    def get_extract_correction(self) -> int:
+        """Returns current extract correction in %."""
+        pass
+
+
+class CfController(CfEngine):
+    """Original algorithm, proportional correction plus a slowly moving base correction."""
+
+    # exp. press = 0,014*(perc*perc)-0,18*perc
+
+    CF_PARAMS_LENGTH = 5
+    
+    CF_CORRECTION_LENGTH = 5
+    
+    # Max speed correction as a fraction of the target speed
+    CF_CORRECTION_LIMIT = 0.25
+    
+    _module_enabled = False
+
+    _params_max = 0.0
+    
+    _supply_speed = 0.0
+    _supply_speed_correction = 0.0
+    _supply_base_correction = 0
+    _extract_speed = 0.0
+    _extract_speed_correction = 0.0
+    _extract_base_correction = 0
+    
+    _supply_exp_param = 0.0
+    _extract_exp_param = 0.0
+    
+    
+    def __init__(self, params_length : int = CF_PARAMS_LENGTH, correction_length : int = CF_CORRECTION_LENGTH, correction_limit : float = CF_CORRECTION_LIMIT):
+        self._module_enabled = False
+        self._params_supply = RunningWindow(params_length)
+        self._params_extract = RunningWindow(params_length)
+    
+        self._corrections_supply = RunningWindow(correction_length)
+        self._corrections_extract = RunningWindow(correction_length)
+        self._correction_limit = correction_limit
+        self._supply_curve = CfCurve.from_params_max(self._params_max)
+        self._extract_curve = CfCurve.from_params_max(self._params_max)
+    
+    def set_enabled(self, enabled : bool):
+        self._module_enabled = enabled
+        
+    def set_params_max(self, params_max : float):
+        self._params_max = params_max
+        if not self._supply_curve.calibrated:
+            self._supply_curve = CfCurve.from_params_max(params_max)
+        if not self._extract_curve.calibrated:
+            self._extract_curve = CfCurve.from_params_max(params_max)
+        _LOGGER.debug("CF params max %f", self._params_max)
+
+    def get_params_max(self) -> float:
+        return self._params_max
+
+    def set_curves(self, supply: CfCurve, extract: CfCurve):
+        self._supply_curve = supply
+        self._extract_curve = extract
+        # Recomputed from the new curves on next call
+        self._supply_speed = 0.0
+        self._extract_speed = 0.0
+
+    def get_curves(self):
+        return self._supply_curve, self._extract_curve
+    
+    def set_current_params(self, supply : float, extract : float):
+        self._params_supply.append(supply)
+        self._params_extract.append(extract)
+
+    def add_samples(self, timestamps, supply, extract) -> int:
+        # Windows hold the latest samples, their time isn't used
+        taken = 0
+        for window, values in ((self._params_supply, supply), (self._params_extract, extract)):
+            for value in values:
+                if value == value:
+                    window.append(value)
+                    taken += 1
+        return taken
+   
+    def get_supply_speed(self, exp_speed : int) -> int:
+        if int(self._supply_speed) != exp_speed :
+            self._supply_speed = float(exp_speed)
+            self._supply_exp_param = self._supply_curve.expected(exp_speed)
+            self._params_supply.clear()
+            #self._supply_base_correction = 0
+            self._corrections_supply.clear()
+        
+            _LOGGER.debug("Expected Supply CF params %f", self._supply_exp_param)
+            
+        target_val = self._supply_speed
+        correction_limit = int(target_val * self._correction_limit)
+        if self._module_enabled :
+        
+            if len(self._params_supply) >= self._params_supply.maxlen-1 :
+                
+                supply_param_avg = self._params_supply.mean()
+        
+                paramDiff = supply_param_avg - self._supply_exp_param
+                
+                # convert difference to percent and change sign
+                diffPerc = (paramDiff / self._supply_curve.scale) * -100.0
+                # If speed higher allow bigger differences
+                supply_norm = self._supply_speed / 100.0
+                diffPerc = diffPerc * (0.4 * (1.0 - (supply_norm*supply_norm*supply_norm)) + 0.6)
+                
+                if abs(int(diffPerc)) > correction_limit :
+                    diffPerc = (abs(diffPerc) / diffPerc) * correction_limit
+                    
+                self._supply_speed_correction = int(diffPerc)
+
+                #
+                self._corrections_supply.append(self._supply_speed_correction)
+                if len(self._corrections_supply) >= self._corrections_supply.maxlen :
+                    supply_correction_avg = self._corrections_supply.mean()
+                    if abs(supply_correction_avg) > 1 :
+                        self._supply_base_correction += abs(supply_correction_avg) / supply_correction_avg
+                        if abs(self._supply_base_correction) > correction_limit :
+                            self._supply_base_correction = correction_limit * abs(self._supply_base_correction) / self._supply_base_correction
+                    self._corrections_supply.clear()
+                    
+                _LOGGER.debug("CF Supply diff %f, correction %d, avg %f, base %d", paramDiff, self._supply_speed_correction, supply_param_avg, self._supply_base_correction)
+                
+            target_val += self._supply_speed_correction + self._supply_base_correction
+            if target_val > 100 :
+                target_val = 100
+            elif target_val < self._supply_speed/2 :
+                target_val = self._supply_speed/2
+        return int(target_val)
+    
+    def get_extract_speed(self, exp_speed : int) -> int:
+        if int(self._extract_speed) != exp_speed :
+            self._extract_speed = float(exp_speed)
+            self._extract_exp_param = self._extract_curve.expected(exp_speed)
+            self._params_extract.clear()
+            #self._extract_base_correction = 0
+            self._corrections_extract.clear()
+        
+            _LOGGER.debug("Expected Extract CF params %f", self._extract_exp_param)
+        
+        target_val = self._extract_speed
+        correction_limit = int(target_val * self._correction_limit)
+        if self._module_enabled :
+                
+            if len(self._params_extract) >= self._params_extract.maxlen-1 :
+                
+                extract_param_avg = self._params_extract.mean()
+                
+                paramDiff = extract_param_avg - self._extract_exp_param
+                # convert difference to percent and change sign
+                diffPerc = (paramDiff / self._extract_curve.scale) * -100.0
+                # If speed higher allow bigger differences
+                extract_norm = self._extract_speed / 100.0
+                diffPerc = diffPerc * (0.4 * (1.0 - (extract_norm*extract_norm*extract_norm)) + 0.6)
+                
+                if abs(int(diffPerc)) > correction_limit :
+                    diffPerc = (abs(diffPerc) / diffPerc) * correction_limit
+                    
+                self._extract_speed_correction = int(diffPerc)
+
+                #
+                self._corrections_extract.append(self._extract_speed_correction)
+                if len(self._corrections_extract) >= self._corrections_extract.maxlen :
+                    extract_correction_avg = self._corrections_extract.mean()
+                    if abs(extract_correction_avg) > 1 :
+                        self._extract_base_correction += abs(extract_correction_avg) / extract_correction_avg
+                        if abs(self._extract_base_correction) > correction_limit :
+                            self._extract_base_correction = correction_limit * abs(self._extract_base_correction) / self._extract_base_correction
+                    self._corrections_extract.clear()
+                    
+                _LOGGER.debug("CF Extract diff %f, correction %d avg %f, base %d", paramDiff, self._extract_speed_correction, extract_param_avg, self._extract_base_correction)
+                
+            target_val += self._extract_speed_correction + self._extract_base_correction
+            if target_val > 100 :
+                target_val = 100
+            elif target_val < self._extract_speed/2 :
+                target_val = self._extract_speed/2
+        return int(target_val)
+    
+    def is_enabled(self) -> bool:
+        return self._module_enabled
+    
+    def get_extract_correction(self) -> int:
+        return int(self._extract_base_correction)
+    
+    def get_supply_correction(self) -> int:
+        return int(self._supply_base_correction)
+
+
+class CfPiChannel(object):
+    """Discrete PI loop of one fan.
+
+    Pressure samples are averaged between updates. The error is taken in
+    percent of the curve scale, weighted by speed like the original algorithm.
+    The correction is clamped to the limits and rate limited, the integral
+    then tracks the correction actually applied so it can't wind up while
+    the output is saturated.
+    """
+
+    __slots__ = ('kp', 'ki', 'rate_limit', 'correction_limit', 'curve', 'speed', 'expected',
+                 'integral', 'correction', '_sum', '_count', '_updated', '_changed')
+
+    def __init__(self, kp: float, ki: float, rate_limit: float, correction_limit: float) -> None:
+        self.kp = kp
+        self.ki = ki
+        self.rate_limit = rate_limit
+        self.correction_limit = correction_limit
+        self.curve = CfCurve.from_params_max(0.0)
+        self.speed = None
+        self.expected = 0.0
+        self.integral = 0.0
+        self.correction = 0.0
+        self._sum = 0.0
+        self._count = 0
+        self._updated = None
+        self._changed = -math.inf
+
+    def limits(self):
+        """Returns lowest and highest correction at the current speed."""
+        limit = int(self.speed * self.correction_limit)
+        return max(-limit, -self.speed / 2.0), min(limit, 100 - self.speed)
+
+    def set_curve(self, curve: CfCurve):
+        self.curve = curve
+        if self.speed is not None:
+            self.expected = curve.expected(self.speed)
+
+    def add_sample(self, value: float):
+        self._sum += value
+        self._count += 1
+
+    def add_samples(self, timestamps, values) -> int:
+        """Adds samples taken at the current speed, returns their number."""
+        changed = self._changed
+        total = 0.0
+        count = 0
+        for timestamp, value in zip(timestamps, values):
+            if value == value and timestamp >= changed:
+                total += value
+                count += 1
+        self._sum += total
+        self._count += count
+        return count
+
+    def set_speed(self, speed: int, now: float):
+        """New target speed, the samples taken at the old one are dropped."""
+        if speed == self.speed:
+            return
+        if self.speed:
+            # Bumpless, keep the correction as a fraction of the speed
+            self.integral *= speed / self.speed
+        self.speed = speed
+        self.expected = self.curve.expected(speed)
+        low, high = self.limits()
+        self.integral = min(max(self.integral, low), high)
+        self.correction = self.integral
+        self._sum = 0.0
+        self._count = 0
+        self._updated = now
+        self._changed = now
+        _LOGGER.debug("Expected CF params %f at speed %d", self.expected, speed)
+
+    def update(self, now: float, interval: float):
+        """Compute new correction if interval passed and there are samples."""
+        if self._count == 0 or self.curve.scale <= 0 or now - self._updated < interval:
+            return
+        # A long gap without samples mustn't integrate as one huge step
+        dt = min(now - self._updated, 5.0 * interval)
+        self._updated = now
+        average = self._sum / self._count
+        self._sum = 0.0
+        self._count = 0
+
+        norm = self.speed / 100.0
+        error = (self.expected - average) / self.curve.scale * 100.0
+        # If speed higher allow bigger differences
+        error *= 0.4 * (1.0 - (norm * norm * norm)) + 0.6
+
+        integral = self.integral + self.ki * error * dt
+        wanted = self.kp * error + integral
+        low, high = self.limits()
+        step = self.rate_limit * dt
+        correction = min(max(wanted, self.correction - step, low), self.correction + step, high)
+        if correction != wanted:
+            # Anti-windup, integral tracks the limited correction
+            integral = correction - self.kp * error
+        self.integral = min(max(integral, low), high)
+        self.correction = correction
+        _LOGGER.debug("CF diff %f, error %f, correction %f", average - self.expected, error, correction)
+
+    def output(self) -> int:
+        target = self.speed + self.correction
+        return int(round(min(max(target, self.speed / 2.0), 100.0)))
+
+
+class CfPiController(CfEngine):
+    """PI constant flow engine, one loop per fan sharing the same tuning.
+
+    Corrections are updated at most every update_interval seconds from the
+    samples received in between, on the time of clock.
+    """
+
+    CF_KP = 0.3
+
+    # Integral gain [1/s]
+    CF_KI = 0.08
+
+    CF_UPDATE_INTERVAL = 2.0
+
+    # Max change of the correction [%/s]
+    CF_RATE_LIMIT = 2.0
+
+    CF_CORRECTION_LIMIT = CfController.CF_CORRECTION_LIMIT
+
+    def __init__(self, kp: float = CF_KP, ki: float = CF_KI, update_interval: float = CF_UPDATE_INTERVAL,
+                 rate_limit: float = CF_RATE_LIMIT, correction_limit: float = CF_CORRECTION_LIMIT,
+                 clock=time.monotonic) -> None:
+        if update_interval <= 0:
+            raise ValueError("CF update interval must be positive")
+        self._module_enabled = False
+        self._params_max = 0.0
+        self._update_interval = update_interval
+        self._clock = clock
+        self._supply = CfPiChannel(kp, ki, rate_limit, correction_limit)
+        self._extract = CfPiChannel(kp, ki, rate_limit, correction_limit)
+
+    def set_enabled(self, enabled: bool):
+        self._module_enabled = enabled
+
+    def is_enabled(self) -> bool:
+        return self._module_enabled
+
+    def set_params_max(self, params_max: float):
+        self._params_max = params_max
+        for channel in (self._supply, self._extract):
+            if not channel.curve.calibrated:
+                channel.set_curve(CfCurve.from_params_max(params_max))
+        _LOGGER.debug("CF params max %f", params_max)
+
+    def get_params_max(self) -> float:
+        return self._params_max
+
+    def set_curves(self, supply: CfCurve, extract: CfCurve):
+        self._supply.set_curve(supply)
+        self._extract.set_curve(extract)
+
+    def get_curves(self):
+        return self._supply.curve, self._extract.curve
+
+    def set_current_params(self, supply: float, extract: float):
+        self._supply.add_sample(supply)
+        self._extract.add_sample(extract)
+
+    def add_samples(self, timestamps, supply, extract) -> int:
+        return self._supply.add_samples(timestamps, supply) + self._extract.add_samples(timestamps, extract)
+
+    def _speed(self, channel: CfPiChannel, exp_speed: int) -> int:
+        now = self._clock()
+        channel.set_speed(exp_speed, now)
+        if not self._module_enabled:
+            return exp_speed
+        channel.update(now, self._update_interval)
+        return channel.output()
+
+    def get_supply_speed(self, exp_speed: int) -> int:
+        return self._speed(self._supply, exp_speed)
+
+    def get_extract_speed(self, exp_speed: int) -> int:
+        return self._speed(self._extract, exp_speed)
+
+    def get_supply_correction(self) -> int:
+        return int(round(self._supply.correction))
+
+    def get_extract_correction(self) -> int:
+        return int(round(self._extract.correction))
+
+
+# Engine names used in the configuration
+CF_ENGINES = {
+    'legacy': CfController,
+    'pi': CfPiController,
+}
+
+DEFAULT_CF_ENGINE = 'legacy'
+
+
+def create_cf_engine(name: str = DEFAULT_CF_ENGINE, clock=time.monotonic, update_interval: float = None) -> CfEngine:
+    """Returns new engine by name, the legacy one works per call and has no clock or interval."""
+    if name not in CF_ENGINES:
+        raise ValueError("Unknown CF engine %s" % name)
+    if name == 'legacy':
+        return CfController()
+    if update_interval is None:
+        return CF_ENGINES[name](clock=clock)
+    return CF_ENGINES[name](update_interval=update_interval, clock=clock)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+"""Offline simulation and parameter tuning of the constant flow (CF) module.
+
+Recorded traces of (time, target speed, supply pressure, extract pressure)
+are replayed in closed loop through the CfController algorithm for a whole
+grid of CF parameters at once. Traces are expected to be recorded with the
+CF module disabled, so the recorded pressure is the pressure at the target
+speed. When the simulated controller drives the fan at a different speed,
+pressure is scaled by the fan affinity law (pressure ~ speed^2), using the
+speed written in the previous step.
+
+Run from the izzifast directory:
+
+    python -m izzi.cf_tuning trace.csv --params-max 100 150 200 --correction-limit 0.2 0.25
+
+The CF engines can be compared on the same trace, or on a synthetic one
+with step changes of the target speed and dirty filters:
+
+    python -m izzi.cf_tuning --synthetic --params-max 150 --compare legacy pi
+"""
+
+import argparse
+import csv
+import itertools
+import logging
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .cf import CfController, CF_ENGINES, create_cf_engine
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+# Fans never run slower than this while the unit is on
+CF_MIN_SPEED = 15
+
+CfTuningConfig = namedtuple('CfTuningConfig', ['params_max', 'params_length', 'correction_length', 'correction_limit'])
+
+CfTuningResult = namedtuple('CfTuningResult', ['config', 'convergence_time', 'unconverged', 'overshoot', 'steady_state_error'])
+
+
+class CfTrace(object):
+    """Recorded time series used as input of the simulation."""
+
+    def __init__(self, timestamps, speeds, supply, extract) -> None:
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.speeds = np.asarray(speeds, dtype=int)
+        self.supply = np.asarray(supply, dtype=float)
+        self.extract = np.asarray(extract, dtype=float)
+        if not (len(self.timestamps) == len(self.speeds) == len(self.supply) == len(self.extract)):
+            raise ValueError("Trace columns differ in length")
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @classmethod
+    def load_csv(cls, path: str) -> 'CfTrace':
+        """Load trace from csv file with time, speed, supply and extract columns."""
+        with open(path, newline='') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        return cls([float(row['time']) for row in rows],
+                   [int(float(row['speed'])) for row in rows],
+                   [float(row['supply']) for row in rows],
+                   [float(row['extract']) for row in rows])
+
+    def segments(self):
+        """Returns (start, end) index pairs of constant target speed."""
+        changes = np.flatnonzero(np.diff(self.speeds)) + 1
+        bounds = np.concatenate(([0], changes, [len(self)]))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+def make_grid(params_max, params_length=(CfController.CF_PARAMS_LENGTH,),
+              correction_length=(CfController.CF_CORRECTION_LENGTH,),
+              correction_limit=(CfController.CF_CORRECTION_LIMIT,)):
+    """Returns every combination of the given parameter values."""
+    return [CfTuningConfig(*values) for values in itertools.product(params_max, params_length, correction_length, correction_limit)]
+
+
+def _expected_param(params_max, speed: int):
+    norm = speed / 100.0
+    return np.maximum(0.0, params_max * (norm * norm * norm) + 40.0 * norm - 6.0)
+
+
+def synthetic_trace(params_max: float, speeds=(30, 60, 90, 45, 70), duration: float = 300.0,
+                    period: float = 1.0, flow: float = 0.8, noise: float = 0.01, seed: int = 0) -> CfTrace:
+    """Returns trace with step changes of the target speed every duration seconds.
+
+    Recorded pressure is flow times the expected one plus gaussian noise, as
+    with partly clogged filters, so the engine has to raise both fan speeds.
+    """
+    rng = np.random.default_rng(seed)
+    steps = int(duration / period)
+    target = np.repeat(np.asarray(speeds, dtype=int), steps)
+    pressure = _expected_param(params_max, target) * flow
+    return CfTrace(np.arange(len(target)) * period, target,
+                   pressure * (1.0 + noise * rng.standard_normal(len(target))),
+                   pressure * (1.0 + noise * rng.standard_normal(len(target))))
+
+
+def simulate_engine(trace: CfTrace, engine, clock=None):
+    """Run trace through a CF engine, returns speeds written and pressures seen per step.
+
+    Both are shaped (steps, 2), supply then extract. clock is a one item list
+    set to the trace time before every step, give it to engines with a clock.
+    """
+    outputs = np.empty((len(trace), 2), dtype=int)
+    pressures = np.empty((len(trace), 2))
+    supply_speed = extract_speed = int(trace.speeds[0])
+    for k in range(len(trace)):
+        if clock is not None:
+            clock[0] = trace.timestamps[k]
+        speed = int(trace.speeds[k])
+        supply_scale = (supply_speed / speed) ** 2 if speed > 0 else 1.0
+        extract_scale = (extract_speed / speed) ** 2 if speed > 0 else 1.0
+        pressures[k] = (trace.supply[k] * supply_scale, trace.extract[k] * extract_scale)
+        engine.set_current_params(pressures[k, 0], pressures[k, 1])
+        supply_speed = max(engine.get_supply_speed(speed), CF_MIN_SPEED)
+        extract_speed = max(engine.get_extract_speed(speed), CF_MIN_SPEED)
+        outputs[k] = (supply_speed, extract_speed)
+    return outputs, pressures
+
+
+def simulate_reference(trace: CfTrace, config: CfTuningConfig):
+    """Run trace through a real CfController, returns speeds written per step.
+
+    Slow, one configuration at a time. Used to check the batch engine.
+    """
+    controller = CfController(config.params_length, config.correction_length, config.correction_limit)
+    controller.set_params_max(config.params_max)
+    controller.set_enabled(True)
+    outputs, _ = simulate_engine(trace, controller)
+    return outputs
+
+
+def compare_engines(trace: CfTrace, params_max: float, engines=tuple(CF_ENGINES), tolerance: float = 0.05):
+    """Returns CfTuningResult of every engine with default tuning, config is the engine name."""
+    simulator = CfBatchSimulator(trace, tolerance=tolerance)
+    results = []
+    for name in engines:
+        clock = [float(trace.timestamps[0])]
+        engine = create_cf_engine(name, clock=lambda: clock[0])
+        engine.set_params_max(params_max)
+        engine.set_enabled(True)
+        _, pressures = simulate_engine(trace, engine, clock)
+        results.append(CfTuningResult(name, *simulator.score(pressures, params_max)))
+    return results
+
+
+class CfBatchSimulator(object):
+    """Evaluates many CF configurations against one trace at once.
+
+    Configurations sharing window lengths are simulated together, one numpy
+    row per configuration and fan channel, mirroring CfController step by
+    step (including its integer truncations).
+    """
+
+    def __init__(self, trace: CfTrace, tolerance: float = 0.05, tolerance_abs: float = 1.0, steady_fraction: float = 0.25) -> None:
+        self._trace = trace
+        self._tolerance = tolerance
+        self._tolerance_abs = tolerance_abs
+        self._steady_fraction = steady_fraction
+
+    def run(self, configs):
+        """Returns CfTuningResult for every configuration, in input order."""
+        results = [None] * len(configs)
+        groups = {}
+        for position, config in enumerate(configs):
+            if config.params_max <= 0:
+                raise ValueError("params_max must be positive")
+            groups.setdefault((config.params_length, config.correction_length), []).append(position)
+
+        for (params_length, correction_length), positions in groups.items():
+            group = [configs[position] for position in positions]
+            metrics, _ = self._simulate(group, params_length, correction_length)
+            for position, config, values in zip(positions, group, metrics):
+                results[position] = CfTuningResult(config, *values)
+        return results
+
+    def outputs(self, configs):
+        """Returns speeds written per step, shaped (steps, configs, 2)."""
+        params_length = configs[0].params_length
+        correction_length = configs[0].correction_length
+        if any(c.params_length != params_length or c.correction_length != correction_length for c in configs):
+            raise ValueError("Configurations must share window lengths")
+        _, outputs = self._simulate(configs, params_length, correction_length, keep_outputs=True)
+        return outputs
+
+    def _simulate(self, configs, params_length, correction_length, keep_outputs=False):
+        trace = self._trace
+        count = len(configs)
+        rows = 2 * count
+
+        # Rows [0, count) are supply fans, rows [count, 2*count) extract fans
+        params_max = np.tile(np.array([c.params_max for c in configs], dtype=float), 2)
+        limit = np.tile(np.array([c.correction_limit for c in configs], dtype=float), 2)
+
+        params = np.zeros((rows, params_length))
+        corrections = np.zeros((rows, correction_length))
+        params_count = params_pos = corrections_count = 0
+        correction = np.zeros(rows)
+        base = np.zeros(rows)
+        output = np.full(rows, float(trace.speeds[0]))
+        recorded = np.empty(rows)
+
+        steps = len(trace)
+        outputs = np.empty((steps, count, 2), dtype=int) if keep_outputs else None
+
+        # Per segment metric accumulators
+        segment_ends = {start: end for start, end in trace.segments()}
+        conv_sum = np.zeros(rows)
+        conv_count = np.zeros(rows)
+        unconverged = np.zeros(rows)
+        overshoot_sum = np.zeros(rows)
+        steady_sum = np.zeros(rows)
+        segments = 0
+
+        speed = None
+        for k in range(steps):
+            exp_speed = int(trace.speeds[k])
+            changed = speed is None or int(speed) != exp_speed
+            if changed:
+                if speed is not None:
+                    self._close_segment(seg_state, trace.timestamps, k, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum)
+                    segments += 1
+                speed = float(exp_speed)
+                norm = speed / 100.0
+                expected = _expected_param(params_max, speed)
+                params_count = params_pos = corrections_count = 0
+                seg_state = self._segment_state(k, segment_ends[k], expected, rows)
+
+            # Fan model, pressure follows the speed written in previous step
+            recorded[:count] = trace.supply[k]
+            recorded[count:] = trace.extract[k]
+            pressure = recorded * (output / speed) ** 2 if speed > 0 else recorded.copy()
+
+            self._track(seg_state, k, pressure)
+
+            # CfController.set_current_params(), a speed change clears the
+            # window right after this sample was appended
+            if not changed:
+                params[:, params_pos] = pressure
+                params_pos = (params_pos + 1) % params_length
+                params_count = min(params_count + 1, params_length)
+
+            # CfController.get_*_speed()
+            correction_limit = np.trunc(speed * limit)
+            if params_count >= params_length - 1:
+                param_avg = params[:, :params_count].sum(axis=1) / params_count
+                diff = ((param_avg - expected) / params_max) * -100.0
+                diff = diff * (0.4 * (1.0 - (norm * norm * norm)) + 0.6)
+                diff = np.where(np.abs(np.trunc(diff)) > correction_limit, np.sign(diff) * correction_limit, diff)
+                correction = np.trunc(diff)
+
+                corrections[:, corrections_count] = correction
+                corrections_count += 1
+                if corrections_count >= correction_length:
+                    correction_avg = corrections.sum(axis=1) / correction_length
+                    moved = np.abs(correction_avg) > 1
+                    base = base + np.where(moved, np.sign(correction_avg), 0.0)
+                    base = np.where(moved & (np.abs(base) > correction_limit), correction_limit * np.sign(base), base)
+                    corrections_count = 0
+
+            target = speed + correction + base
+            target = np.where(target > 100, 100.0, np.where(target < speed / 2, speed / 2, target))
+            output = np.maximum(np.trunc(target), CF_MIN_SPEED)
+
+            if keep_outputs:
+                outputs[k, :, 0] = output[:count]
+                outputs[k, :, 1] = output[count:]
+
+        self._close_segment(seg_state, trace.timestamps, steps, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum)
+        segments += 1
+
+        metrics = self._metrics(count, segments, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum)
+        return metrics.tolist(), outputs
+
+    def score(self, pressures, params_max: float):
+        """Returns metrics of pressures simulated by any engine, shaped (steps, 2)."""
+        trace = self._trace
+        conv_sum = np.zeros(2)
+        conv_count = np.zeros(2)
+        unconverged = np.zeros(2)
+        overshoot_sum = np.zeros(2)
+        steady_sum = np.zeros(2)
+        segments = 0
+        for start, end in trace.segments():
+            expected = _expected_param(np.full(2, float(params_max)), float(trace.speeds[start]))
+            state = self._segment_state(start, end, expected, 2)
+            for k in range(start, end):
+                self._track(state, k, pressures[k])
+            self._close_segment(state, trace.timestamps, end, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum)
+            segments += 1
+        return self._metrics(1, segments, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum)[0].tolist()
+
+    def _segment_state(self, start, end, expected, rows) -> dict:
+        return {
+            'start': start,
+            'steady_start': end - max(1, int((end - start) * self._steady_fraction)),
+            'expected': expected,
+            'band': np.maximum(expected * self._tolerance, self._tolerance_abs),
+            'scale': np.maximum(expected, 1.0),
+            'sign': None,
+            'last_outside': np.full(rows, -1),
+            'overshoot': np.zeros(rows),
+            'steady': np.zeros(rows),
+            'steady_count': 0,
+        }
+
+    @staticmethod
+    def _metrics(count, segments, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum):
+        # Channels are weighted equally
+        with np.errstate(invalid='ignore'):
+            convergence = conv_sum / conv_count
+        convergence = (convergence[:count] + convergence[count:]) / 2.0
+        return np.column_stack((convergence,
+                                unconverged[:count] + unconverged[count:],
+                                (overshoot_sum[:count] + overshoot_sum[count:]) / (2.0 * segments),
+                                (steady_sum[:count] + steady_sum[count:]) / (2.0 * segments)))
+
+    def _track(self, state, k, pressure):
+        error = pressure - state['expected']
+        if state['sign'] is None:
+            state['sign'] = np.where(error >= 0, 1.0, -1.0)
+        outside = np.abs(error) > state['band']
+        state['last_outside'] = np.where(outside, k, state['last_outside'])
+        state['overshoot'] = np.maximum(state['overshoot'], -state['sign'] * error / state['scale'])
+        if k >= state['steady_start']:
+            state['steady'] += np.abs(error) / state['scale']
+            state['steady_count'] += 1
+
+    @staticmethod
+    def _close_segment(state, timestamps, end, conv_sum, conv_count, unconverged, overshoot_sum, steady_sum):
+        last_outside = state['last_outside']
+        converged = last_outside < end - 1
+        # Converged at the first sample after the last one outside the band
+        entered = np.minimum(last_outside + 1, end - 1)
+        conv_time = timestamps[entered] - timestamps[state['start']]
+        conv_sum += np.where(converged, conv_time, 0.0)
+        conv_count += converged
+        unconverged += ~converged
+        overshoot_sum += state['overshoot']
+        steady_sum += state['steady'] / max(1, state['steady_count'])
+
+
+def verify(trace: CfTrace, configs, samples: int = 5) -> bool:
+    """Compare batch engine against CfController for a few configurations."""
+    simulator = CfBatchSimulator(trace)
+    ok = True
+    step = max(1, len(configs) // samples)
+    for config in configs[::step][:samples]:
+        expected = simulate_reference(trace, config)
+        actual = simulator.outputs([config])[:, 0, :]
+        mismatches = np.count_nonzero(np.any(expected != actual, axis=1))
+        if mismatches:
+            _LOGGER.warning("Batch engine differs from CfController in %d steps for %s", mismatches, config)
+            ok = False
+    return ok
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Sweep CF module parameters over a recorded trace.")
+    parser.add_argument('trace', nargs='?', help="csv file with time, speed, supply and extract columns")
+    parser.add_argument('--synthetic', action='store_true', help="use step changes with dirty filters instead of a trace")
+    parser.add_argument('--params-max', type=float, nargs='+', required=True)
+    parser.add_argument('--params-length', type=int, nargs='+', default=[CfController.CF_PARAMS_LENGTH])
+    parser.add_argument('--correction-length', type=int, nargs='+', default=[CfController.CF_CORRECTION_LENGTH])
+    parser.add_argument('--correction-limit', type=float, nargs='+', default=[CfController.CF_CORRECTION_LIMIT])
+    parser.add_argument('--tolerance', type=float, default=0.05, help="relative pressure band counted as converged")
+    parser.add_argument('--verify', action='store_true', help="check batch engine against CfController first")
+    parser.add_argument('--compare', nargs='+', choices=sorted(CF_ENGINES),
+                        help="compare CF engines with their default tuning instead of the sweep")
+    parser.add_argument('--output', help="write all results to this csv file")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.synthetic:
+        trace = synthetic_trace(args.params_max[0])
+    elif args.trace:
+        trace = CfTrace.load_csv(args.trace)
+    else:
+        parser.error("trace or --synthetic is required")
+
+    if args.compare:
+        for params_max in args.params_max:
+            for result in compare_engines(trace, params_max, args.compare, args.tolerance):
+                print("%s params max %.0f conv %.1fs unconverged %d overshoot %.3f steady %.3f" % (
+                    result.config, params_max, result.convergence_time, result.unconverged,
+                    result.overshoot, result.steady_state_error))
+        return 0
+
+    configs = make_grid(args.params_max, args.params_length, args.correction_length, args.correction_limit)
+
+    if args.verify and not verify(trace, configs):
+        return 1
+
+    started = time.perf_counter()
+    results = CfBatchSimulator(trace, tolerance=args.tolerance).run(configs)
+    _LOGGER.info("Evaluated %d configurations over %d samples in %.2f s", len(configs), len(trace), time.perf_counter() - started)
+
+    results.sort(key=lambda r: (r.unconverged, r.steady_state_error, r.convergence_time))
+    if args.output:
+        with open(args.output, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(CfTuningConfig._fields + CfTuningResult._fields[1:])
+            for result in results:
+                writer.writerow(tuple(result.config) + tuple(result[1:]))
+
+    for result in results[:args.top]:
+        print("%s conv %.1fs unconverged %d overshoot %.3f steady %.3f" % (
+            result.config, result.convergence_time, result.unconverged, result.overshoot, result.steady_state_error))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
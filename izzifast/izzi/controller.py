@@ -1,667 +1,1045 @@
-#!/usr/bin/env python
-
-import binascii
-import socket 
-import struct
-import time
-import datetime
-import sys
-import select
-import logging
-import threading
-import serial
-from numpy import median
-from numpy import mean
-from array import array
-from collections import deque
-from .const import *
-from . import *
-
-_LOGGER = logging.getLogger('izzicontroller')
-
-#values = array('B', [0x64, 0x19, 0x00, 0x14, 0x00, 0x16, 0x05, 0x00, 0x17, 0x02, 0x28, 0x28, 0x00, 0x00, 0x00])
-
-
-#socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-#socket.connect((TCP_IP, TCP_PORT))
-#socket.setblocking(0)
-
-#class IzziEthbrindge
-#    connect()
-#    disconnect()    
-#    read_message()
-#    write_message()
-class IzziBridge(object):
-    def connect(self) -> bool:
-        """Open connection to the bridge."""
-        pass
-    def disconnect(self) -> bool:
-        """Close connection to the bridge."""
-        pass
-    def is_connected(self):
-        """Returns weather there is an open socket."""
-        pass
-
-    def read_message(self, timeout=3) -> b'':
-        """Read a message from the connection."""
-        pass
-        
-    def write_message(self, message: b'') -> bool:
-        """Write a message to the connection."""
-        pass
-
-class IzziSerialBridge(IzziBridge):
-    """Implements an interface to send and receive messages from the Bridge."""
-
-    STATUS_MESSAGE_LENGTH = 15
-
-    def __init__(self, usbname: str) -> None:
-        self.usbname = usbname
-
-        self._serialport = None
-        self.debug = False
-
-    def connect(self) -> bool:
-        """Open connection to the bridge."""
-
-        if self._serialport is None:
-            self._serialport = serial.Serial(self.usbname, 9600, timeout=0, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
-            # Clear buffered data
-            while True:
-                ready = select.select([self._serialport], [], [], 0.1)
-                if not ready[0]:
-                    break
-                self._serialport.read(1024)
-
-        return True
-
-    def disconnect(self) -> bool:
-        """Close connection to the bridge."""
-
-        self._serialport.close()
-        self._serialport = None
-
-        return True
-
-    def is_connected(self):
-        """Returns weather there is an open port."""
-        
-        return self._serialport is not None
-
-    def read_message(self, timeout=3.0) -> b'':
-        """Read a message from the connection."""
-
-        if self._serialport is None:
-            raise Exception('Broken pipe')
-
-        message = b''
-        remaining = self.STATUS_MESSAGE_LENGTH
-        message_valid = False
-        while remaining > 0:
-            ready = select.select([self._serialport], [], [], timeout)
-            if not ready[0]:
-                message = None
-                break
-            if not message_valid:
-                data = self._serialport.read(1)
-                if struct.unpack_from('>B', data, 0)[0] != IZZI_STATUS_MESSAGE_ID:
-                    continue
-                message_valid = True
-            else:
-                data = self._serialport.read(remaining)
-            remaining -= len(data)
-            message += (data)
-        
-        # Debug message
-        
-        if message != None:
-            _LOGGER.debug("RX %s", binascii.hexlify(message))
-        return message
-
-    def write_message(self, message: b'') -> bool:
-        """Send a message."""
-
-        if self._serialport is None:
-            raise Exception('Not connected!')
-
-        # Debug message
-        #_LOGGER.debug("TX %s", "".join( str(x) for x in message))
-        _LOGGER.debug("TX %s", str(binascii.hexlify(message)))
-        # Send packet
-        try:
-            self._serialport.write(message)
-        except Exception:
-            return False
-        return True
-
-class IzziEthBridge(IzziBridge):
-    """Implements an interface to send and receive messages from the Bridge."""
-
-    STATUS_MESSAGE_LENGTH = 15
-
-    def __init__(self, host: str, port: int) -> None:
-        self.host = host
-        self.port = port
-
-        self._socket = None
-        self._dummysocket = None
-        self.debug = False
-
-    def connect(self) -> bool:
-        """Open connection to the bridge."""
-
-        if self._socket is None:
-            tcpsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tcpsocket.connect((self.host, self.port))
-            tcpsocket.setblocking(0)
-            self._socket = tcpsocket
-            # Clear buffered data
-            while True:
-                ready = select.select([self._socket], [], [], 0.01)
-                if not ready[0]:
-                    break
-                self._socket.recv(1024)
-
-        return True
-
-    def disconnect(self) -> bool:
-        """Close connection to the bridge."""
-        if self._socket != None:
-            self._socket.close()
-        self._socket = None
-
-        return True
-
-    def is_connected(self):
-        """Returns weather there is an open socket."""
-        
-        return self._socket is not None
-
-    def read_message(self, timeout=3.0) -> b'':
-        """Read a message from the connection."""
-
-        if self._socket is None:
-            raise Exception('Broken pipe')
-
-        message = b''
-        remaining = self.STATUS_MESSAGE_LENGTH
-        message_valid = False
-        while remaining > 0:
-            #_LOGGER.debug("Read select")
-            ready = select.select([self._socket], [], [], timeout)
-            if not ready[0]:
-                message = None
-                #_LOGGER.debug("Select timeout")
-                break
-            if not message_valid:
-                #_LOGGER.debug("Read recv(1)")
-                data = self._socket.recv(1)
-                if struct.unpack_from('>B', data, 0)[0] != IZZI_STATUS_MESSAGE_ID and struct.unpack_from('>B', data, 0)[0] != IZZI_COMMAND_MESSAGE_ID:
-                    _LOGGER.debug("Read invalid msg id")
-                    continue
-                message_valid = True
-            else:
-                #_LOGGER.debug("Read recv(%d)", remaining)
-                data = self._socket.recv(remaining)
-                #_LOGGER.debug("Data %s", binascii.hexlify(data))
-            remaining -= len(data)
-            message += (data)
-        
-        # Debug message
-        
-        #if message != None:
-        #    _LOGGER.debug("RX %s", binascii.hexlify(message))
-        return message
-
-    def write_message(self, message: b'') -> bool:
-        """Send a message."""
-
-        if self._socket is None:
-            raise Exception('Not connected!')
-
-        # Debug message
-        #_LOGGER.debug("TX %s", "".join( str(x) for x in message))
-        #_LOGGER.debug("TX %s", str(binascii.hexlify(message)))
-        # Send packet
-        try:
-            self._socket.sendall(message)
-        except Exception:
-            return False
-        return True
-
-class CfController(object):
-
-    # exp. press = 0,014*(perc*perc)-0,18*perc
-
-    CF_PARAMS_LENGTH = 5
-    
-    CF_CORRECTION_LENGTH = 5
-    
-    _module_enabled = False
-    _params_supply = deque([], CF_PARAMS_LENGTH)
-    _params_extract = deque([], CF_PARAMS_LENGTH)
-    
-    _corrections_supply = deque([], CF_CORRECTION_LENGTH)
-    _corrections_extract = deque([], CF_CORRECTION_LENGTH)
-
-    _params_max = 0.0
-    
-    _supply_speed = 0.0
-    _supply_speed_correction = 0.0
-    _supply_base_correction = 0
-    _extract_speed = 0.0
-    _extract_speed_correction = 0.0
-    _extract_base_correction = 0
-    
-    _supply_exp_param = 0.0
-    _extract_exp_param = 0.0
-    
-    
-    def __init__(self):
-        self._module_enabled = False
-    
-    def set_enabled(self, enabled : bool):
-        self._module_enabled = enabled
-        
-    def set_params_max(self, params_max : float):
-        self._params_max = params_max
-        _LOGGER.debug("CF params max %f", self._params_max)
-    
-    def set_current_params(self, supply : float, extract : float):
-        self._params_supply.append(supply)
-        self._params_extract.append(extract)
-   
-    def get_supply_speed(self, exp_speed : int) -> int:
-        if int(self._supply_speed) != exp_speed :
-            self._supply_speed = float(exp_speed)
-            supply_norm = self._supply_speed / 100.0
-            self._supply_exp_param = max(0.0, self._params_max* (supply_norm*supply_norm*supply_norm) + 40.0 * supply_norm - 6.0)
-            self._params_supply.clear()
-            #self._supply_base_correction = 0
-            self._corrections_supply.clear()
-        
-            _LOGGER.debug("Expected Supply CF params %f", self._supply_exp_param)
-            
-        target_val = self._supply_speed
-        correction_limit = int(target_val / 4)
-        if self._module_enabled :
-        
-            if len(self._params_supply) >= self.CF_PARAMS_LENGTH-1 :
-                
-                supply_param_avg = mean(self._params_supply)
-        
-                paramDiff = supply_param_avg - self._supply_exp_param
-                
-                # convert difference to percent and change sign
-                diffPerc = (paramDiff / self._params_max) * -100.0
-                # If speed higher allow bigger differences
-                supply_norm = self._supply_speed / 100.0
-                diffPerc = diffPerc * (0.4 * (1.0 - (supply_norm*supply_norm*supply_norm)) + 0.6)
-                
-                if abs(int(diffPerc)) > correction_limit :
-                    diffPerc = (abs(diffPerc) / diffPerc) * correction_limit
-                    
-                self._supply_speed_correction = int(diffPerc)
-
-                #
-                self._corrections_supply.append(self._supply_speed_correction)
-                if len(self._corrections_supply) >= self.CF_CORRECTION_LENGTH :
-                    supply_correction_avg = mean(self._corrections_supply)
-                    if abs(supply_correction_avg) > 1 :
-                        self._supply_base_correction += abs(supply_correction_avg) / supply_correction_avg
-                        if abs(self._supply_base_correction) > correction_limit :
-                            self._supply_base_correction = correction_limit * abs(self._supply_base_correction) / self._supply_base_correction
-                    self._corrections_supply.clear()
-                    
-                _LOGGER.debug("CF Supply diff %f, correction %d, avg %f, base %d", paramDiff, self._supply_speed_correction, supply_param_avg, self._supply_base_correction)
-                
-            target_val += self._supply_speed_correction + self._supply_base_correction
-            if target_val > 100 :
-                target_val = 100
-            elif target_val < self._supply_speed/2 :
-                target_val = self._supply_speed/2
-        return int(target_val)
-    
-    def get_extract_speed(self, exp_speed : int) -> int:
-        if int(self._extract_speed) != exp_speed :
-            self._extract_speed = float(exp_speed)
-            extract_norm = self._extract_speed / 100.0
-            self._extract_exp_param = max(0.0, self._params_max* (extract_norm*extract_norm*extract_norm) + 40.0 * extract_norm - 6.0)
-            self._params_extract.clear()
-            #self._extract_base_correction = 0
-            self._corrections_extract.clear()
-        
-            _LOGGER.debug("Expected Extract CF params %f", self._extract_exp_param)
-        
-        target_val = self._extract_speed
-        correction_limit = int(target_val / 4)
-        if self._module_enabled :
-                
-            if len(self._params_extract) >= self.CF_PARAMS_LENGTH-1 :
-                
-                extract_param_avg = mean(self._params_extract)
-                
-                paramDiff = extract_param_avg - self._extract_exp_param
-                # convert difference to percent and change sign
-                diffPerc = (paramDiff / self._params_max) * -100.0
-                # If speed higher allow bigger differences
-                extract_norm = self._extract_speed / 100.0
-                diffPerc = diffPerc * (0.4 * (1.0 - (extract_norm*extract_norm*extract_norm)) + 0.6)
-                
-                if abs(int(diffPerc)) > correction_limit :
-                    diffPerc = (abs(diffPerc) / diffPerc) * correction_limit
-                    
-                self._extract_speed_correction = int(diffPerc)
-
-                #
-                self._corrections_extract.append(self._extract_speed_correction)
-                if len(self._corrections_extract) >= self.CF_CORRECTION_LENGTH :
-                    extract_correction_avg = mean(self._corrections_extract)
-                    if abs(extract_correction_avg) > 1 :
-                        self._extract_base_correction += abs(extract_correction_avg) / extract_correction_avg
-                        if abs(self._extract_base_correction) > correction_limit :
-                            self._extract_base_correction = correction_limit * abs(self._extract_base_correction) / self._extract_base_correction
-                    self._corrections_extract.clear()
-                    
-                _LOGGER.debug("CF Extract diff %f, correction %d avg %f, base %d", paramDiff, self._extract_speed_correction, extract_param_avg, self._extract_base_correction)
-                
-            target_val += self._extract_speed_correction + self._extract_base_correction
-            if target_val > 100 :
-                target_val = 100
-            elif target_val < self._extract_speed/2 :
-                target_val = self._extract_speed/2
-        return int(target_val)
-    
-    def is_enabled(self) -> bool:
-        return self._module_enabled
-    
-    def get_extract_correction(self) -> int:
-        return int(self._extract_base_correction)
-    
-    def get_supply_correction(self) -> int:
-        return int(self._supply_base_correction)
-        
-
-class IzziController(object):
-
-    
-    """Implements the commands to communicate with the IZZI 300 ERV ventilation unit."""
-                    # Id of sensor,                      Value,    Index in status message array. Unpack type
-    _sensors_data = {IZZY_SENSOR_TEMPERATURE_SUPPLY_ID: [None, IZZI_STATUS_MSG_SUPPLY_AIR_TEMP_INDEX, '>b'],
-                     IZZY_SENSOR_TEMPERATURE_EXTRACT_ID: [None, IZZI_STATUS_MSG_EXTRACT_AIR_TEMP_INDEX, '>b'],
-                     IZZY_SENSOR_TEMPERATURE_EXHAUST_ID: [None, IZZI_STATUS_MSG_EXHAUST_AIR_TEMP_INDEX, '>b'],
-                     IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID: [None, IZZI_STATUS_MSG_OUTDOR_AIR_TEMP_INDEX, '>b'],
-                     IZZY_SENSOR_BYPASS_STATE_ID: [None, IZZI_STATUS_MSG_BYPASS_STATE_INDEX, '>B'],
-                     IZZY_SENSOR_COVER_STATE_ID: [None, IZZI_STATUS_MSG_COVER_STATE_INDEX, '>B'],
-                     IZZY_SENSOR_DEFROST_STATE_ID: [None, IZZI_STATUS_MSG_DEFROST_STATE_INDEX, '>B'],
-                    }
-
-                    # Id of sensor,               Target value,    Index in command array, multiplier
-    _cmd_data = {IZZY_SENSOR_FAN_SUPPLY_SPEED_ID: [0, IZZI_CMD_MSG_SUPPLY_FAN_SPEED_INDEX, None],
-                 IZZY_SENSOR_FAN_EXTRACT_SPEED_ID: [0, IZZI_CMD_MSG_EXTRACT_FAN_SPEED_INDEX, None],
-                 IZZY_SENSOR_UNIT_STATE_ID: [IZZY_CMD_UNIT_STATE_OFF, IZZI_CMD_MSG_UNIT_STATE_INDEX, None],
-                 IZZY_SENSOR_BYPASS_TEMP_ID: [22, IZZI_CMD_MSG_BYPASS_TEMP_INDEX, None],
-                 IZZY_SENSOR_BYPASS_MODE_ID: [IZZY_CMD_BYPASS_MODE_AUTO, IZZI_CMD_MSG_BYPASS_MODE_INDEX, None]}
-
-                    # Id of sensor,           Target Value, Current value    
-    _virtual_data = {IZZY_SENSOR_VENT_MODE_ID: [IZZY_SENSOR_VENT_MODE_NONE, None],
-                     IZZY_SENSOR_EFFICIENCY_ID: [0, None],
-                     IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID: [0, 0],
-                     IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID: [0, 0]}
-
-    """Callback function to invoke when sensor updates are received."""
-    callback_sensor = None
-    
-    cf_controller = CfController()
-    extract_correction = 0.0
-    
-    _command_message = array('B', [IZZI_COMMAND_MESSAGE_ID, 0x19, 0x00, 0x14, 0x00, 0x16, 0x05, 0x00, 0x17, IZZY_CMD_BYPASS_MODE_CLOSED, 0x28, 0x28, IZZY_CMD_UNIT_STATE_OFF, 0x00, 0x00])
-
-    def __init__(self, bridge: IzziBridge, is_master : bool):
-
-        self._bridge = bridge
-        self._stopping = False
-        self._connection_thread = None
-        self._master_mode = is_master
-
-    def connect(self):
-        """Connect to the bridge. Disconnect existing clients if needed by default."""
-
-        _LOGGER.info("IzziController connect")
-        try:
-            # Start connection thread
-            self._connection_thread = threading.Thread(target=self._connection_thread_loop)
-            self._connection_thread.start()
-        except Exception as exc:
-            _LOGGER.error(exc)
-            raise Exception('Could start task.')
-
-    def disconnect(self):
-        """Disconnect from the bridge."""
-    
-        _LOGGER.info("IzziController disconnect")
-    
-        # Set the stopping flag
-        self._stopping = True
-
-        # Wait for the background thread to finish
-        self._connection_thread.join()
-        self._connection_thread = None
-
-    def is_connected(self):
-        """Returns whether there is a connection with the bridge."""
-
-        return self._bridge.is_connected()
-
-    def get_master_mode() -> bool:
-        return self._master_mode
-        
-    def force_update(self, sensor_id):
-        """Make sure state of sensor will be published."""
-        sensor_obj = self._sensors_data.get(sensor_id)
-        if sensor_obj != None:
-            sensor_obj[0] = None
-        sensor_obj = self._cmd_data.get(sensor_id)
-        if sensor_obj != None:
-            sensor_obj[0] = None
-        sensor_obj = self._virtual_data.get(sensor_id)
-        if sensor_obj != None:
-            sensor_obj[1] = None
-    
-    def set_bypass_mode(self, mode : int) -> bool:
-        if mode < 0 or mode > 2:
-            return False
-        self._cmd_data[IZZY_SENSOR_BYPASS_MODE_ID][0] = mode
-        return True
-        
-    def get_bypass_mode(self) -> int:
-        return self._cmd_data[IZZY_SENSOR_BYPASS_MODE_ID][0];
-        
-    def set_bypass_temp(self, temp : int) -> bool:
-        if temp < 18 or temp > 26:
-            return False
-        self._cmd_data[IZZY_SENSOR_BYPASS_TEMP_ID][0] = temp
-        return True
-        
-    def set_fan_speed(self, supply : int, extract : int) :
-        if (supply < 0 and extract < 0) or supply > 100 or extract > 100:
-            return False
-        
-        self._cmd_data[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID][0] = supply
-        self._cmd_data[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID][0] = extract
-        
-        return True
-
-    def get_supply_speed():
-        return self._cmd_data[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID][0]
-        
-    def get_extract_speed():
-        return self._cmd_data[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID][0]
-    
-    
-    def set_vent_mode(self, mode : int) -> bool:
-        if mode < IZZY_SENSOR_VENT_MODE_NONE or mode > IZZY_SENSOR_VENT_MODE_COOKER_HOOD:
-            return False
-        if mode == IZZY_SENSOR_VENT_MODE_NONE:
-            self._cmd_data[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID][2] = None
-            self._cmd_data[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID][2] = None
-        elif mode == IZZY_SENSOR_VENT_MODE_FIREPLACE:
-            self._cmd_data[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID][2] = None
-            self._cmd_data[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID][2] = 0.8
-        elif mode == IZZY_SENSOR_VENT_MODE_OPEN_WINDOW:
-            self._cmd_data[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID][2] = 0
-            self._cmd_data[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID][2] = None
-        elif mode == IZZY_SENSOR_VENT_MODE_COOKER_HOOD:
-            self._cmd_data[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID][2] = None
-            self._cmd_data[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID][2] = 0.3
-        
-        self._virtual_data[IZZY_SENSOR_VENT_MODE_ID][0] = mode
-        return True
-        
-    def set_cf_params_max(self, params_max : float) -> bool:
-        self.cf_controller.set_params_max(params_max)
-        self.cf_controller.set_enabled(True)
-        return True
-    
-    def set_cf_params(self, supply : float, extract : float) -> bool:
-        self.cf_controller.set_current_params(supply, extract)
-        return True
-        
-    def is_cf_enabled(self) -> bool:
-        return self.cf_controller.is_enabled()
-        
-    def set_unit_on(self, on : bool) :
-        if on:
-            self._cmd_data[IZZY_SENSOR_UNIT_STATE_ID][0] = IZZY_CMD_UNIT_STATE_ON
-        else:
-            self._cmd_data[IZZY_SENSOR_UNIT_STATE_ID][0] = IZZY_CMD_UNIT_STATE_OFF
-        return True
-        
-    def _connection_thread_loop(self):
-        self._stopping = False
-        stat_msg_counter = 0
-        last_cmd_timestamp = time.time()
-            
-        while not self._stopping:
-        
-            # Start connection
-            if not self.is_connected():
-
-                try:
-                    _LOGGER.info("Trying connect to bridge")
-                    # Connect or re-connect
-                    if not self._bridge.connect():
-                        time.sleep(5)
-                        continue
-                        
-                    _LOGGER.info("Connection established")
-                except Exception as exc:
-                    _LOGGER.error(exc)
-                    time.sleep(5)
-                    continue;
-            
-            try:
-                
-                #_LOGGER.debug("Reading message")
-                status_message = self._bridge.read_message()
-                if status_message == None:
-                    self._bridge.disconnect()
-                    _LOGGER.error("Can't read message, disconnecting")
-                    continue
-                
-                command_id = struct.unpack_from('>B', status_message, IZZI_STATUS_MSG_ID_INDEX)[0]
-                if (command_id == IZZI_STATUS_MESSAGE_ID):
-                    stat_msg_counter += 1
-                    #_LOGGER.debug(status_message)
-                    
-                    timediff = time.time() - last_cmd_timestamp
-                    last_cmd_timestamp = time.time()
-                    
-                    #_LOGGER.debug("Since last cmd %f", timediff)
-                    
-                    for sensor_id in self._sensors_data:
-                        sensor_data = self._sensors_data[sensor_id];
-                        sensor_current = struct.unpack_from(sensor_data[2], status_message, sensor_data[1])[0] 
-                       
-                        if sensor_data[0] != sensor_current:
-                            sensor_data[0] = sensor_current
-                            if self.callback_sensor:
-                                self.callback_sensor(sensor_id, sensor_data[0])
-                    
-                    #Calculate efficiency
-                    try:
-                        t1 = float(self._sensors_data[IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID][0])
-                        t2 = float(self._sensors_data[IZZY_SENSOR_TEMPERATURE_SUPPLY_ID][0])
-                        t3 = float(self._sensors_data[IZZY_SENSOR_TEMPERATURE_EXTRACT_ID][0])
-                        
-                        if t3 != t1:
-                            efficiency = ((t2 - t1) / (t3 - t1)) * 100.0
-                            self._virtual_data[IZZY_SENSOR_EFFICIENCY_ID][0] = round(efficiency)
-                        else:
-                            self._virtual_data[IZZY_SENSOR_EFFICIENCY_ID][0] = 100
-                                
-                    except Exception as exc:
-                        self._virtual_data[IZZY_SENSOR_EFFICIENCY_ID][0] = None
-                        _LOGGER.error(exc)
-                
-                elif not self._master_mode and command_id == IZZI_COMMAND_MESSAGE_ID:
-                    for sensor_id in self._cmd_data:
-                        sensor_data = self._cmd_data[sensor_id]
-                        sensor_data[0] = status_message[sensor_data[1]]
-                    _LOGGER.debug("CMD RX %s", str(binascii.hexlify(status_message)))
-                    
-                for sensor_id in self._cmd_data:
-                    sensor_data = self._cmd_data[sensor_id]
-                    sensor_current = self._command_message[sensor_data[1]]
-                    if sensor_data[0] is None:
-                        sensor_data[0] = sensor_current
-                        if self.callback_sensor:
-                            self.callback_sensor(sensor_id, sensor_data[0])
-                    
-                        # Make sure we use up to date data
-                    if sensor_data[2] is not None:
-                        exp_sensor_val = int(float(sensor_data[0]) * sensor_data[2])
-                    else:
-                        exp_sensor_val = sensor_data[0]
-                    
-                    if self._cmd_data[IZZY_SENSOR_UNIT_STATE_ID][0] == IZZY_CMD_UNIT_STATE_ON and self._sensors_data[IZZY_SENSOR_COVER_STATE_ID][0] == 0:
-                        if sensor_id == IZZY_SENSOR_FAN_SUPPLY_SPEED_ID:
-                            exp_sensor_val = self.cf_controller.get_supply_speed(exp_sensor_val)
-                            if exp_sensor_val < 15:
-                                exp_sensor_val = 15
-                        elif sensor_id == IZZY_SENSOR_FAN_EXTRACT_SPEED_ID:
-                            exp_sensor_val = self.cf_controller.get_extract_speed(exp_sensor_val)
-                            if exp_sensor_val < 15:
-                                exp_sensor_val = 15
-                        
-                    if exp_sensor_val != sensor_current:
-                        self._command_message[sensor_data[1]] = exp_sensor_val
-                        if self.callback_sensor:
-                            self.callback_sensor(sensor_id, self._command_message[sensor_data[1]])
-                
-                if self.cf_controller.is_enabled(): 
-                    self._virtual_data[IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID][0] = self.cf_controller.get_extract_correction()
-                    self._virtual_data[IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID][0] = self.cf_controller.get_supply_correction()
-                    
-                for sensor_id in self._virtual_data:
-                    sensor_data = self._virtual_data[sensor_id]
-                    if sensor_data[1] is None or sensor_data[0] != sensor_data[1]:
-                        sensor_data[1] = sensor_data[0]
-                        if self.callback_sensor:
-                            self.callback_sensor(sensor_id, sensor_data[0])
-                 
-                if stat_msg_counter >= 2:
-                    stat_msg_counter = 0
-                    if self._master_mode:
-                        #_LOGGER.debug("Writting msg %s", str(self._command_message))
-                        time.sleep(0.2)
-                        self._bridge.write_message(self._command_message)
-
-            except Exception as exc:
-                _LOGGER.error(exc)
-                continue
-          
-        try:
-            self._bridge.disconnect()
-        except Exception as exc:
-            _LOGGER.error(exc)
+#!/usr/bin/env python
+
+import asyncio
+import binascii
+import os
+import struct
+import time
+import datetime
+import sys
+import logging
+import operator
+import random
+import socket
+from array import array
+from collections import deque
+from .const import *
+from .cf import CfCurve, create_cf_engine
+from .calibration import CfCalibration
+from .mailbox import IzziCommandMailbox
+from .schedule import IzziScheduler
+from .protocol import IzziFrameDecoder, IzziStatusDecoder, IZZI_MESSAGE_LENGTH
+from .registers import IzziRegisterStore, RegisterSnapshot, IZZI_REGISTER_COUNT
+from .bus import IzziBusScheduler
+from .metrics import IzziMetrics
+from .derived import DerivedSensor, IzziDerivedEngine, izzi_derived_sensors
+from .history import IzziHistory, DEFAULT_HISTORY_WINDOW
+from .publish import IzziPublisher, PublishPolicy
+from . import *
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+#values = array('B', [0x64, 0x19, 0x00, 0x14, 0x00, 0x16, 0x05, 0x00, 0x17, 0x02, 0x28, 0x28, 0x00, 0x00, 0x00])
+
+
+#class IzziEthbrindge
+#    connect()
+#    disconnect()    
+#    read_message()
+#    write_message()
+class IzziBridge(object):
+
+    # Line speed between the adapter and the unit
+    baudrate = 9600
+
+    async def connect(self) -> bool:
+        """Open connection to the bridge."""
+        pass
+    def disconnect(self) -> bool:
+        """Close connection to the bridge."""
+        pass
+    def is_connected(self):
+        """Returns weather there is an open socket."""
+        pass
+
+    async def read_message(self, timeout=3) -> b'':
+        """Read a message from the connection."""
+        pass
+        
+    def write_message(self, message: b'') -> bool:
+        """Write a message to the connection."""
+        pass
+
+class IzziStreamBridge(IzziBridge):
+    """Common frame handling for bridges driven by the asyncio event loop.
+
+    Received bytes are pushed by the transport into a shared frame decoder
+    and complete frames are queued until read_message() picks them up, so no
+    thread ever blocks on the port.
+    """
+
+    STATUS_MESSAGE_LENGTH = IZZI_MESSAGE_LENGTH
+    
+    MAX_PENDING_MESSAGES = 16
+
+    def __init__(self) -> None:
+        self._loop = None
+        self._decoder = IzziFrameDecoder()
+        self._messages = deque([], self.MAX_PENDING_MESSAGES)
+        self._waiter = None
+
+    @property
+    def skipped_bytes(self) -> int:
+        """Returns number of garbage bytes skipped while resynchronising."""
+        return self._decoder.skipped
+
+    def _reset_rx(self):
+        self._decoder.reset()
+        self._messages.clear()
+
+    def _get_buffer(self) -> memoryview:
+        return self._decoder.get_buffer()
+
+    def _buffer_updated(self, nbytes):
+        """Queue every complete message received so far."""
+
+        self._decoder.buffer_updated(nbytes)
+        for frame in self._decoder.frames():
+            self._messages.append(bytes(frame))
+        
+        if self._messages:
+            self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def read_message(self, timeout=3.0) -> b'':
+        """Read a message from the connection."""
+
+        if not self.is_connected():
+            raise Exception('Broken pipe')
+
+        if not self._messages:
+            self._waiter = self._loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._waiter = None
+            
+            # Woken up without data, connection was lost
+            if not self._messages:
+                raise Exception('Broken pipe')
+
+        return self._messages.popleft()
+
+class IzziStreamProtocol(asyncio.BufferedProtocol):
+    """Lets the transport receive straight into the bridge decoder buffer."""
+
+    def __init__(self, bridge: IzziStreamBridge) -> None:
+        self._bridge = bridge
+
+    def get_buffer(self, sizehint):
+        return self._bridge._get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self._bridge._buffer_updated(nbytes)
+
+    def connection_lost(self, exc):
+        self._bridge._connection_lost(self, exc)
+
+class IzziSerialBridge(IzziStreamBridge):
+    """Implements an interface to send and receive messages from the Bridge.
+
+    The tty is set to report readable only once min_read bytes are waiting
+    (VMIN with VTIME 0), so a frame costs one wakeup and one read however
+    the adapter splits it. Reads are non-blocking and take everything there
+    is. Works the same on a pty, used by the emulator.
+    """
+
+    DEFAULT_BAUDRATE = 9600
+
+    def __init__(self, usbname: str, baudrate: int = DEFAULT_BAUDRATE, low_latency: bool = True,
+                 min_read: int = IZZI_MESSAGE_LENGTH) -> None:
+        super().__init__()
+        self.usbname = usbname
+        self.baudrate = baudrate
+        self.low_latency = low_latency
+        self.min_read = min_read
+        # Times the port woke the event loop up
+        self.rx_wakeups = 0
+
+        self._serialport = None
+        self.debug = False
+
+    async def connect(self) -> bool:
+        """Open connection to the bridge."""
+
+        if self._serialport is None:
+            self._loop = asyncio.get_running_loop()
+            # Importing pyserial and opening the port block, keep them off the event loop
+            serialport = await self._loop.run_in_executor(None, self._open)
+            self._serialport = serialport
+            self._reset_rx()
+            self._loop.add_reader(self._serialport.fileno(), self._read_ready)
+
+        return True
+
+    def _open(self):
+        import serial
+
+        serialport = serial.Serial(self.usbname, self.baudrate, timeout=0, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS)
+        if self.low_latency:
+            # USB adapters hold received bytes up to 16 ms otherwise
+            try:
+                serialport.set_low_latency_mode(True)
+            except (AttributeError, NotImplementedError, OSError, ValueError) as exc:
+                _LOGGER.debug("No low latency mode on %s: %s", self.usbname, exc)
+        set_min_read(serialport.fileno(), self.min_read)
+        # Clear buffered data
+        serialport.reset_input_buffer()
+        return serialport
+
+    def disconnect(self) -> bool:
+        """Close connection to the bridge."""
+
+        if self._serialport is not None:
+            self._loop.remove_reader(self._serialport.fileno())
+            self._serialport.close()
+        self._serialport = None
+        self._wakeup()
+
+        return True
+
+    def is_connected(self):
+        """Returns weather there is an open port."""
+        
+        return self._serialport is not None
+
+    def _read_ready(self):
+        self.rx_wakeups += 1
+        try:
+            nbytes = os.readv(self._serialport.fileno(), [self._get_buffer()])
+        except BlockingIOError:
+            return
+        except Exception as exc:
+            _LOGGER.error(exc)
+            self.disconnect()
+            return
+        if nbytes == 0:
+            _LOGGER.error("Serial port reports readiness to read but returned no data")
+            self.disconnect()
+            return
+        self._buffer_updated(nbytes)
+
+    def write_message(self, message: b'') -> bool:
+        """Send a message."""
+
+        if self._serialport is None:
+            raise Exception('Not connected!')
+
+        # Debug message
+        #_LOGGER.debug("TX %s", "".join( str(x) for x in message))
+        _LOGGER.debug("TX %s", str(binascii.hexlify(message)))
+        # Send packet
+        try:
+            self._serialport.write(message)
+        except Exception:
+            return False
+        return True
+
+def set_min_read(fd: int, count: int) -> bool:
+    """Make tty fd poll readable only with count bytes waiting, returns whether it could."""
+    try:
+        import termios
+    except ImportError:
+        return False
+    attrs = termios.tcgetattr(fd)
+    attrs[6][termios.VMIN] = count
+    attrs[6][termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    return True
+
+class IzziEthBridge(IzziStreamBridge):
+    """Implements an interface to send and receive messages from the Bridge."""
+
+    CONNECT_TIMEOUT = 2.0
+    
+    # Dead peer is detected after idle + interval * count seconds
+    KEEPALIVE_IDLE = 2
+    KEEPALIVE_INTERVAL = 1
+    KEEPALIVE_COUNT = 3
+
+    def __init__(self, host: str, port: int, connect_timeout: float = CONNECT_TIMEOUT) -> None:
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+
+        self._transport = None
+        self._protocol = None
+        self.debug = False
+
+    async def connect(self) -> bool:
+        """Open connection to the bridge."""
+
+        if self._transport is None:
+            self._loop = asyncio.get_running_loop()
+            try:
+                transport, protocol = await asyncio.wait_for(self._create_connection(), self.connect_timeout)
+            except asyncio.TimeoutError:
+                raise Exception('Connect to %s timed out' % self._address())
+            self._tune_socket(transport.get_extra_info('socket'))
+            self._transport = transport
+            self._protocol = protocol
+            # Clear buffered data
+            await asyncio.sleep(0.01)
+            self._reset_rx()
+
+        return True
+
+    def _create_connection(self):
+        return self._loop.create_connection(lambda: IzziStreamProtocol(self), self.host, self.port)
+
+    def _address(self) -> str:
+        return '%s:%d' % (self.host, self.port)
+
+    def _tune_socket(self, sock):
+        """Let the kernel detect half-open sessions within a few seconds."""
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.KEEPALIVE_IDLE)
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.KEEPALIVE_INTERVAL)
+            if hasattr(socket, 'TCP_KEEPCNT'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.KEEPALIVE_COUNT)
+            if hasattr(socket, 'TCP_USER_TIMEOUT'):
+                # Unacknowledged writes fail after the same time [ms]
+                timeout = (self.KEEPALIVE_IDLE + self.KEEPALIVE_INTERVAL * self.KEEPALIVE_COUNT) * 1000
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, timeout)
+        except OSError as exc:
+            _LOGGER.warning("Can't set TCP keepalive %s", exc)
+
+    def disconnect(self) -> bool:
+        """Close connection to the bridge."""
+        if self._transport != None:
+            self._transport.close()
+        self._transport = None
+        self._protocol = None
+        self._wakeup()
+
+        return True
+
+    def is_connected(self):
+        """Returns weather there is an open socket."""
+        
+        return self._transport is not None
+
+    def _connection_lost(self, protocol, exc):
+        # Ignore notifications for connections we already dropped
+        if protocol is not self._protocol:
+            return
+        _LOGGER.error("Connection lost %s", exc)
+        self._transport = None
+        self._protocol = None
+        self._wakeup()
+
+    def write_message(self, message: b'') -> bool:
+        """Send a message."""
+
+        if self._transport is None:
+            raise Exception('Not connected!')
+
+        # Debug message
+        #_LOGGER.debug("TX %s", "".join( str(x) for x in message))
+        #_LOGGER.debug("TX %s", str(binascii.hexlify(message)))
+        # Send packet
+        try:
+            self._transport.write(bytes(message))
+        except Exception:
+            return False
+        return True
+
+class IzziUnixBridge(IzziEthBridge):
+    """Connects to a local fan-out proxy over a Unix socket."""
+
+    def __init__(self, path: str, connect_timeout: float = IzziEthBridge.CONNECT_TIMEOUT) -> None:
+        super().__init__(None, None, connect_timeout)
+        self.path = path
+
+    def _create_connection(self):
+        return self._loop.create_unix_connection(lambda: IzziStreamProtocol(self), self.path)
+
+    def _address(self) -> str:
+        return self.path
+
+    def _tune_socket(self, sock):
+        pass
+
+class ReconnectBackoff(object):
+    """Jittered exponential delay between reconnect attempts.
+
+    The first retry comes almost at once, every further one waits about
+    twice as long up to the maximum. Half of each delay is random so units
+    behind the same access point don't retry in lockstep. Attempts start
+    over after a few status frames in a row, a link dropping after every
+    frame keeps backing off.
+    """
+
+    # Status frames in a row after which the link counts as up
+    STABLE_FRAMES = 3
+
+    def __init__(self, initial: float = 0.1, maximum: float = 10.0, factor: float = 2.0, rng=None) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self._rng = rng if rng is not None else random.Random()
+        self.attempts = 0
+        self._frames = 0
+
+    def reset(self):
+        self.attempts = 0
+        self._frames = 0
+
+    def frame_received(self):
+        self._frames += 1
+        if self._frames >= self.STABLE_FRAMES:
+            self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.maximum, self.initial * (self.factor ** self.attempts))
+        self.attempts += 1
+        self._frames = 0
+        return delay / 2.0 + self._rng.uniform(0.0, delay / 2.0)
+
+class IzziController(object):
+
+    
+    """Implements the commands to communicate with the IZZI 300 ERV ventilation unit."""
+
+    """Callback function invoked once per frame with a dict of changed sensor values."""
+    callback_update = None
+
+    """Callback function invoked with supply and extract CfCurve when a CF calibration ends, None on failure."""
+    callback_cf_calibrated = None
+
+    """Callback function invoked when overrides are started, cancelled or expire."""
+    callback_schedule_changed = None
+    
+                        # Id of sensor,                      StatusFrame attribute
+    _STATUS_REGISTERS = ((IZZY_SENSOR_TEMPERATURE_SUPPLY_ID, 'supply_temp'),
+                         (IZZY_SENSOR_TEMPERATURE_EXTRACT_ID, 'extract_temp'),
+                         (IZZY_SENSOR_TEMPERATURE_EXHAUST_ID, 'exhaust_temp'),
+                         (IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID, 'outdoor_temp'),
+                         (IZZY_SENSOR_BYPASS_STATE_ID, 'bypass_state'),
+                         (IZZY_SENSOR_COVER_STATE_ID, 'cover_state'),
+                         (IZZY_SENSOR_DEFROST_STATE_ID, 'defrost_state'))
+    _STATUS_REGISTER_IDS = tuple(sensor_id for sensor_id, attribute in _STATUS_REGISTERS)
+    _STATUS_REGISTER_VALUES = operator.attrgetter(*[attribute for sensor_id, attribute in _STATUS_REGISTERS])
+
+                        # Id of sensor,                    Index in command array
+    _CMD_REGISTERS = ((IZZY_SENSOR_FAN_SUPPLY_SPEED_ID, IZZI_CMD_MSG_SUPPLY_FAN_SPEED_INDEX),
+                      (IZZY_SENSOR_FAN_EXTRACT_SPEED_ID, IZZI_CMD_MSG_EXTRACT_FAN_SPEED_INDEX),
+                      (IZZY_SENSOR_UNIT_STATE_ID, IZZI_CMD_MSG_UNIT_STATE_INDEX),
+                      (IZZY_SENSOR_BYPASS_TEMP_ID, IZZI_CMD_MSG_BYPASS_TEMP_INDEX),
+                      (IZZY_SENSOR_BYPASS_MODE_ID, IZZI_CMD_MSG_BYPASS_MODE_INDEX))
+
+    # Targets taken from the command mailbox
+    _TARGET_IDS = tuple(sensor_id for sensor_id, index in _CMD_REGISTERS) + (IZZY_SENSOR_VENT_MODE_ID,)
+
+    # Supply and extract speed multipliers of the vent modes, None keeps the speed
+    _VENT_MODE_MULTIPLIERS = {IZZY_SENSOR_VENT_MODE_NONE: (None, None),
+                              IZZY_SENSOR_VENT_MODE_FIREPLACE: (None, 0.8),
+                              IZZY_SENSOR_VENT_MODE_OPEN_WINDOW: (0, None),
+                              IZZY_SENSOR_VENT_MODE_COOKER_HOOD: (None, 0.3)}
+    
+    def __init__(self, bridge: IzziBridge, is_master : bool):
+
+        self._bridge = bridge
+        self._stopping = False
+        self._connection_task = None
+        self._write_task = None
+        self._write_event = None
+        self._command_pending = False
+        self._command_requested_at = None
+        self._loop = None
+        self.metrics = IzziMetrics()
+        self._bus = IzziBusScheduler(bridge.baudrate)
+        self._backoff = ReconnectBackoff()
+        self._master_mode = is_master
+        
+        # All state is kept per instance, one controller per unit
+        self._registers = IzziRegisterStore()
+        self._publisher = IzziPublisher()
+        self._history = None
+        
+        # Command targets in use, indexed by register id, only touched by the
+        # event loop. Setters publish to the mailbox from any thread, the
+        # scheduler overrides lie on top of the latest snapshot taken.
+        self._cmd_targets = array('h', bytes(2 * IZZI_REGISTER_COUNT))
+        self._cmd_targets[IZZY_SENSOR_UNIT_STATE_ID] = IZZY_CMD_UNIT_STATE_OFF
+        self._cmd_targets[IZZY_SENSOR_BYPASS_TEMP_ID] = 22
+        self._cmd_targets[IZZY_SENSOR_BYPASS_MODE_ID] = IZZY_CMD_BYPASS_MODE_AUTO
+        self._cmd_targets[IZZY_SENSOR_VENT_MODE_ID] = IZZY_SENSOR_VENT_MODE_NONE
+        self._commands = IzziCommandMailbox(self._cmd_targets, self._commands_published)
+        self._base_targets = tuple(self._cmd_targets)
+        self._scheduler = IzziScheduler()
+        # Fan speed multipliers of the active vent mode
+        self._speed_multipliers = {IZZY_SENSOR_FAN_SUPPLY_SPEED_ID: None,
+                                   IZZY_SENSOR_FAN_EXTRACT_SPEED_ID: None}
+        self._registers.set(IZZY_SENSOR_VENT_MODE_ID, IZZY_SENSOR_VENT_MODE_NONE)
+
+        self.cf_controller = create_cf_engine()
+        self._calibration = None
+        self._calibration_task = None
+        # Efficiency, temperature deltas, recovered heat and CF corrections
+        self._derived = IzziDerivedEngine(izzi_derived_sensors(self))
+        self.extract_correction = 0.0
+    
+        self._command_message = array('B', [IZZI_COMMAND_MESSAGE_ID, 0x19, 0x00, 0x14, 0x00, 0x16, 0x05, 0x00, 0x17, IZZY_CMD_BYPASS_MODE_CLOSED, 0x28, 0x28, IZZY_CMD_UNIT_STATE_OFF, 0x00, 0x00])
+        self._status_decoder = IzziStatusDecoder()
+        for sensor_id, index in self._CMD_REGISTERS:
+            self._registers.set(sensor_id, self._command_message[index])
+
+    def connect(self):
+        """Start the connection task on the running event loop."""
+
+        _LOGGER.info("IzziController connect")
+        try:
+            # Start connection task
+            self._stopping = False
+            loop = asyncio.get_running_loop()
+            self._loop = loop
+            # Commands set before, nothing is written before the first slot
+            self._apply_commands()
+            self._connection_task = loop.create_task(self._connection_loop())
+            if self._master_mode:
+                self._write_event = asyncio.Event()
+                self._write_task = loop.create_task(self._write_loop())
+        except Exception as exc:
+            _LOGGER.error(exc)
+            raise Exception('Could start task.')
+
+    async def disconnect(self):
+        """Disconnect from the bridge."""
+    
+        _LOGGER.info("IzziController disconnect")
+    
+        # Set the stopping flag
+        self._stopping = True
+
+        self._calibration = None
+        if self._calibration_task is not None:
+            self._calibration_task.cancel()
+            self._calibration_task = None
+
+        # Wait for the connection tasks to finish
+        if self._write_task is not None:
+            self._write_task.cancel()
+            try:
+                await self._write_task
+            except asyncio.CancelledError:
+                pass
+            self._write_task = None
+            self._write_event = None
+        if self._connection_task is not None:
+            self._connection_task.cancel()
+            try:
+                await self._connection_task
+            except asyncio.CancelledError:
+                pass
+            self._connection_task = None
+        self._loop = None
+
+    def is_connected(self):
+        """Returns whether there is a connection with the bridge."""
+
+        return self._bridge.is_connected()
+
+    def get_master_mode(self) -> bool:
+        return self._master_mode
+        
+    def force_update(self, sensor_id):
+        """Make sure state of sensor will be published."""
+        self._registers.touch(sensor_id)
+        self._publisher.force(sensor_id)
+
+    def set_publish_policy(self, sensor_id, policy: PublishPolicy):
+        """Set when changes of sensor are published, None publishes every change."""
+        self._publisher.set_policy(sensor_id, policy)
+
+    def snapshot(self) -> RegisterSnapshot:
+        """Returns consistent copy of all sensor values, safe to use from any thread."""
+        return self._registers.snapshot()
+
+    def add_derived_sensor(self, sensor: DerivedSensor):
+        """Compute sensor from other sensors whenever one of them changes."""
+        if sensor.sensor_id >= IZZI_REGISTER_COUNT:
+            raise ValueError("Sensor 0x%02x has no register" % sensor.sensor_id)
+        self._derived.add(sensor)
+
+    def enable_history(self, window: float = DEFAULT_HISTORY_WINDOW):
+        """Keep history of the sensors at frame resolution for window seconds."""
+        self._history = IzziHistory(window, self._bus.period or self._bus.DEFAULT_PERIOD)
+
+    def aggregate(self, sensor_id, start: float, end: float = None, percentiles=()) -> dict:
+        """Returns statistics of sensor between start and end (unix time), None without history."""
+        if self._history is None or sensor_id not in self._history:
+            return None
+        return self._history.aggregate(sensor_id, start, end, percentiles)
+    
+    def set_bypass_mode(self, mode : int) -> bool:
+        if mode < 0 or mode > 2:
+            return False
+        self._commands.publish({IZZY_SENSOR_BYPASS_MODE_ID: mode})
+        return True
+        
+    def get_bypass_mode(self) -> int:
+        return self._commands.latest[IZZY_SENSOR_BYPASS_MODE_ID];
+        
+    def set_bypass_temp(self, temp : int) -> bool:
+        if temp < 18 or temp > 26:
+            return False
+        self._commands.publish({IZZY_SENSOR_BYPASS_TEMP_ID: temp})
+        return True
+        
+    def set_fan_speed(self, supply : int, extract : int) :
+        if (supply < 0 and extract < 0) or supply > 100 or extract > 100:
+            return False
+        
+        # One snapshot, the pair is never written half updated
+        self._commands.publish({IZZY_SENSOR_FAN_SUPPLY_SPEED_ID: supply,
+                                IZZY_SENSOR_FAN_EXTRACT_SPEED_ID: extract})
+        
+        return True
+
+    def get_supply_speed(self):
+        return self._commands.latest[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID]
+        
+    def get_extract_speed(self):
+        return self._commands.latest[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID]
+    
+    
+    def set_vent_mode(self, mode : int) -> bool:
+        if mode < IZZY_SENSOR_VENT_MODE_NONE or mode > IZZY_SENSOR_VENT_MODE_COOKER_HOOD:
+            return False
+        self._commands.publish({IZZY_SENSOR_VENT_MODE_ID: mode})
+        return True
+        
+    def set_cf_engine(self, name: str, update_interval: float = None) -> bool:
+        """Replace the CF engine, see CF_ENGINES. Enabled state and params max are kept."""
+        engine = create_cf_engine(name, update_interval=update_interval)
+        old = self.cf_controller
+        engine.set_enabled(old.is_enabled())
+        engine.set_params_max(old.get_params_max())
+        engine.set_curves(*old.get_curves())
+        self.cf_controller = engine
+        self._derived.invalidate(IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID)
+        self._derived.invalidate(IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID)
+        self._command_requested((IZZY_SENSOR_FAN_SUPPLY_SPEED_ID, IZZY_SENSOR_FAN_EXTRACT_SPEED_ID))
+        return True
+
+    def set_cf_params_max(self, params_max : float) -> bool:
+        self.cf_controller.set_params_max(params_max)
+        self.cf_controller.set_enabled(True)
+        return True
+    
+    def set_cf_params(self, supply : float, extract : float) -> bool:
+        self.add_cf_samples((0.0,), (supply,), (extract,))
+        return True
+
+    def add_cf_samples(self, timestamps, supply, extract) -> int:
+        """Pressure samples at unix timestamps (0 for now), NaN for a fan not measured.
+
+        Samples taken before the last speed change of a fan are dropped.
+        Returns number of pressure values taken.
+        """
+        now = time.monotonic()
+        offset = now - time.time()
+        times = array('d', [timestamp + offset if timestamp else now for timestamp in timestamps])
+        if self._calibration is not None:
+            # Taken at the sweep speeds, not at the ones the engine expects
+            taken = self._calibration.add_samples(times, supply, extract)
+        else:
+            taken = self.cf_controller.add_samples(times, supply, extract)
+        measured = sum(1 for value in supply if value == value) + sum(1 for value in extract if value == value)
+        self.metrics.cf_samples += taken
+        self.metrics.cf_samples_dropped += measured - taken
+        return taken
+
+    def set_cf_curves(self, supply: CfCurve, extract: CfCurve) -> bool:
+        """Expected pressures of both fans, usually from an earlier calibration."""
+        self.cf_controller.set_curves(supply, extract)
+        self._command_requested((IZZY_SENSOR_FAN_SUPPLY_SPEED_ID, IZZY_SENSOR_FAN_EXTRACT_SPEED_ID))
+        return True
+
+    def get_cf_curves(self):
+        return self.cf_controller.get_curves()
+
+    def start_cf_calibration(self, calibration: CfCalibration = None) -> bool:
+        """Sweep fan speeds and fit the CF curves, only in master mode with the unit on.
+
+        Pressures keep coming through set_cf_params(), fan speeds are back to
+        normal when the sweep ends and the curves are fitted in the executor.
+        """
+        if not self._master_mode or self._commands.latest[IZZY_SENSOR_UNIT_STATE_ID] != IZZY_CMD_UNIT_STATE_ON:
+            return False
+        if self._calibration is not None or self._calibration_task is not None:
+            return False
+        if calibration is None:
+            calibration = CfCalibration()
+        calibration.start(time.monotonic())
+        self._calibration = calibration
+        self._command_requested((IZZY_SENSOR_FAN_SUPPLY_SPEED_ID, IZZY_SENSOR_FAN_EXTRACT_SPEED_ID))
+        return True
+
+    def cancel_cf_calibration(self) -> bool:
+        if self._calibration is None:
+            return False
+        _LOGGER.info("CF calibration cancelled")
+        self._calibration = None
+        self._command_requested((IZZY_SENSOR_FAN_SUPPLY_SPEED_ID, IZZY_SENSOR_FAN_EXTRACT_SPEED_ID))
+        return True
+
+    def is_cf_calibrating(self) -> bool:
+        return self._calibration is not None or self._calibration_task is not None
+
+    def _advance_calibration(self):
+        calibration = self._calibration
+        if calibration.advance(time.monotonic()) and calibration.done():
+            self._calibration = None
+            self._calibration_task = asyncio.get_running_loop().create_task(self._finish_calibration(calibration))
+
+    async def _finish_calibration(self, calibration: CfCalibration):
+        """Fit curves in the executor, importing numpy would stall the frames."""
+        supply = extract = None
+        try:
+            supply, extract = await asyncio.get_running_loop().run_in_executor(None, calibration.fit)
+            self.set_cf_curves(supply, extract)
+            _LOGGER.info("CF calibration done, supply %.1f, extract %.1f at 100 %%", supply.scale, extract.scale)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            _LOGGER.error("CF calibration failed: %s", exc)
+        finally:
+            self._calibration_task = None
+        if self.callback_cf_calibrated:
+            self.callback_cf_calibrated(supply, extract)
+        
+    def is_cf_enabled(self) -> bool:
+        return self.cf_controller.is_enabled()
+        
+    def set_unit_on(self, on : bool) :
+        self._commands.publish({IZZY_SENSOR_UNIT_STATE_ID: IZZY_CMD_UNIT_STATE_ON if on else IZZY_CMD_UNIT_STATE_OFF})
+        return True
+
+    def _commands_published(self):
+        """Called by the thread publishing to the mailbox, wakes the event loop."""
+        loop = self._loop
+        if loop is None:
+            # Taken when connecting
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._commands_ready()
+        else:
+            loop.call_soon_threadsafe(self._commands_ready)
+
+    def _commands_ready(self):
+        if self._master_mode:
+            # Taken at the write slot, later snapshots until then supersede it
+            self._command_pending = True
+            if self._write_event is not None:
+                self._write_event.set()
+        else:
+            self._apply_commands()
+
+    def _apply_commands(self) -> bool:
+        """Take the latest snapshot of the mailbox, returns whether the command changed."""
+        snapshot = self._commands.take()
+        self.metrics.commands_superseded = self._commands.superseded
+        if snapshot is None:
+            return False
+        self._base_targets = snapshot.targets
+        if self._command_requested_at is None:
+            self._command_requested_at = snapshot.published_at
+        return self._retarget()
+
+    def _retarget(self) -> bool:
+        """Update targets from the snapshot taken and the overrides, returns whether the command changed."""
+        targets = self._cmd_targets
+        base = self._base_targets
+        overlay = self._scheduler.overlay
+        changed = []
+        for sensor_id in self._TARGET_IDS:
+            value = overlay.get(sensor_id, base[sensor_id])
+            if targets[sensor_id] != value:
+                targets[sensor_id] = value
+                changed.append(sensor_id)
+
+        if IZZY_SENSOR_UNIT_STATE_ID in changed and targets[IZZY_SENSOR_UNIT_STATE_ID] != IZZY_CMD_UNIT_STATE_ON:
+            if self._calibration is not None:
+                _LOGGER.info("CF calibration cancelled, unit off")
+                self._calibration = None
+                changed.extend(self._speed_multipliers)
+        if IZZY_SENSOR_VENT_MODE_ID in changed:
+            mode = targets[IZZY_SENSOR_VENT_MODE_ID]
+            supply, extract = self._VENT_MODE_MULTIPLIERS[mode]
+            self._speed_multipliers[IZZY_SENSOR_FAN_SUPPLY_SPEED_ID] = supply
+            self._speed_multipliers[IZZY_SENSOR_FAN_EXTRACT_SPEED_ID] = extract
+            self._registers.set(IZZY_SENSOR_VENT_MODE_ID, mode)
+            changed.extend(self._speed_multipliers)
+        return self._update_command(frozenset(changed))
+
+    def _command_requested(self, sensor_ids):
+        """Write changed command in the next free bus slot instead of waiting for keep-alive.
+
+        Event loop only, for changes not coming through the mailbox.
+        """
+        if self._master_mode and self._update_command(sensor_ids):
+            self._command_changed()
+
+    def _command_changed(self):
+        if self._command_requested_at is None:
+            self._command_requested_at = time.perf_counter()
+        self._command_pending = True
+        if self._write_event is not None:
+            self._write_event.set()
+
+    def start_override(self, name: str, targets: dict, duration: float) -> bool:
+        """Hold targets {register id: value} for duration seconds, then revert them.
+
+        Overrides of fan speeds, vent mode and bypass mode lie on top of the
+        targets set otherwise, the latest started wins. Starting one with the
+        name of an active one replaces it. Master mode only, event loop only.
+        """
+        if not self._master_mode:
+            return False
+        self._scheduler.start_override(name, targets, duration, time.monotonic())
+        self._schedule_changed()
+        return True
+
+    def cancel_override(self, name: str = None) -> bool:
+        """Revert override of name or all of them. Event loop only."""
+        if not self._scheduler.cancel_override(name):
+            return False
+        self._schedule_changed()
+        return True
+
+    def get_overrides(self) -> list:
+        """Returns (name, targets, seconds left) of the active overrides."""
+        return self._scheduler.get_overrides(time.monotonic())
+
+    def set_program(self, entries) -> bool:
+        """Weekly program of ScheduleEntry, the step in effect now is set at once.
+
+        Steps set targets the same way the setters do, so a change made in
+        between holds until the next step. Master mode only, event loop only.
+        """
+        if not self._master_mode:
+            return False
+        changes = self._scheduler.set_program(entries, time.monotonic(), time.time())
+        if changes:
+            self._commands.publish(changes)
+        return True
+
+    def _run_schedule(self):
+        changes, overlay_changed = self._scheduler.evaluate(time.monotonic(), time.time())
+        if changes:
+            # Taken at the write slot like any other command
+            self._commands.publish(changes)
+        if overlay_changed:
+            self._schedule_changed()
+
+    def _schedule_changed(self):
+        if self._retarget():
+            self._command_changed()
+        if self.callback_schedule_changed:
+            self.callback_schedule_changed()
+
+    def _update_command(self, sensor_ids=None) -> bool:
+        """Compute command message from targets, returns whether it changed.
+
+        Only given sensors are computed, the CF controller must not see the
+        same target twice per frame.
+        """
+        registers = self._registers
+        changed = False
+        unit_running = (self._cmd_targets[IZZY_SENSOR_UNIT_STATE_ID] == IZZY_CMD_UNIT_STATE_ON
+                        and registers.get(IZZY_SENSOR_COVER_STATE_ID) == 0)
+        for sensor_id, index in self._CMD_REGISTERS:
+            if sensor_ids is not None and sensor_id not in sensor_ids:
+                continue
+            exp_sensor_val = self._cmd_targets[sensor_id]
+            multiplier = self._speed_multipliers.get(sensor_id)
+            if multiplier is not None:
+                exp_sensor_val = int(float(exp_sensor_val) * multiplier)
+        
+            if self._calibration is not None and sensor_id in self._speed_multipliers:
+                # Sweep speed as it is, without vent mode and CF
+                exp_sensor_val = self._calibration.speed
+            elif unit_running:
+                if sensor_id == IZZY_SENSOR_FAN_SUPPLY_SPEED_ID:
+                    exp_sensor_val = self.cf_controller.get_supply_speed(exp_sensor_val)
+                    self._derived.invalidate(IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID)
+                    if exp_sensor_val < 15:
+                        exp_sensor_val = 15
+                elif sensor_id == IZZY_SENSOR_FAN_EXTRACT_SPEED_ID:
+                    exp_sensor_val = self.cf_controller.get_extract_speed(exp_sensor_val)
+                    self._derived.invalidate(IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID)
+                    if exp_sensor_val < 15:
+                        exp_sensor_val = 15
+            
+            if exp_sensor_val != self._command_message[index]:
+                self._command_message[index] = exp_sensor_val
+                registers.set(sensor_id, self._command_message[index])
+                changed = True
+        return changed
+
+    async def _write_loop(self):
+        """Write command message in the quiet window after a status frame."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._write_event.wait()
+            self._write_event.clear()
+            
+            while self._command_pending:
+                delay = self._bus.slot_delay(loop.time())
+                if delay is None:
+                    # Window missed, the next status frame wakes us up again
+                    break
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                
+                # Only the latest targets are written, whatever was published since the wake-up
+                self._apply_commands()
+                written = False
+                try:
+                    if self.is_connected():
+                        #_LOGGER.debug("Writting msg %s", str(self._command_message))
+                        written = self._bridge.write_message(self._command_message) != False
+                except Exception as exc:
+                    _LOGGER.error(exc)
+                if written:
+                    self._bus.written(loop.time())
+                    self.metrics.writes += 1
+                    if self._command_requested_at is not None:
+                        self.metrics.command_latency_seconds.observe(time.perf_counter() - self._command_requested_at)
+                        self._command_requested_at = None
+                else:
+                    # Command stays requested, keep-alive retries it
+                    self.metrics.write_failures += 1
+                    _LOGGER.debug("Command write failed")
+                self._command_pending = False
+        
+    def collect_metrics(self) -> IzziMetrics:
+        """Returns metrics with gauges brought up to date."""
+        metrics = self.metrics
+        metrics.skipped_bytes = getattr(self._bridge, 'skipped_bytes', 0)
+        metrics.rx_wakeups = getattr(self._bridge, 'rx_wakeups', 0)
+        metrics.connected = 1 if self.is_connected() else 0
+        metrics.frame_period_seconds = self._bus.period or 0.0
+        metrics.frame_jitter_seconds = self._bus.jitter
+        return metrics
+
+    async def _connection_loop(self):
+        registers = self._registers
+        metrics = self.metrics
+        loop = asyncio.get_running_loop()
+            
+        try:
+            while not self._stopping:
+        
+                # Start connection
+                if not self.is_connected():
+
+                    try:
+                        _LOGGER.info("Trying connect to bridge")
+                        # Connect or re-connect
+                        if not await self._bridge.connect():
+                            metrics.connect_failures += 1
+                            await asyncio.sleep(self._backoff.next_delay())
+                            continue
+                        
+                        metrics.connects += 1
+                        self._bus.reset()
+                        _LOGGER.info("Connection established")
+                    except Exception as exc:
+                        _LOGGER.error(exc)
+                        metrics.connect_failures += 1
+                        await asyncio.sleep(self._backoff.next_delay())
+                        continue;
+            
+                try:
+                
+                    #_LOGGER.debug("Reading message")
+                    # Watchdog, status frame is missing after about 1.5 learned periods
+                    status_message = await self._bridge.read_message(self._bus.read_timeout(loop.time()))
+                    if status_message == None:
+                        metrics.read_timeouts += 1
+                        self._bridge.disconnect()
+                        _LOGGER.error("No status frame received, reconnecting")
+                        await asyncio.sleep(self._backoff.next_delay())
+                        continue
+                
+                    started = time.perf_counter()
+                    command_id = struct.unpack_from('>B', status_message, IZZI_STATUS_MSG_ID_INDEX)[0]
+                    if (command_id == IZZI_STATUS_MESSAGE_ID):
+                        metrics.frames_status += 1
+                        self._bus.frame_received(loop.time())
+                        self._backoff.frame_received()
+                        #_LOGGER.debug(status_message)
+                    
+                        # Repeated frames carry nothing new, skip the per sensor work
+                        status_frame = self._status_decoder.decode(status_message)
+                        if status_frame is not None:
+                            registers.update(self._STATUS_REGISTER_IDS, self._STATUS_REGISTER_VALUES(status_frame))
+                
+                    elif command_id == IZZI_COMMAND_MESSAGE_ID:
+                        metrics.frames_command += 1
+                    
+                    if not self._master_mode and command_id == IZZI_COMMAND_MESSAGE_ID:
+                        for sensor_id, index in self._CMD_REGISTERS:
+                            self._cmd_targets[sensor_id] = status_message[index]
+                        _LOGGER.debug("CMD RX %s", str(binascii.hexlify(status_message)))
+                    
+                    if self._calibration is not None:
+                        self._advance_calibration()
+                    if self._scheduler.due(time.monotonic()):
+                        self._run_schedule()
+                    self._update_command()
+                    # Only sensors whose inputs changed in this frame
+                    self._derived.evaluate(registers)
+                    
+                    # Deliver all changes of this frame at once
+                    updates = registers.commit()
+                    if self._history is not None and command_id == IZZI_STATUS_MESSAGE_ID:
+                        period = self._bus.period
+                        if period is not None and period < self._history.period:
+                            self._history.fit_period(period)
+                        self._history.record(time.time(), registers)
+                    if updates or self._publisher.has_work():
+                        updates = self._publisher.filter(updates, loop.time(), registers)
+                    if updates and self.callback_update:
+                        self.callback_update(updates)
+                 
+                    # Keep-alive every few frames, user commands as soon as there is a slot
+                    if command_id == IZZI_STATUS_MESSAGE_ID and self._master_mode:
+                        if self._bus.keepalive_due():
+                            self._command_pending = True
+                        if self._command_pending and self._write_event is not None:
+                            self._write_event.set()
+                    
+                    metrics.frame_processing_seconds.observe(time.perf_counter() - started)
+
+                except Exception as exc:
+                    _LOGGER.error(exc)
+                    if not self.is_connected():
+                        # Connection refused right after connect shouldn't spin
+                        await asyncio.sleep(self._backoff.next_delay())
+                    continue
+          
+        finally:
+            try:
+                self._bridge.disconnect()
+            except Exception as exc:
+                _LOGGER.error(exc)
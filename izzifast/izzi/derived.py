@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+from operator import itemgetter
+
+from .const import *
+
+# Supply airflow at 100 % fan speed [m3/h]
+NOMINAL_AIRFLOW = 300.0
+
+# Volumetric heat capacity of air [Wh/(m3*K)], 1.2 kg/m3 * 1005 J/(kg*K)
+AIR_HEAT_CAPACITY = 1.2 * 1005.0 / 3600.0
+
+
+class DerivedSensor(object):
+    """Register computed from other registers.
+
+    compute is called with the values of inputs, in the same order, and only
+    when all of them have a value. Otherwise the register is cleared.
+    """
+
+    __slots__ = ('sensor_id', 'inputs', 'compute', 'mask', 'bit', 'read')
+
+    def __init__(self, sensor_id: int, inputs, compute) -> None:
+        self.sensor_id = sensor_id
+        self.inputs = tuple(inputs)
+        self.compute = compute
+        self.bit = 1 << sensor_id
+        self.mask = 0
+        for input_id in self.inputs:
+            self.mask |= 1 << input_id
+        # Returns tuple of the input values from the register array
+        if len(self.inputs) > 1:
+            self.read = itemgetter(*self.inputs)
+        else:
+            self.read = lambda values, inputs=self.inputs: tuple(values[input_id] for input_id in inputs)
+
+
+class IzziDerivedEngine(object):
+    """Recomputes derived registers whose inputs changed since the last commit.
+
+    Changes are taken from the dirty bits of the register store, so a frame
+    which changed nothing computes nothing. Sensors are evaluated in the
+    order they were added and may use the outputs of earlier ones. Sensors
+    depending on state outside of the registers are invalidated explicitly.
+    """
+
+    def __init__(self, sensors=()) -> None:
+        self._sensors = []
+        self._outputs = 0
+        self._inputs = 0
+        self._invalid = 0
+        for sensor in sensors:
+            self.add(sensor)
+
+    def __iter__(self):
+        return iter(self._sensors)
+
+    def add(self, sensor: DerivedSensor):
+        bit = 1 << sensor.sensor_id
+        if self._outputs & bit:
+            raise ValueError("Sensor 0x%02x is derived already" % sensor.sensor_id)
+        if sensor.mask & bit:
+            raise ValueError("Sensor 0x%02x depends on itself" % sensor.sensor_id)
+        # Earlier sensors would read the output before it's computed
+        if any(other.mask & bit for other in self._sensors):
+            raise ValueError("Sensor 0x%02x must be added before the sensors using it" % sensor.sensor_id)
+        self._sensors.append(sensor)
+        self._outputs |= bit
+        self._inputs |= sensor.mask
+        self._invalid |= bit
+
+    def invalidate(self, sensor_id):
+        """Recompute sensor on next evaluate() even if no input changed."""
+        self._invalid |= 1 << sensor_id
+
+    def evaluate(self, registers) -> int:
+        """Updates derived registers, returns the number of sensors computed."""
+        invalid = self._invalid
+        changed = registers.dirty
+        if not invalid and not changed & self._inputs:
+            return 0
+        self._invalid = 0
+        computed = 0
+        values = registers.values
+        for sensor in self._sensors:
+            if changed & sensor.mask or invalid & sensor.bit:
+                if registers.valid & sensor.mask == sensor.mask:
+                    value = sensor.compute(*sensor.read(values))
+                else:
+                    value = None
+                # Later sensors may use this one
+                if registers.set(sensor.sensor_id, value):
+                    changed |= sensor.bit
+                computed += 1
+        return computed
+
+
+def efficiency(outdoor: int, supply: int, extract: int) -> int:
+    """Temperature efficiency of the heat exchanger [%]."""
+    if extract == outdoor:
+        return 100
+    return round((supply - outdoor) / (extract - outdoor) * 100.0)
+
+
+def temperature_delta(high: int, low: int) -> int:
+    return high - low
+
+
+def recovered_heat(outdoor: int, supply: int, supply_speed: int) -> int:
+    """Heat given to the supply air [W], airflow estimated from the fan speed."""
+    airflow = NOMINAL_AIRFLOW * supply_speed / 100.0
+    return round(AIR_HEAT_CAPACITY * airflow * (supply - outdoor))
+
+
+def izzi_derived_sensors(controller) -> list:
+    """Derived sensors of a controller, CF corrections are invalidated by the controller.
+
+    They are read through the controller as its CF engine can be replaced.
+    """
+    return [
+        DerivedSensor(IZZY_SENSOR_EFFICIENCY_ID,
+                      (IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID, IZZY_SENSOR_TEMPERATURE_SUPPLY_ID,
+                       IZZY_SENSOR_TEMPERATURE_EXTRACT_ID),
+                      efficiency),
+        DerivedSensor(IZZY_SENSOR_SUPPLY_DELTA_ID,
+                      (IZZY_SENSOR_TEMPERATURE_SUPPLY_ID, IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID),
+                      temperature_delta),
+        DerivedSensor(IZZY_SENSOR_EXTRACT_DELTA_ID,
+                      (IZZY_SENSOR_TEMPERATURE_EXTRACT_ID, IZZY_SENSOR_TEMPERATURE_EXHAUST_ID),
+                      temperature_delta),
+        DerivedSensor(IZZY_SENSOR_RECOVERED_HEAT_ID,
+                      (IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID, IZZY_SENSOR_TEMPERATURE_SUPPLY_ID,
+                       IZZY_SENSOR_FAN_SUPPLY_SPEED_ID),
+                      recovered_heat),
+        DerivedSensor(IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID, (), lambda: controller.cf_controller.get_supply_correction()),
+        DerivedSensor(IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID, (), lambda: controller.cf_controller.get_extract_correction()),
+    ]
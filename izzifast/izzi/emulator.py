@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Emulates an iZZi ERV 300 unit together with its RS485 bridge.
+
+Status (0x63) frames are sent at the unit cadence to every TCP client and to
+a pseudo terminal, command (0x64) frames received on either of them are
+applied to the simulated unit. Run from the izzifast directory:
+
+    python -m izzi.emulator --port 8234 --pty --period 1.0 --noise 0.3
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import sys
+import time
+import tty
+
+from .const import *
+from .protocol import IzziFrameDecoder, IZZI_MESSAGE_LENGTH
+
+_LOGGER = logging.getLogger('izziemulator')
+
+DEFAULT_PORT = 8234
+DEFAULT_PERIOD = 1.0
+
+
+class IzziUnitModel(object):
+    """Thermal and state model of the ventilation unit."""
+
+    # Heat exchanger efficiency at minimum and maximum fan speed
+    EFFICIENCY_LOW_SPEED = 0.92
+    EFFICIENCY_HIGH_SPEED = 0.75
+    # Time constant of temperature changes [s]
+    TEMPERATURE_TAU = 120.0
+    # Outdoor temperature below which the exchanger starts to freeze
+    DEFROST_TEMPERATURE = -3.0
+    DEFROST_DURATION = 300.0
+    DEFROST_INTERVAL = 1800.0
+    BYPASS_MIN_OUTDOOR_TEMPERATURE = 12.0
+
+    def __init__(self, outdoor: float = 5.0, indoor: float = 22.0, noise: float = 0.0, drift: float = 0.0, rng=None) -> None:
+        self.rng = rng or random.Random()
+        self.noise = noise
+        # Outdoor temperature drift [deg C per hour]
+        self.drift = drift
+
+        self.outdoor_temp = outdoor
+        self.extract_temp = indoor
+        self.supply_temp = indoor
+        self.exhaust_temp = outdoor
+
+        self.supply_speed = 0
+        self.extract_speed = 0
+        self.bypass_temp = 23
+        self.bypass_mode = IZZY_CMD_BYPASS_MODE_AUTO
+        self.unit_state = IZZY_CMD_UNIT_STATE_OFF
+
+        self.bypass_open = False
+        self.cover_open = False
+        self._defrost_until = 0.0
+        self._next_defrost = self.DEFROST_INTERVAL
+        self.time = 0.0
+
+    @property
+    def defrost_active(self) -> bool:
+        return self.time < self._defrost_until
+
+    def apply_command(self, message):
+        """Apply settings from a command frame."""
+        self.bypass_temp = message[IZZI_CMD_MSG_BYPASS_TEMP_INDEX]
+        self.bypass_mode = message[IZZI_CMD_MSG_BYPASS_MODE_INDEX]
+        self.supply_speed = min(100, message[IZZI_CMD_MSG_SUPPLY_FAN_SPEED_INDEX])
+        self.extract_speed = min(100, message[IZZI_CMD_MSG_EXTRACT_FAN_SPEED_INDEX])
+        self.unit_state = message[IZZI_CMD_MSG_UNIT_STATE_INDEX]
+
+    def step(self, dt: float):
+        """Advance the model by dt seconds."""
+        self.time += dt
+        self.outdoor_temp += self.drift * dt / 3600.0
+
+        running = self.unit_state == IZZY_CMD_UNIT_STATE_ON and not self.cover_open
+        supply = self.supply_speed if running else 0
+        extract = self.extract_speed if running else 0
+
+        if self.bypass_mode == IZZY_CMD_BYPASS_MODE_OPEN:
+            self.bypass_open = True
+        elif self.bypass_mode == IZZY_CMD_BYPASS_MODE_CLOSED:
+            self.bypass_open = False
+        else:
+            self.bypass_open = (self.extract_temp > self.bypass_temp
+                                and self.BYPASS_MIN_OUTDOOR_TEMPERATURE < self.outdoor_temp < self.extract_temp)
+
+        if running and self.outdoor_temp < self.DEFROST_TEMPERATURE and self.time >= self._next_defrost:
+            self._defrost_until = self.time + self.DEFROST_DURATION
+            self._next_defrost = self.time + self.DEFROST_INTERVAL
+
+        if supply == 0 and extract == 0:
+            efficiency = 0.0
+            target_supply = self.extract_temp
+            target_exhaust = self.extract_temp
+        else:
+            speed = max(supply, extract) / 100.0
+            efficiency = self.EFFICIENCY_LOW_SPEED + (self.EFFICIENCY_HIGH_SPEED - self.EFFICIENCY_LOW_SPEED) * speed
+            # Unbalanced flows and defrost (supply fan stopped) lower recovery
+            if extract > 0:
+                efficiency *= min(1.0, extract / max(supply, 1))
+            if self.bypass_open or self.defrost_active:
+                efficiency = 0.0
+            target_supply = self.outdoor_temp + efficiency * (self.extract_temp - self.outdoor_temp)
+            target_exhaust = self.extract_temp - efficiency * (self.extract_temp - self.outdoor_temp)
+
+        alpha = 1.0 - math.exp(-dt / self.TEMPERATURE_TAU)
+        self.supply_temp += (target_supply - self.supply_temp) * alpha
+        self.exhaust_temp += (target_exhaust - self.exhaust_temp) * alpha
+
+    def _measure(self, value: float) -> int:
+        if self.noise > 0:
+            value += self.rng.gauss(0.0, self.noise)
+        return max(-128, min(127, int(round(value))))
+
+    def status_message(self) -> bytes:
+        message = bytearray(IZZI_MESSAGE_LENGTH)
+        message[IZZI_STATUS_MSG_ID_INDEX] = IZZI_STATUS_MESSAGE_ID
+        message[IZZI_STATUS_MSG_OUTDOR_AIR_TEMP_INDEX] = self._measure(self.outdoor_temp) & 0xFF
+        message[IZZI_STATUS_MSG_EXHAUST_AIR_TEMP_INDEX] = self._measure(self.exhaust_temp) & 0xFF
+        message[IZZI_STATUS_MSG_SUPPLY_AIR_TEMP_INDEX] = self._measure(self.supply_temp) & 0xFF
+        message[IZZI_STATUS_MSG_EXTRACT_AIR_TEMP_INDEX] = self._measure(self.extract_temp) & 0xFF
+        # Cover and defrost share the same byte
+        if self.defrost_active:
+            message[IZZI_STATUS_MSG_DEFROST_STATE_INDEX] = IZZY_STATUS_MSG_DEFROST_STATE_ACTIVE
+        elif self.cover_open:
+            message[IZZI_STATUS_MSG_COVER_STATE_INDEX] = IZZY_STATUS_MSG_COVER_STATE_OPEN
+        else:
+            message[IZZI_STATUS_MSG_COVER_STATE_INDEX] = IZZY_STATUS_MSG_COVER_STATE_CLOSED
+        message[IZZI_STATUS_MSG_BYPASS_STATE_INDEX] = IZZI_STATUS_MSG_BYPASS_STATE_OPEN if self.bypass_open else IZZI_STATUS_MSG_BYPASS_STATE_CLOSED
+        return bytes(message)
+
+    def command_message(self) -> bytes:
+        """Command frame a touch panel would send for current settings."""
+        message = bytearray([IZZI_COMMAND_MESSAGE_ID, 0x19, 0x00, 0x14, 0x00, 0x16, 0x05, 0x00, 0x17, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+        message[IZZI_CMD_MSG_BYPASS_TEMP_INDEX] = self.bypass_temp
+        message[IZZI_CMD_MSG_BYPASS_MODE_INDEX] = self.bypass_mode
+        message[IZZI_CMD_MSG_SUPPLY_FAN_SPEED_INDEX] = self.supply_speed
+        message[IZZI_CMD_MSG_EXTRACT_FAN_SPEED_INDEX] = self.extract_speed
+        message[IZZI_CMD_MSG_UNIT_STATE_INDEX] = self.unit_state
+        return bytes(message)
+
+
+class IzziEmulator(object):
+    """Serves the unit model over TCP and a pseudo terminal."""
+
+    def __init__(self, model: IzziUnitModel, period: float = DEFAULT_PERIOD, jitter: float = 0.0,
+                 garbage: float = 0.0, panel: bool = False, time_scale: float = 1.0) -> None:
+        self.model = model
+        self.period = period
+        self.jitter = jitter
+        # Probability of line garbage before a frame
+        self.garbage = garbage
+        # Emulate a touch panel sending command frames (slave mode testing)
+        self.panel = panel
+        self.time_scale = time_scale
+
+        self._clients = set()
+        self._server = None
+        self._pty_master = None
+        self.pty_name = None
+        self._decoder = IzziFrameDecoder()
+        self.frames_sent = 0
+        self.commands_received = 0
+
+    async def start_tcp(self, host: str, port: int):
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        _LOGGER.info("Listening on %s:%d", host, port)
+
+    def start_pty(self) -> str:
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        os.set_blocking(master, False)
+        self._pty_master = master
+        self._pty_slave = slave
+        self.pty_name = os.ttyname(slave)
+        asyncio.get_running_loop().add_reader(master, self._pty_readable)
+        _LOGGER.info("Serial line on %s", self.pty_name)
+        return self.pty_name
+
+    async def _handle_client(self, reader, writer):
+        _LOGGER.info("Client connected %s", writer.get_extra_info('peername'))
+        self._clients.add(writer)
+        decoder = IzziFrameDecoder()
+        try:
+            while True:
+                data = await reader.read(256)
+                if not data:
+                    break
+                self._received(decoder, data)
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+            _LOGGER.info("Client disconnected")
+
+    def _pty_readable(self):
+        try:
+            data = os.read(self._pty_master, 256)
+        except (BlockingIOError, OSError):
+            return
+        self._received(self._decoder, data)
+
+    def _received(self, decoder, data):
+        decoder.feed(data)
+        for frame in decoder.frames():
+            if frame[IZZI_CMD_MSG_ID_INDEX] == IZZI_COMMAND_MESSAGE_ID:
+                self.commands_received += 1
+                self.model.apply_command(frame)
+                _LOGGER.debug("Command %s", bytes(frame).hex())
+
+    def _send(self, data: bytes):
+        for writer in list(self._clients):
+            if writer.transport.get_write_buffer_size() > 64 * IZZI_MESSAGE_LENGTH:
+                # Client doesn't read, the bridge drops data as well
+                continue
+            writer.write(data)
+        if self._pty_master is not None:
+            try:
+                os.write(self._pty_master, data)
+            except (BlockingIOError, OSError):
+                pass
+
+    async def run(self):
+        rng = self.model.rng
+        last = time.monotonic()
+        counter = 0
+        while True:
+            delay = self.period + (rng.uniform(-self.jitter, self.jitter) if self.jitter > 0 else 0.0)
+            await asyncio.sleep(max(0.0, delay))
+            now = time.monotonic()
+            self.model.step((now - last) * self.time_scale)
+            last = now
+
+            data = self.model.status_message()
+            if self.garbage > 0 and rng.random() < self.garbage:
+                data = bytes(rng.randrange(256) for _ in range(rng.randint(1, 8))) + data
+            self._send(data)
+            self.frames_sent += 1
+
+            counter += 1
+            if self.panel and counter % 2 == 0:
+                await asyncio.sleep(min(0.2, self.period / 4))
+                self._send(self.model.command_message())
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        if self._pty_master is not None:
+            asyncio.get_running_loop().remove_reader(self._pty_master)
+            os.close(self._pty_master)
+            os.close(self._pty_slave)
+            self._pty_master = None
+
+
+async def _main(args):
+    model = IzziUnitModel(args.outdoor, args.indoor, args.noise, args.drift, random.Random(args.seed))
+    model.cover_open = args.cover_open
+    if args.on:
+        model.unit_state = IZZY_CMD_UNIT_STATE_ON
+        model.supply_speed = model.extract_speed = args.speed
+    emulator = IzziEmulator(model, args.period, args.jitter, args.garbage, args.panel, args.time_scale)
+    if args.port:
+        await emulator.start_tcp(args.host, args.port)
+    if args.pty:
+        print(emulator.start_pty(), flush=True)
+    try:
+        await emulator.run()
+    finally:
+        emulator.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Emulate an iZZi ERV 300 unit and its RS485 bridge.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="TCP port, 0 disables TCP")
+    parser.add_argument('--pty', action='store_true', help="also serve a pseudo terminal, its name is printed")
+    parser.add_argument('--period', type=float, default=DEFAULT_PERIOD, help="status frame period [s]")
+    parser.add_argument('--jitter', type=float, default=0.0, help="max frame period deviation [s]")
+    parser.add_argument('--noise', type=float, default=0.0, help="temperature noise std deviation [deg C]")
+    parser.add_argument('--drift', type=float, default=0.0, help="outdoor temperature drift [deg C / h]")
+    parser.add_argument('--garbage', type=float, default=0.0, help="probability of line garbage before a frame")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="model time speed up")
+    parser.add_argument('--outdoor', type=float, default=5.0)
+    parser.add_argument('--indoor', type=float, default=22.0)
+    parser.add_argument('--on', action='store_true', help="start with the unit running")
+    parser.add_argument('--speed', type=int, default=40)
+    parser.add_argument('--cover-open', action='store_true')
+    parser.add_argument('--panel', action='store_true', help="send touch panel command frames")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+import logging
+import math
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+
+from .const import *
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+NAN = float('nan')
+
+# Registers kept in the history, one column each
+HISTORY_REGISTERS = (IZZY_SENSOR_TEMPERATURE_SUPPLY_ID,
+                     IZZY_SENSOR_TEMPERATURE_EXTRACT_ID,
+                     IZZY_SENSOR_TEMPERATURE_EXHAUST_ID,
+                     IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID,
+                     IZZY_SENSOR_EFFICIENCY_ID,
+                     IZZY_SENSOR_BYPASS_STATE_ID,
+                     IZZY_SENSOR_COVER_STATE_ID,
+                     IZZY_SENSOR_DEFROST_STATE_ID,
+                     IZZY_SENSOR_FAN_SUPPLY_SPEED_ID,
+                     IZZY_SENSOR_FAN_EXTRACT_SPEED_ID,
+                     IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID,
+                     IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID,
+                     IZZY_SENSOR_SUPPLY_DELTA_ID,
+                     IZZY_SENSOR_EXTRACT_DELTA_ID,
+                     IZZY_SENSOR_RECOVERED_HEAT_ID)
+
+DEFAULT_HISTORY_WINDOW = 3600.0
+
+MINUTE = 60.0
+HOUR = 3600.0
+
+
+class TimeRing(object):
+    """Timestamps and value columns in preallocated arrays used as a ring.
+
+    Entries are appended in time order, so a time range maps to a contiguous
+    range of logical indexes found by binary search.
+    """
+
+    __slots__ = ('capacity', 'times', 'columns', '_count', '_pos')
+
+    def __init__(self, capacity: int, columns: int) -> None:
+        if capacity < 1:
+            raise ValueError("Ring capacity must be positive")
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.columns = [array('d', bytes(8 * capacity)) for _ in range(columns)]
+        self._count = 0
+        self._pos = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def clear(self):
+        self._count = 0
+        self._pos = 0
+
+    def oldest(self):
+        """Returns time of the oldest entry or None if empty."""
+        if self._count == 0:
+            return None
+        return self.times[(self._pos - self._count) % self.capacity]
+
+    def newest(self):
+        if self._count == 0:
+            return None
+        return self.times[self._pos - 1]
+
+    def time(self, index: int) -> float:
+        """Returns time of entry at logical index."""
+        return self.times[(self._pos - self._count + index) % self.capacity]
+
+    def append(self, timestamp: float, row):
+        pos = self._pos
+        self.times[pos] = timestamp
+        for column, value in zip(self.columns, row):
+            column[pos] = value
+        pos += 1
+        self._pos = 0 if pos == self.capacity else pos
+        if self._count < self.capacity:
+            self._count += 1
+
+    def bisect(self, timestamp: float, right: bool = False) -> int:
+        """Returns logical index of the first entry not older than timestamp.
+
+        With right set the first entry newer than timestamp.
+        """
+        times = self.times
+        capacity = self.capacity
+        first = self._pos - self._count
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = times[(first + mid) % capacity]
+            if value < timestamp or right and value == timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def resize(self, capacity: int):
+        """Reallocate for capacity entries, the newest ones are kept."""
+        if capacity < 1:
+            raise ValueError("Ring capacity must be positive")
+        count = min(self._count, capacity)
+        lo = self._count - count
+        times = array('d', bytes(8 * capacity))
+        times[0:count] = self.slice(self.times, lo, self._count)
+        columns = []
+        for column in self.columns:
+            resized = array('d', bytes(8 * capacity))
+            resized[0:count] = self.slice(column, lo, self._count)
+            columns.append(resized)
+        self.capacity = capacity
+        self.times = times
+        self.columns = columns
+        self._count = count
+        self._pos = count % capacity
+
+    def slice(self, column: array, lo: int, hi: int) -> array:
+        """Returns entries lo to hi (logical indexes) of column as a new array."""
+        if hi <= lo:
+            return column[0:0]
+        start = (self._pos - self._count + lo) % self.capacity
+        end = start + hi - lo
+        if end <= self.capacity:
+            return column[start:end]
+        return column[start:] + column[:end - self.capacity]
+
+
+def _valid(values: array) -> array:
+    """Drops the NaN markers of missing values, the sum tells if there are any."""
+    total = sum(values)
+    if total != total:
+        return array('d', [value for value in values if value == value])
+    return values
+
+
+class IzziHistory(object):
+    """Frame resolution history of the registers with 1 minute and 1 hour rollups.
+
+    Every status frame appends one row to the raw ring, which holds the
+    configured window. When a minute ends its rows are reduced to min, max,
+    sum and count per column and appended to the minute ring, finished hours
+    are reduced the same way from the minute ring. Memory is fixed, about
+    8 bytes per column and frame plus a day of minutes and a month of hours.
+
+    aggregate() reads the raw rows for the part of the window they cover and
+    whole rollup buckets for the older part, so every query touches at most
+    a few thousand values. Missing register values are stored as NaN.
+    """
+
+    MINUTE_BUCKETS = 24 * 60
+    HOUR_BUCKETS = 31 * 24
+
+    # Room for frames this much faster when the raw ring grows, so a period
+    # drifting a little doesn't reallocate it again
+    PERIOD_MARGIN = 0.8
+
+    def __init__(self, window: float = DEFAULT_HISTORY_WINDOW, period: float = 1.0,
+                 registers=HISTORY_REGISTERS) -> None:
+        if window < 2 * MINUTE:
+            raise ValueError("History window must be at least two minutes")
+        self.window = window
+        self.period = period
+        self.registers = tuple(registers)
+        self._columns = {register_id: index for index, register_id in enumerate(self.registers)}
+        count = len(self.registers)
+        self._raw = TimeRing(self._raw_capacity(period), count)
+        # min, max, sum and count columns of every register
+        self._minutes = TimeRing(self.MINUTE_BUCKETS, 4 * count)
+        self._hours = TimeRing(self.HOUR_BUCKETS, 4 * count)
+        # Coarsest first, see aggregate()
+        self._levels = ((self._hours, HOUR), (self._minutes, MINUTE))
+        self._minute_start = None
+        self._hour_start = None
+        self._last = None
+
+    def _raw_capacity(self, period: float) -> int:
+        # The minute in progress comes on top of the window
+        return int(math.ceil((self.window + MINUTE) / period))
+
+    def fit_period(self, period: float) -> bool:
+        """Grow the raw ring to hold the window of frames period apart, returns whether it grew.
+
+        The frame period is only known once frames come in, rows already
+        recorded are kept.
+        """
+        if period >= self.period:
+            return False
+        period *= self.PERIOD_MARGIN
+        self._raw.resize(self._raw_capacity(period))
+        self.period = period
+        _LOGGER.debug("History holds %d frames", self._raw.capacity)
+        return True
+
+    def __contains__(self, register_id) -> bool:
+        return register_id in self._columns
+
+    def clear(self):
+        self._raw.clear()
+        self._minutes.clear()
+        self._hours.clear()
+        self._minute_start = None
+        self._hour_start = None
+        self._last = None
+
+    def record(self, timestamp: float, registers):
+        """Append current register values as one row."""
+        if self._last is not None and timestamp < self._last:
+            # Wall clock stepped back, keep rows in order
+            timestamp = self._last
+        self._last = timestamp
+
+        minute = timestamp - timestamp % MINUTE
+        if minute != self._minute_start:
+            if self._minute_start is not None:
+                self._close_minute(self._minute_start)
+            self._minute_start = minute
+
+        get = registers.get
+        self._raw.append(timestamp, [get(register_id, NAN) for register_id in self.registers])
+
+    def _close_minute(self, start: float):
+        raw = self._raw
+        lo = raw.bisect(start)
+        hi = len(raw)
+        if lo < hi:
+            self._minutes.append(start, _reduce_rows([raw.slice(column, lo, hi) for column in raw.columns]))
+
+        hour = start - start % HOUR
+        if hour != self._hour_start:
+            if self._hour_start is not None:
+                self._close_hour(self._hour_start)
+            self._hour_start = hour
+
+    def _close_hour(self, start: float):
+        minutes = self._minutes
+        lo = minutes.bisect(start)
+        hi = minutes.bisect(start + HOUR)
+        if lo < hi:
+            self._hours.append(start, _reduce_buckets([minutes.slice(column, lo, hi) for column in minutes.columns]))
+
+    def aggregate(self, register_id, start: float, end: float = None, percentiles=()) -> dict:
+        """Returns count, min, max, mean and percentiles of register in [start, end).
+
+        Whole hour and minute buckets inside the window are used as they are,
+        raw rows only fill the partial minutes at its edges, so a query reads
+        a few hundred values whatever the window. Percentiles are exact while
+        the window lies in the raw window, older parts contribute their bucket
+        means weighted by sample count. Returns None if there are no values.
+        """
+        if end is None:
+            end = math.inf
+        pieces = []
+        self._collect(self._columns[register_id], 0, start, end, pieces)
+
+        samples = 0
+        minimum = math.inf
+        maximum = -math.inf
+        total = 0.0
+        covered = None
+        for first, mins, maxs, sums, counts in pieces:
+            count = sum(counts) if counts is not None else len(mins)
+            if not count:
+                continue
+            samples += count
+            minimum = min(minimum, min(mins))
+            maximum = max(maximum, max(maxs))
+            total += sum(sums)
+            covered = first if covered is None else min(covered, first)
+        if samples == 0:
+            return None
+
+        result = {
+            'start': covered,
+            'count': int(samples),
+            'min': minimum,
+            'max': maximum,
+            'mean': total / samples,
+        }
+        if percentiles:
+            result['percentiles'] = self._percentiles(register_id, start, end, pieces, percentiles)
+        return result
+
+    def _collect(self, column: int, level: int, start: float, end: float, pieces: list):
+        """Appends (first time, mins, maxs, sums, counts) pieces covering [start, end).
+
+        Raw pieces have the values as mins, maxs and sums and no counts.
+        """
+        if start >= end:
+            return
+        if level == len(self._levels):
+            raw = self._raw
+            lo = raw.bisect(start)
+            hi = raw.bisect(end)
+            if lo < hi:
+                values = _valid(raw.slice(raw.columns[column], lo, hi))
+                pieces.append((raw.time(lo), values, values, values, None))
+            return
+
+        ring, size = self._levels[level]
+        # Buckets starting and ending in the window
+        lo = ring.bisect(start)
+        hi = ring.bisect(end - size, right=True)
+        if lo >= hi:
+            self._collect(column, level + 1, start, end, pieces)
+            return
+        count = len(self.registers)
+        mins, maxs, sums, counts = (ring.slice(ring.columns[column + offset * count], lo, hi) for offset in range(4))
+        first = ring.time(lo)
+        last = ring.time(hi - 1) + size
+        self._collect(column, level + 1, start, first, pieces)
+        pieces.append((first, _valid(mins), _valid(maxs), sums, counts))
+        self._collect(column, level + 1, last, end, pieces)
+
+    def _percentiles(self, register_id, start, end, pieces, percentiles) -> dict:
+        raw = self._raw
+        oldest = raw.oldest()
+        if oldest is not None and start >= oldest:
+            values = sorted(_valid(raw.slice(raw.columns[self._columns[register_id]], raw.bisect(start), raw.bisect(end))))
+            weights = None
+        else:
+            points = []
+            for first, mins, maxs, sums, counts in pieces:
+                if counts is None:
+                    points.extend((value, 1) for value in sums)
+                else:
+                    points.extend((total / count, count) for total, count in zip(sums, counts) if count)
+            points.sort()
+            values = [value for value, weight in points]
+            weights = list(accumulate(weight for value, weight in points))
+
+        result = {}
+        for p in percentiles:
+            if not values:
+                result[p] = None
+            elif weights is None:
+                result[p] = values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+            else:
+                index = bisect_right(weights, p / 100.0 * weights[-1])
+                result[p] = values[min(len(values) - 1, index)]
+        return result
+
+
+def _reduce_rows(columns) -> list:
+    """Returns min, max, sum and count columns of one bucket of raw rows."""
+    mins = []
+    maxs = []
+    sums = []
+    counts = []
+    for values in columns:
+        values = _valid(values)
+        mins.append(min(values) if values else NAN)
+        maxs.append(max(values) if values else NAN)
+        sums.append(sum(values))
+        counts.append(len(values))
+    return mins + maxs + sums + counts
+
+
+def _reduce_buckets(columns) -> list:
+    """Merges min, max, sum and count columns of finer buckets into one bucket."""
+    count = len(columns) // 4
+    mins = []
+    maxs = []
+    for values in columns[:count]:
+        values = _valid(values)
+        mins.append(min(values) if values else NAN)
+    for values in columns[count:2 * count]:
+        values = _valid(values)
+        maxs.append(max(values) if values else NAN)
+    sums = [sum(values) for values in columns[2 * count:3 * count]]
+    counts = [sum(values) for values in columns[3 * count:]]
+    return mins + maxs + sums + counts
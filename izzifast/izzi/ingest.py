@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import asyncio
+import logging
+import sys
+from array import array
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+# Bytes of one sample, time, supply and extract pressure as little endian doubles
+CF_SAMPLE_SIZE = 24
+
+NAN = float('nan')
+
+
+def decode_cf_samples(datagram: bytes):
+    """Returns timestamps, supply and extract arrays of a datagram of samples.
+
+    Every sample is three little endian doubles: unix time (0 for the time
+    of arrival), supply and extract pressure (NaN if not measured).
+    """
+    if not datagram or len(datagram) % CF_SAMPLE_SIZE:
+        raise ValueError("CF sample datagram of %d bytes" % len(datagram))
+    values = array('d', datagram)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values[0::3], values[1::3], values[2::3]
+
+
+def encode_cf_samples(timestamps, supply, extract) -> bytes:
+    """Packs samples the way decode_cf_samples() expects them."""
+    values = array('d', [value for sample in zip(timestamps, supply, extract) for value in sample])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+class IzziPressureProtocol(asyncio.DatagramProtocol):
+    """Feeds batches of pressure samples received over UDP to the controller.
+
+    A datagram is handed over as it is, so a sensor sampling at 10 Hz and
+    sending once a second costs one call per second instead of ten.
+    """
+
+    def __init__(self, controller) -> None:
+        self._controller = controller
+
+    def datagram_received(self, data, addr):
+        try:
+            timestamps, supply, extract = decode_cf_samples(data)
+        except ValueError as exc:
+            self._controller.metrics.cf_samples_dropped += len(data) // CF_SAMPLE_SIZE
+            _LOGGER.debug("Invalid CF samples from %s: %s", addr, exc)
+            return
+        self._controller.add_cf_samples(timestamps, supply, extract)
+
+    def error_received(self, exc):
+        _LOGGER.error("CF sample endpoint: %s", exc)
+
+
+async def start_pressure_endpoint(controller, host: str = '127.0.0.1', port: int = 9234):
+    """Listen for pressure samples of controller, returns the transport to close."""
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: IzziPressureProtocol(controller),
+                                                       local_addr=(host, port))
+    _LOGGER.info("CF samples received on udp://%s:%d", host, port)
+    return transport
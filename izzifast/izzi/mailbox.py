@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+
+class CommandSnapshot(object):
+    """Desired command targets indexed by register id, never changed once published.
+
+    published_at is the perf_counter time the oldest snapshot not yet taken
+    was published, so the latency of a write covers the coalesced ones too.
+    """
+
+    __slots__ = ('seq', 'targets', 'published_at')
+
+    def __init__(self, seq: int, targets: tuple, published_at: float = None) -> None:
+        self.seq = seq
+        self.targets = targets
+        self.published_at = published_at
+
+    def __getitem__(self, sensor_id):
+        return self.targets[sensor_id]
+
+
+class IzziCommandMailbox(object):
+    """Hands the desired command state from any thread to the event loop.
+
+    publish() builds a new snapshot from the latest one and the changes with
+    the next sequence number, callers serialize on a short lock. The event
+    loop takes the latest snapshot at its write slot with plain attribute
+    reads, snapshots published in between are superseded and never written.
+    A supply and extract pair published together is always taken together.
+
+    notify is called by the publishing thread when the first snapshot after
+    a take is published, later ones ride on the same wake-up.
+    """
+
+    def __init__(self, targets, notify=None) -> None:
+        self._lock = threading.Lock()
+        self._latest = CommandSnapshot(0, tuple(targets))
+        self._taken = 0
+        self.notify = notify
+        self.published = 0
+        self.superseded = 0
+
+    @property
+    def latest(self) -> CommandSnapshot:
+        """Latest published snapshot, safe to read from any thread."""
+        return self._latest
+
+    @property
+    def taken(self) -> int:
+        """Sequence number of the snapshot taken last."""
+        return self._taken
+
+    def pending(self) -> bool:
+        return self._latest.seq != self._taken
+
+    def publish(self, changes: dict) -> int:
+        """Publish targets changed by {sensor id: value}, returns the sequence number.
+
+        Nothing is published if the targets don't change.
+        """
+        with self._lock:
+            latest = self._latest
+            targets = list(latest.targets)
+            for sensor_id, value in changes.items():
+                targets[sensor_id] = value
+            targets = tuple(targets)
+            if targets == latest.targets:
+                return latest.seq
+            published_at = latest.published_at if latest.seq != self._taken else None
+            if published_at is None:
+                published_at = time.perf_counter()
+            self._latest = CommandSnapshot(latest.seq + 1, targets, published_at)
+            self.published += 1
+            # Read after the store, see take()
+            first = self._taken == latest.seq
+        if first and self.notify is not None:
+            self.notify()
+        return latest.seq + 1
+
+    def take(self) -> CommandSnapshot:
+        """Returns the latest snapshot if it wasn't taken yet, else None. Event loop only."""
+        taken = self._taken
+        while True:
+            snapshot = self._latest
+            if snapshot.seq == taken:
+                return None
+            self._taken = snapshot.seq
+            # A publisher which stored a newer one before seeing the update
+            # above didn't notify, so take that one instead
+            if self._latest is snapshot:
+                break
+        superseded = snapshot.seq - taken - 1
+        if superseded:
+            self.superseded += superseded
+            _LOGGER.debug("Command %d supersedes %d unwritten", snapshot.seq, superseded)
+        return snapshot
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+# Upper bounds of time buckets [s], 10 us to 10 s
+TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Fixed bucket histogram, observe() is a bisect and three additions."""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=TIME_BUCKETS) -> None:
+        self.bounds = tuple(bounds)
+        # Last bucket collects values above the highest bound
+        self.counts = array('Q', bytes(8 * (len(self.bounds) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def quantile(self, q: float):
+        """Returns upper bound of the bucket holding quantile q."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+class IzziMetrics(object):
+    """Counters and histograms of one controller.
+
+    Counters are plain attributes incremented in place, so recording an
+    event costs no more than an attribute update.
+    """
+
+    COUNTERS = (
+        ('frames_status', "Status (0x63) frames received"),
+        ('frames_command', "Command (0x64) frames received"),
+        ('skipped_bytes', "Bytes skipped while resynchronising on frame start"),
+        ('rx_wakeups', "Times the serial port woke the event loop up"),
+        ('read_timeouts', "Status frame watchdog timeouts"),
+        ('connects', "Successful connections to the bridge"),
+        ('connect_failures', "Failed connection attempts"),
+        ('writes', "Command frames written"),
+        ('write_failures', "Command frames which could not be written"),
+        ('commands_superseded', "Published commands replaced by a newer one before they were written"),
+        ('cf_samples', "CF pressure values taken"),
+        ('cf_samples_dropped', "CF pressure values dropped as invalid or taken before a speed change"),
+    )
+
+    GAUGES = (
+        ('connected', "Whether the bridge is connected"),
+        ('frame_period_seconds', "Learned status frame period"),
+        ('frame_jitter_seconds', "Learned status frame period jitter"),
+        ('setup_seconds', "Time Home Assistant took to set up the unit"),
+    )
+
+    HISTOGRAMS = (
+        ('frame_processing_seconds', "Controller processing time per frame"),
+        ('fanout_seconds', "Time to deliver a batch of updates to entities"),
+        ('command_latency_seconds', "Time from a command change to its frame on the wire"),
+    )
+
+    __slots__ = tuple(name for name, doc in COUNTERS + GAUGES + HISTOGRAMS)
+
+    def __init__(self) -> None:
+        for name, doc in self.COUNTERS + self.GAUGES:
+            setattr(self, name, 0)
+        for name, doc in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+
+
+def render_prometheus(units) -> str:
+    """Prometheus text exposition of (unit id, IzziMetrics) pairs."""
+    units = list(units)
+    lines = []
+    for name, doc in IzziMetrics.COUNTERS:
+        lines.append('# HELP izzi_%s_total %s' % (name, doc))
+        lines.append('# TYPE izzi_%s_total counter' % name)
+        for unit_id, metrics in units:
+            lines.append('izzi_%s_total{unit="%s"} %d' % (name, unit_id, getattr(metrics, name)))
+    for name, doc in IzziMetrics.GAUGES:
+        lines.append('# HELP izzi_%s %s' % (name, doc))
+        lines.append('# TYPE izzi_%s gauge' % name)
+        for unit_id, metrics in units:
+            lines.append('izzi_%s{unit="%s"} %s' % (name, unit_id, repr(float(getattr(metrics, name) or 0))))
+    for name, doc in IzziMetrics.HISTOGRAMS:
+        lines.append('# HELP izzi_%s %s' % (name, doc))
+        lines.append('# TYPE izzi_%s histogram' % name)
+        for unit_id, metrics in units:
+            histogram = getattr(metrics, name)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('izzi_%s_bucket{unit="%s",le="%s"} %d' % (name, unit_id, bound, cumulative))
+            lines.append('izzi_%s_sum{unit="%s"} %r' % (name, unit_id, histogram.sum))
+            lines.append('izzi_%s_count{unit="%s"} %d' % (name, unit_id, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class IzziMetricsServer(object):
+    """Minimal HTTP server answering GET /metrics with Prometheus text.
+
+    collect is called for every scrape and returns (unit id, IzziMetrics) pairs.
+    """
+
+    def __init__(self, collect, host: str = '127.0.0.1', port: int = 9233) -> None:
+        self._collect = collect
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        _LOGGER.info("Metrics served on http://%s:%d/metrics", self.host, self.port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._server = None
+
+    async def _handle_client(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5.0)
+            # Skip headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5.0)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                body = render_prometheus(self._collect()).encode()
+                status = b'200 OK'
+            else:
+                body = b'Not found\n'
+                status = b'404 Not Found'
+            writer.write(b'HTTP/1.0 ' + status + b'\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as exc:
+            _LOGGER.error(exc)
+        finally:
+            writer.close()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+import logging
+import operator
+import struct
+from .const import *
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+IZZI_MESSAGE_LENGTH = 15
+
+
+class IzziFrameDecoder(object):
+    """Incremental decoder splitting a byte stream into protocol frames.
+
+    Data is received directly into a preallocated buffer (get_buffer() /
+    buffer_updated() follow the recv_into() contract), complete frames are
+    returned as memoryview slices of that buffer and garbage between frames
+    is skipped in bulk. Only the unfinished tail of the last frame is ever
+    moved, back to the front of the buffer once the free space runs out.
+    """
+
+    __slots__ = ('_buffer', '_view', '_start', '_end', 'skipped')
+
+    def __init__(self, size: int = 1024) -> None:
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        # Number of garbage bytes dropped while looking for a message id
+        self.skipped = 0
+
+    def reset(self):
+        """Drop any buffered data."""
+        self._start = 0
+        self._end = 0
+
+    def pending(self) -> int:
+        """Returns number of buffered bytes not yet returned as a frame."""
+        return self._end - self._start
+
+    def get_buffer(self) -> memoryview:
+        """Returns writable free space at the end of the buffer."""
+        if len(self._buffer) - self._end < IZZI_MESSAGE_LENGTH:
+            self._compact()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        """Mark nbytes written into the last get_buffer() view as received."""
+        self._end += nbytes
+
+    def feed(self, data):
+        """Copy data from a source which can't read into our buffer."""
+        data = memoryview(data)
+        while len(data) > 0:
+            free = self.get_buffer()
+            count = min(len(free), len(data))
+            free[:count] = data[:count]
+            self.buffer_updated(count)
+            data = data[count:]
+            if len(data) > 0 and self.pending() >= len(self._buffer) - IZZI_MESSAGE_LENGTH:
+                # Caller doesn't consume frames between feeds, drop oldest data
+                self.skipped += self.pending()
+                self.reset()
+
+    def frames(self):
+        """Yield every complete frame in the buffer.
+
+        Returned views are only valid until the next get_buffer() call.
+        """
+        buf = self._buffer
+        view = self._view
+        start = self._start
+        end = self._end
+        while start < end:
+            msg_id = buf[start]
+            if msg_id != IZZI_STATUS_MESSAGE_ID and msg_id != IZZI_COMMAND_MESSAGE_ID:
+                sync = self._find_sync(start + 1, end)
+                _LOGGER.debug("Read invalid msg id, skipped %d bytes", sync - start)
+                self.skipped += sync - start
+                start = sync
+                continue
+            if end - start < IZZI_MESSAGE_LENGTH:
+                break
+            self._start = start + IZZI_MESSAGE_LENGTH
+            yield view[start:start + IZZI_MESSAGE_LENGTH]
+            start = self._start
+            end = self._end
+        self._start = start
+        if start == end:
+            self._start = 0
+            self._end = 0
+
+    def _find_sync(self, start: int, end: int) -> int:
+        status = self._buffer.find(IZZI_STATUS_MESSAGE_ID, start, end)
+        command = self._buffer.find(IZZI_COMMAND_MESSAGE_ID, start, end)
+        if status < 0:
+            return command if command >= 0 else end
+        if command < 0:
+            return status
+        return min(status, command)
+
+    def _compact(self):
+        count = self._end - self._start
+        if count > 0 and self._start > 0:
+            self._view[0:count] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = count
+
+
+# Status message fields: attribute name, index in status message array, unpack type
+IZZI_STATUS_FIELDS = (
+    ('outdoor_temp', IZZI_STATUS_MSG_OUTDOR_AIR_TEMP_INDEX, 'b'),
+    ('exhaust_temp', IZZI_STATUS_MSG_EXHAUST_AIR_TEMP_INDEX, 'b'),
+    ('supply_temp', IZZI_STATUS_MSG_SUPPLY_AIR_TEMP_INDEX, 'b'),
+    ('extract_temp', IZZI_STATUS_MSG_EXTRACT_AIR_TEMP_INDEX, 'b'),
+    ('cover_state', IZZI_STATUS_MSG_COVER_STATE_INDEX, 'B'),
+    ('defrost_state', IZZI_STATUS_MSG_DEFROST_STATE_INDEX, 'B'),
+    ('bypass_state', IZZI_STATUS_MSG_BYPASS_STATE_INDEX, 'B'),
+)
+
+
+def _build_status_struct(fields):
+    """Build one struct for the whole message, bytes shared by fields are unpacked once."""
+    formats = {}
+    for name, index, fmt in fields:
+        if formats.setdefault(index, fmt) != fmt:
+            raise ValueError("Conflicting formats for status byte %d" % index)
+
+    layout = '>'
+    offset = 0
+    positions = {}
+    for index in sorted(formats):
+        if index < offset:
+            raise ValueError("Overlapping status fields at byte %d" % index)
+        if index > offset:
+            layout += '%dx' % (index - offset)
+        positions[index] = len(positions)
+        layout += formats[index]
+        offset = struct.calcsize(layout)
+    if offset < IZZI_MESSAGE_LENGTH:
+        layout += '%dx' % (IZZI_MESSAGE_LENGTH - offset)
+
+    getter = operator.itemgetter(*[positions[index] for name, index, fmt in fields])
+    return struct.Struct(layout), getter
+
+
+_STATUS_STRUCT, _STATUS_GETTER = _build_status_struct(IZZI_STATUS_FIELDS)
+
+
+class StatusFrame(object):
+    """Decoded content of a status (0x63) message."""
+
+    __slots__ = tuple(name for name, index, fmt in IZZI_STATUS_FIELDS)
+
+    def __init__(self, outdoor_temp, exhaust_temp, supply_temp, extract_temp, cover_state, defrost_state, bypass_state):
+        self.outdoor_temp = outdoor_temp
+        self.exhaust_temp = exhaust_temp
+        self.supply_temp = supply_temp
+        self.extract_temp = extract_temp
+        self.cover_state = cover_state
+        self.defrost_state = defrost_state
+        self.bypass_state = bypass_state
+
+    @classmethod
+    def decode(cls, message) -> 'StatusFrame':
+        """Decode whole status message with a single unpack call."""
+        return cls(*_STATUS_GETTER(_STATUS_STRUCT.unpack_from(message)))
+
+
+class IzziStatusDecoder(object):
+    """Decodes status messages, skipping messages identical to the previous one."""
+
+    __slots__ = ('_last_message', 'frame')
+
+    def __init__(self) -> None:
+        self._last_message = None
+        self.frame = None
+
+    def invalidate(self):
+        """Make sure the next message is decoded even if it didn't change."""
+        self._last_message = None
+
+    def decode(self, message) -> StatusFrame:
+        """Returns decoded frame or None when message is a repeat of the last one."""
+        if message == self._last_message:
+            return None
+        self._last_message = bytes(message)
+        self.frame = StatusFrame.decode(message)
+        return self.frame
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""Shares one bridge connection among many local consumers.
+
+The proxy keeps the only upstream connection to the RS485 bridge and sends
+every frame to all subscribers connected over TCP or a Unix socket. Frames
+written by subscribers are dropped, except for the single writer connected
+to the writer endpoint, whose command frames go upstream and to the other
+subscribers. Run from the izzifast directory:
+
+    python -m izzi.proxy --host 192.168.1.20 --port 8234 --listen 8235 --writer-listen 8236
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from collections import deque
+
+from .const import *
+from .bus import IzziBusScheduler
+from .controller import IzziBridge, IzziEthBridge, IzziSerialBridge, ReconnectBackoff
+from .protocol import IzziFrameDecoder
+
+_LOGGER = logging.getLogger('izziproxy')
+
+DEFAULT_LISTEN_PORT = 8235
+DEFAULT_QUEUE_SIZE = 64
+
+
+class IzziProxySubscriber(object):
+    """Local consumer with its own bounded frame queue.
+
+    The upstream reader only appends to the queue, a sender task per
+    subscriber writes it out. When the subscriber can't keep up the oldest
+    frames are dropped.
+    """
+
+    def __init__(self, writer, queue_size: int = DEFAULT_QUEUE_SIZE, is_writer: bool = False) -> None:
+        self.writer = writer
+        self.is_writer = is_writer
+        self.name = writer.get_extra_info('peername') or writer.get_extra_info('sockname')
+        self.dropped = 0
+        self.sent = 0
+        self._queue = deque([], queue_size)
+        self._ready = asyncio.Event()
+
+    def push(self, frame: bytes):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(frame)
+        self._ready.set()
+
+    async def run_sender(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._queue:
+                self.writer.write(self._queue.popleft())
+                self.sent += 1
+            await self.writer.drain()
+
+
+class IzziFanoutProxy(object):
+    """Holds the upstream bridge connection and fans frames out."""
+
+    def __init__(self, bridge: IzziBridge, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        self._bridge = bridge
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._servers = []
+        self._writer = None
+        self._bus = IzziBusScheduler()
+        self._backoff = ReconnectBackoff()
+        self.frames = 0
+        self.commands = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    async def start_tcp(self, host: str, port: int, writer: bool = False):
+        server = await asyncio.start_server(lambda r, w: self._handle_client(r, w, writer), host, port)
+        self._servers.append(server)
+        _LOGGER.info("Listening on %s:%d%s", host, port, " for the writer" if writer else "")
+
+    async def start_unix(self, path: str, writer: bool = False):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(lambda r, w: self._handle_client(r, w, writer), path)
+        self._servers.append(server)
+        _LOGGER.info("Listening on %s%s", path, " for the writer" if writer else "")
+
+    async def _handle_client(self, reader, writer, is_writer: bool):
+        if is_writer and self._writer is not None:
+            _LOGGER.warning("Writer %s already connected, rejecting", self._writer.name)
+            writer.close()
+            return
+
+        subscriber = IzziProxySubscriber(writer, self.queue_size, is_writer)
+        _LOGGER.info("Subscriber %s connected%s", subscriber.name, " as writer" if is_writer else "")
+        self._subscribers.add(subscriber)
+        if is_writer:
+            self._writer = subscriber
+        sender = asyncio.get_running_loop().create_task(subscriber.run_sender())
+        decoder = IzziFrameDecoder()
+        try:
+            while True:
+                data = await reader.read(256)
+                if not data:
+                    break
+                if is_writer:
+                    decoder.feed(data)
+                    for frame in decoder.frames():
+                        self._command(subscriber, bytes(frame))
+        except ConnectionError:
+            pass
+        finally:
+            sender.cancel()
+            self._subscribers.discard(subscriber)
+            if self._writer is subscriber:
+                self._writer = None
+            writer.close()
+            _LOGGER.info("Subscriber %s disconnected, %d frames dropped", subscriber.name, subscriber.dropped)
+
+    def _command(self, source: IzziProxySubscriber, frame: bytes):
+        """Forward frame of the writer to the unit and the other subscribers."""
+        if frame[IZZI_CMD_MSG_ID_INDEX] != IZZI_COMMAND_MESSAGE_ID:
+            return
+        try:
+            if self._bridge.is_connected():
+                self._bridge.write_message(frame)
+        except Exception as exc:
+            _LOGGER.error(exc)
+        self.commands += 1
+        for subscriber in self._subscribers:
+            if subscriber is not source:
+                subscriber.push(frame)
+
+    def _broadcast(self, frame: bytes):
+        self.frames += 1
+        for subscriber in self._subscribers:
+            subscriber.push(frame)
+
+    async def run(self):
+        """Keep the upstream connection open and distribute its frames."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._bridge.is_connected():
+                try:
+                    if not await self._bridge.connect():
+                        await asyncio.sleep(self._backoff.next_delay())
+                        continue
+                    self._bus.reset()
+                    _LOGGER.info("Upstream connected")
+                except Exception as exc:
+                    _LOGGER.error(exc)
+                    await asyncio.sleep(self._backoff.next_delay())
+                    continue
+
+            try:
+                message = await self._bridge.read_message(self._bus.read_timeout(loop.time()))
+            except Exception as exc:
+                _LOGGER.error(exc)
+                if not self._bridge.is_connected():
+                    await asyncio.sleep(self._backoff.next_delay())
+                continue
+            if message is None:
+                _LOGGER.error("No status frame received, reconnecting upstream")
+                self._bridge.disconnect()
+                await asyncio.sleep(self._backoff.next_delay())
+                continue
+
+            if message[IZZI_STATUS_MSG_ID_INDEX] == IZZI_STATUS_MESSAGE_ID:
+                self._bus.frame_received(loop.time())
+                self._backoff.frame_received()
+            self._broadcast(message)
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+        self._servers = []
+        self._bridge.disconnect()
+
+
+def _address(value: str):
+    """Parses [host:]port."""
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+async def _main(args):
+    if args.serial:
+        bridge = IzziSerialBridge(args.serial)
+    else:
+        bridge = IzziEthBridge(args.host, args.port, args.timeout)
+    proxy = IzziFanoutProxy(bridge, args.queue)
+    if args.listen:
+        await proxy.start_tcp(*_address(args.listen))
+    if args.unix:
+        await proxy.start_unix(args.unix)
+    if args.writer_listen:
+        await proxy.start_tcp(*_address(args.writer_listen), writer=True)
+    if args.writer_unix:
+        await proxy.start_unix(args.writer_unix, writer=True)
+    try:
+        await proxy.run()
+    finally:
+        proxy.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Share one iZZi bridge connection among local consumers.")
+    upstream = parser.add_mutually_exclusive_group(required=True)
+    upstream.add_argument('--host', help="TCP bridge host")
+    upstream.add_argument('--serial', help="serial port of the RS485 adapter")
+    parser.add_argument('--port', type=int, default=8234, help="TCP bridge port")
+    parser.add_argument('--timeout', type=float, default=IzziEthBridge.CONNECT_TIMEOUT, help="upstream connect timeout [s]")
+    parser.add_argument('--listen', default=str(DEFAULT_LISTEN_PORT), help="[host:]port for read only subscribers")
+    parser.add_argument('--unix', help="Unix socket path for read only subscribers")
+    parser.add_argument('--writer-listen', help="[host:]port for the command writer")
+    parser.add_argument('--writer-unix', help="Unix socket path for the command writer")
+    parser.add_argument('--queue', type=int, default=DEFAULT_QUEUE_SIZE, help="frames queued per subscriber")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
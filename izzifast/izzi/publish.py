@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+from .const import *
+
+
+class PublishPolicy(object):
+    """When a changed sensor value is worth publishing.
+
+    deadband      changes smaller than this are dropped
+    relative      changes smaller than this fraction of the last value are dropped
+    min_interval  seconds between two publications, the latest change is held back
+    max_interval  seconds after which the value is published again even if unchanged
+    hysteresis    consecutive frames a new value has to be seen before it's published
+    """
+
+    __slots__ = ('deadband', 'relative', 'min_interval', 'max_interval', 'hysteresis')
+
+    def __init__(self, deadband: float = 0.0, relative: float = 0.0, min_interval: float = 0.0,
+                 max_interval: float = None, hysteresis: int = 0) -> None:
+        self.deadband = deadband
+        self.relative = relative
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.hysteresis = hysteresis
+
+    def suppresses(self, last, value) -> bool:
+        """Returns whether change from last published value is within the deadband."""
+        if last is None or value is None:
+            return False
+        diff = abs(value - last)
+        return diff < self.deadband or diff < self.relative * abs(last)
+
+
+# Sensor names used in the configuration
+PUBLISH_SENSOR_KEYS = {
+    'supply_temp': IZZY_SENSOR_TEMPERATURE_SUPPLY_ID,
+    'extract_temp': IZZY_SENSOR_TEMPERATURE_EXTRACT_ID,
+    'exhaust_temp': IZZY_SENSOR_TEMPERATURE_EXHAUST_ID,
+    'outdoor_temp': IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID,
+    'efficiency': IZZY_SENSOR_EFFICIENCY_ID,
+    'bypass': IZZY_SENSOR_BYPASS_STATE_ID,
+    'cover': IZZY_SENSOR_COVER_STATE_ID,
+    'defrost': IZZY_SENSOR_DEFROST_STATE_ID,
+    'supply_speed': IZZY_SENSOR_FAN_SUPPLY_SPEED_ID,
+    'extract_speed': IZZY_SENSOR_FAN_EXTRACT_SPEED_ID,
+    'cf_supply_correction': IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID,
+    'cf_extract_correction': IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID,
+    'supply_delta': IZZY_SENSOR_SUPPLY_DELTA_ID,
+    'extract_delta': IZZY_SENSOR_EXTRACT_DELTA_ID,
+    'recovered_heat': IZZY_SENSOR_RECOVERED_HEAT_ID,
+}
+
+# Measured values are rate limited, commanded ones are published at once
+DEFAULT_PUBLISH_POLICIES = {
+    IZZY_SENSOR_TEMPERATURE_SUPPLY_ID: PublishPolicy(min_interval=30.0, max_interval=900.0),
+    IZZY_SENSOR_TEMPERATURE_EXTRACT_ID: PublishPolicy(min_interval=30.0, max_interval=900.0),
+    IZZY_SENSOR_TEMPERATURE_EXHAUST_ID: PublishPolicy(min_interval=30.0, max_interval=900.0),
+    IZZY_SENSOR_TEMPERATURE_OUTDOOR_ID: PublishPolicy(min_interval=30.0, max_interval=900.0),
+    IZZY_SENSOR_EFFICIENCY_ID: PublishPolicy(deadband=3.0, min_interval=60.0, max_interval=900.0),
+    IZZY_SENSOR_BYPASS_STATE_ID: PublishPolicy(hysteresis=2),
+    IZZY_SENSOR_COVER_STATE_ID: PublishPolicy(hysteresis=2),
+    IZZY_SENSOR_DEFROST_STATE_ID: PublishPolicy(hysteresis=2),
+    IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID: PublishPolicy(min_interval=30.0),
+    IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID: PublishPolicy(min_interval=30.0),
+    IZZY_SENSOR_SUPPLY_DELTA_ID: PublishPolicy(min_interval=30.0, max_interval=900.0),
+    IZZY_SENSOR_EXTRACT_DELTA_ID: PublishPolicy(min_interval=30.0, max_interval=900.0),
+    IZZY_SENSOR_RECOVERED_HEAT_ID: PublishPolicy(relative=0.05, min_interval=30.0, max_interval=900.0),
+}
+
+
+class IzziPublisher(object):
+    """Applies publish policies to the per frame register updates.
+
+    Sensors without a policy pass straight through. For the others the last
+    published value and time are kept, changes held back by min_interval or
+    hysteresis stay pending and are checked again on every frame.
+    """
+
+    def __init__(self, policies=None) -> None:
+        self._policies = dict(DEFAULT_PUBLISH_POLICIES if policies is None else policies)
+        self._published = {}
+        self._pending = {}
+        self._confirmations = {}
+        self._forced = set()
+        self._heartbeats = ()
+        self._update_heartbeats()
+        self.suppressed = 0
+
+    def _update_heartbeats(self):
+        self._heartbeats = tuple(sensor_id for sensor_id, policy in self._policies.items()
+                                 if policy.max_interval)
+
+    def set_policy(self, sensor_id, policy: PublishPolicy):
+        """Set policy of sensor, None publishes every change."""
+        if policy is None:
+            self._policies.pop(sensor_id, None)
+        else:
+            self._policies[sensor_id] = policy
+        self._pending.pop(sensor_id, None)
+        self._update_heartbeats()
+
+    def get_policy(self, sensor_id) -> PublishPolicy:
+        return self._policies.get(sensor_id)
+
+    def force(self, sensor_id):
+        """Publish next value of sensor regardless of its policy."""
+        self._forced.add(sensor_id)
+
+    def has_work(self) -> bool:
+        return bool(self._pending or self._heartbeats or self._forced)
+
+    def filter(self, updates: dict, now: float, registers) -> dict:
+        """Returns the updates which should be published now."""
+        policies = self._policies
+        pending = self._pending
+        if not pending and not self._forced and not self._heartbeats and policies.keys().isdisjoint(updates):
+            return updates
+
+        published = self._published
+        result = {}
+
+        for sensor_id, value in updates.items():
+            policy = policies.get(sensor_id)
+            if policy is None or sensor_id in self._forced:
+                self._forced.discard(sensor_id)
+                pending.pop(sensor_id, None)
+                result[sensor_id] = value
+                published[sensor_id] = (value, now)
+            else:
+                if policy.hysteresis and pending.get(sensor_id, value) != value:
+                    self._confirmations[sensor_id] = 0
+                pending[sensor_id] = value
+
+        # Forced sensors whose value didn't change in this frame, the ones
+        # without a value yet are published with their first value anyway
+        if self._forced:
+            for sensor_id in self._forced:
+                value = registers.get(sensor_id)
+                if value is not None:
+                    pending.pop(sensor_id, None)
+                    result[sensor_id] = value
+                    published[sensor_id] = (value, now)
+            self._forced.clear()
+
+        for sensor_id in list(pending):
+            policy = policies[sensor_id]
+            value = pending[sensor_id]
+            last, last_time = published.get(sensor_id, (None, None))
+            if value == last and last_time is not None:
+                del pending[sensor_id]
+                self._confirmations.pop(sensor_id, None)
+                continue
+            if policy.hysteresis:
+                if registers.get(sensor_id) != value:
+                    # Flipped back before it was confirmed
+                    del pending[sensor_id]
+                    self._confirmations.pop(sensor_id, None)
+                    self.suppressed += 1
+                    continue
+                confirmations = self._confirmations.get(sensor_id, 0) + 1
+                self._confirmations[sensor_id] = confirmations
+                if last_time is not None and confirmations < policy.hysteresis:
+                    continue
+                self._confirmations.pop(sensor_id, None)
+            if last_time is not None:
+                if policy.suppresses(last, value):
+                    del pending[sensor_id]
+                    self.suppressed += 1
+                    continue
+                if now - last_time < policy.min_interval:
+                    continue
+            del pending[sensor_id]
+            result[sensor_id] = value
+            published[sensor_id] = (value, now)
+
+        for sensor_id in self._heartbeats:
+            last, last_time = published.get(sensor_id, (None, None))
+            if last_time is not None and sensor_id not in result and now - last_time >= policies[sensor_id].max_interval:
+                value = registers.get(sensor_id)
+                pending.pop(sensor_id, None)
+                result[sensor_id] = value
+                published[sensor_id] = (value, now)
+
+        return result
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+from array import array
+
+from .const import *
+
+# Registers are indexed directly by the IZZY_SENSOR_*_ID constants
+IZZI_REGISTER_COUNT = IZZY_SENSOR_RECOVERED_HEAT_ID + 1
+
+
+class RegisterSnapshot(object):
+    """Immutable copy of register values taken at a store version."""
+
+    __slots__ = ('version', '_values', '_valid')
+
+    def __init__(self, version: int, values: array, valid: int) -> None:
+        self.version = version
+        self._values = values
+        self._valid = valid
+
+    def __contains__(self, register_id) -> bool:
+        return bool(self._valid >> register_id & 1)
+
+    def __getitem__(self, register_id):
+        if not self._valid >> register_id & 1:
+            raise KeyError(register_id)
+        return self._values[register_id]
+
+    def get(self, register_id, default=None):
+        if not self._valid >> register_id & 1:
+            return default
+        return self._values[register_id]
+
+    def items(self):
+        """Yields (register id, value) of registers holding a value."""
+        valid = self._valid
+        values = self._values
+        for register_id in range(len(values)):
+            if valid >> register_id & 1:
+                yield register_id, values[register_id]
+
+    def as_dict(self) -> dict:
+        return dict(self.items())
+
+
+class IzziRegisterStore(object):
+    """Current register values with change tracking.
+
+    Values live in a typed array, a register without a value has its valid
+    bit cleared. Every change sets the dirty bit of the register, commit()
+    returns the changed values and publishes a new snapshot. Only the owner
+    of the store writes, readers use snapshot() which never blocks.
+    """
+
+    __slots__ = ('_values', '_valid', '_dirty', '_version', '_committed')
+
+    def __init__(self, size: int = IZZI_REGISTER_COUNT) -> None:
+        self._values = array('l', bytes(array('l').itemsize * size))
+        self._valid = 0
+        self._dirty = 0
+        self._version = 0
+        self._committed = (0, array('l', self._values), 0)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def valid(self) -> int:
+        """Returns bitmask of registers holding a value."""
+        return self._valid
+
+    @property
+    def values(self) -> array:
+        """Returns the live value array, only for reading registers known to be valid."""
+        return self._values
+
+    @property
+    def dirty(self) -> int:
+        """Returns bitmask of registers changed since last commit."""
+        return self._dirty
+
+    def get(self, register_id, default=None):
+        if not self._valid >> register_id & 1:
+            return default
+        return self._values[register_id]
+
+    def set(self, register_id, value) -> bool:
+        """Store value, None clears the register. Returns whether it changed."""
+        bit = 1 << register_id
+        if value is None:
+            if not self._valid & bit:
+                return False
+            self._valid &= ~bit
+        else:
+            if self._valid & bit and self._values[register_id] == value:
+                return False
+            self._values[register_id] = value
+            self._valid |= bit
+        self._dirty |= bit
+        return True
+
+    def update(self, register_ids, values):
+        """Store several values at once, same as set() for each pair."""
+        current = self._values
+        valid = self._valid
+        changed = 0
+        for register_id, value in zip(register_ids, values):
+            if current[register_id] != value or not valid >> register_id & 1:
+                if value is None:
+                    self.set(register_id, None)
+                    continue
+                current[register_id] = value
+                changed |= 1 << register_id
+        self._valid |= changed
+        self._dirty |= changed
+
+    def touch(self, register_id):
+        """Republish register on next commit even if unchanged."""
+        bit = 1 << register_id
+        if self._valid & bit:
+            self._dirty |= bit
+
+    def commit(self) -> dict:
+        """Returns changed registers and publishes a new snapshot if any."""
+        dirty = self._dirty
+        if not dirty:
+            return {}
+        self._dirty = 0
+        valid = self._valid
+        values = self._values
+        updates = {}
+        while dirty:
+            register_id = (dirty & -dirty).bit_length() - 1
+            updates[register_id] = values[register_id] if valid >> register_id & 1 else None
+            dirty &= dirty - 1
+        self._version += 1
+        # Readers pick the tuple up atomically, the copy is never modified
+        self._committed = (self._version, array('l', values), valid)
+        return updates
+
+    def snapshot(self) -> RegisterSnapshot:
+        """Returns values as of the last commit."""
+        return RegisterSnapshot(*self._committed)
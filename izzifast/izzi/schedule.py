@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import datetime
+import heapq
+import logging
+from bisect import bisect_right
+
+from .const import *
+
+_LOGGER = logging.getLogger('izzicontroller')
+
+# Target names used in the configuration, speed sets both fans
+SCHEDULE_TARGET_KEYS = {
+    'supply': (IZZY_SENSOR_FAN_SUPPLY_SPEED_ID,),
+    'extract': (IZZY_SENSOR_FAN_EXTRACT_SPEED_ID,),
+    'speed': (IZZY_SENSOR_FAN_SUPPLY_SPEED_ID, IZZY_SENSOR_FAN_EXTRACT_SPEED_ID),
+    'vent_mode': (IZZY_SENSOR_VENT_MODE_ID,),
+    'bypass_mode': (IZZY_SENSOR_BYPASS_MODE_ID,),
+}
+
+# Valid values of the targets a schedule can set
+SCHEDULE_TARGET_RANGES = {
+    IZZY_SENSOR_FAN_SUPPLY_SPEED_ID: (0, 100),
+    IZZY_SENSOR_FAN_EXTRACT_SPEED_ID: (0, 100),
+    IZZY_SENSOR_VENT_MODE_ID: (IZZY_SENSOR_VENT_MODE_NONE, IZZY_SENSOR_VENT_MODE_COOKER_HOOD),
+    IZZY_SENSOR_BYPASS_MODE_ID: (IZZY_CMD_BYPASS_MODE_AUTO, IZZY_CMD_BYPASS_MODE_CLOSED),
+}
+
+DAY = 24 * 3600.0
+WEEK = 7 * DAY
+
+# Programs are checked against the wall clock at least this often [s],
+# so clock and DST changes don't leave a transition far off
+PROGRAM_RESYNC = 3600.0
+
+
+def schedule_targets(values: dict) -> dict:
+    """Returns {register id: value} of targets given by name, see SCHEDULE_TARGET_KEYS."""
+    targets = {}
+    for key, value in values.items():
+        if key not in SCHEDULE_TARGET_KEYS:
+            raise ValueError("Unknown schedule target '%s'" % key)
+        for sensor_id in SCHEDULE_TARGET_KEYS[key]:
+            targets[sensor_id] = int(value)
+    check_targets(targets)
+    return targets
+
+
+def check_targets(targets: dict):
+    """Raises ValueError if a target can't be scheduled or is out of range."""
+    if not targets:
+        raise ValueError("Schedule entry without targets")
+    for sensor_id, value in targets.items():
+        if sensor_id not in SCHEDULE_TARGET_RANGES:
+            raise ValueError("Register %d can't be scheduled" % sensor_id)
+        low, high = SCHEDULE_TARGET_RANGES[sensor_id]
+        if value < low or value > high:
+            raise ValueError("Scheduled value %d of register %d out of range" % (value, sensor_id))
+
+
+def week_position(wall: float) -> float:
+    """Returns seconds since Monday midnight local time of unix time wall."""
+    moment = datetime.datetime.fromtimestamp(wall)
+    return (moment.weekday() * DAY + moment.hour * 3600.0 + moment.minute * 60.0
+            + moment.second + moment.microsecond / 1e6)
+
+
+class ScheduleEntry(object):
+    """Weekly program step, sets targets at a time of day on the given weekdays (0 is Monday)."""
+
+    __slots__ = ('days', 'at', 'targets')
+
+    def __init__(self, days, at: float, targets: dict) -> None:
+        days = tuple(sorted(set(days)))
+        if not days or days[0] < 0 or days[-1] > 6:
+            raise ValueError("Schedule days must be within 0 and 6")
+        if at < 0 or at >= DAY:
+            raise ValueError("Schedule time must be within the day")
+        check_targets(targets)
+        self.days = days
+        self.at = at
+        self.targets = dict(targets)
+
+
+class ScheduleOverride(object):
+    """Targets held until the monotonic time until, then reverted."""
+
+    __slots__ = ('name', 'targets', 'until', 'seq')
+
+    def __init__(self, name: str, targets: dict, until: float, seq: int) -> None:
+        self.name = name
+        self.targets = targets
+        self.until = until
+        self.seq = seq
+
+
+class IzziScheduler(object):
+    """Timed overrides and weekly programs of the command targets.
+
+    Timers are kept in a heap ordered by monotonic deadline, so the check
+    done on every frame looks at the earliest one only. Overrides lie on top
+    of the targets set by the user in the order they were started and are
+    dropped when they expire or are cancelled, which reverts the targets
+    without remembering old values. Program steps change the user targets
+    themselves, a change made in between holds until the next step.
+
+    Program steps are found by their position in the local week. The timer
+    of the next one is never set further than PROGRAM_RESYNC ahead and the
+    position is taken again from the wall clock when it fires.
+    """
+
+    def __init__(self) -> None:
+        self._timers = []
+        self._seq = 0
+        self._overrides = {}
+        self._program = ()
+        self._positions = ()
+        self._program_seq = None
+        self._program_position = None
+        self.overlay = {}
+
+    def due(self, now: float) -> bool:
+        """Returns whether a timer expired, cheap enough for every frame."""
+        timers = self._timers
+        return bool(timers) and timers[0][0] <= now
+
+    def next_deadline(self):
+        return self._timers[0][0] if self._timers else None
+
+    def _push(self, deadline: float, name) -> int:
+        self._seq += 1
+        heapq.heappush(self._timers, (deadline, self._seq, name))
+        return self._seq
+
+    def start_override(self, name: str, targets: dict, duration: float, now: float):
+        """Hold targets for duration seconds, replaces an override of the same name."""
+        check_targets(targets)
+        if duration <= 0:
+            raise ValueError("Override duration must be positive")
+        self._overrides.pop(name, None)
+        until = now + duration
+        self._overrides[name] = ScheduleOverride(name, dict(targets), until, self._push(until, name))
+        self._update_overlay()
+        _LOGGER.info("Override '%s' for %.0f s", name, duration)
+
+    def cancel_override(self, name: str = None) -> bool:
+        """Revert override of name or all of them, returns whether there was one."""
+        if name is None:
+            cancelled = bool(self._overrides)
+            self._overrides.clear()
+        else:
+            cancelled = self._overrides.pop(name, None) is not None
+        if cancelled:
+            # Stale timers are skipped when they come up
+            self._update_overlay()
+        return cancelled
+
+    def get_overrides(self, now: float) -> list:
+        """Returns (name, targets, seconds left) of the active overrides, oldest first."""
+        return [(override.name, dict(override.targets), max(0.0, override.until - now))
+                for override in self._overrides.values()]
+
+    def _update_overlay(self):
+        overlay = {}
+        for override in self._overrides.values():
+            overlay.update(override.targets)
+        self.overlay = overlay
+
+    def set_program(self, entries, now: float, wall: float) -> dict:
+        """Replace the weekly program, returns targets of the step in effect now."""
+        steps = sorted((day * DAY + entry.at, index, entry)
+                       for index, entry in enumerate(entries) for day in entry.days)
+        self._program = tuple(entry for position, index, entry in steps)
+        self._positions = tuple(position for position, index, entry in steps)
+        self._program_seq = None
+        self._program_position = None
+        if not steps:
+            return {}
+        position = week_position(wall)
+        self._program_position = position
+        self._schedule_program(position, now)
+        # The latest step, possibly of last week
+        return dict(self._program[bisect_right(self._positions, position) - 1].targets)
+
+    def _schedule_program(self, position: float, now: float):
+        index = bisect_right(self._positions, position)
+        if index < len(self._positions):
+            delay = self._positions[index] - position
+        else:
+            delay = WEEK - position + self._positions[0]
+        self._program_seq = self._push(now + min(delay, PROGRAM_RESYNC), None)
+
+    def _program_steps(self, start: float, end: float) -> dict:
+        """Returns targets of the steps in (start, end] of the week, merged in order."""
+        targets = {}
+        if end < start:
+            ranges = ((start, WEEK), (-1.0, end))
+        else:
+            ranges = ((start, end),)
+        for low, high in ranges:
+            for index in range(bisect_right(self._positions, low), bisect_right(self._positions, high)):
+                targets.update(self._program[index].targets)
+        return targets
+
+    def evaluate(self, now: float, wall: float):
+        """Run expired timers, returns (program targets to set, whether overlay changed)."""
+        timers = self._timers
+        changes = {}
+        overlay_changed = False
+        while timers and timers[0][0] <= now:
+            deadline, seq, name = heapq.heappop(timers)
+            if name is None:
+                if seq != self._program_seq:
+                    continue
+                position = week_position(wall)
+                elapsed = (position - self._program_position) % WEEK
+                if elapsed < WEEK / 2:
+                    changes.update(self._program_steps(self._program_position, position))
+                else:
+                    # Wall clock went back, steps already run aren't repeated
+                    _LOGGER.debug("Wall clock went back %.0f s", WEEK - elapsed)
+                self._program_position = position
+                self._schedule_program(position, now)
+            else:
+                override = self._overrides.get(name)
+                if override is None or override.seq != seq:
+                    continue
+                del self._overrides[name]
+                overlay_changed = True
+                _LOGGER.info("Override '%s' expired", name)
+        if overlay_changed:
+            self._update_overlay()
+        return changes, overlay_changed
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+from array import array
+
+
+class RunningWindow(object):
+    """Fixed length window of the latest samples with O(1) append and mean.
+
+    Samples live in a preallocated array used as a ring, the sum is kept up to
+    date on every append and recomputed from scratch once per ring turn so
+    floating point error can't accumulate.
+    """
+
+    __slots__ = ('_values', '_size', '_count', '_pos', '_sum')
+
+    def __init__(self, size: int) -> None:
+        if size < 1:
+            raise ValueError("Window size must be positive")
+        self._values = array('d', bytes(8 * size))
+        self._size = size
+        self._count = 0
+        self._pos = 0
+        self._sum = 0.0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def maxlen(self) -> int:
+        return self._size
+
+    def clear(self):
+        self._count = 0
+        self._pos = 0
+        self._sum = 0.0
+
+    def append(self, value: float):
+        """Add sample, dropping the oldest one if window is full."""
+        values = self._values
+        pos = self._pos
+        if self._count < self._size:
+            self._count += 1
+            self._sum += value
+        else:
+            self._sum += value - values[pos]
+        values[pos] = value
+        pos += 1
+        if pos == self._size:
+            pos = 0
+            if self._count == self._size:
+                self._sum = sum(values)
+        self._pos = pos
+
+    def mean(self) -> float:
+        """Returns mean of samples in the window."""
+        if self._count == 0:
+            raise ValueError("Mean of empty window")
+        return self._sum / self._count
+
+    def is_full(self) -> bool:
+        return self._count == self._size
@@ -2,29 +2,35 @@
 
 import logging
 from homeassistant.helpers.dispatcher import *
+from homeassistant.core import callback
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 from homeassistant.const import (
+    EntityCategory,
+    UnitOfPower,
     UnitOfTemperature,
+    UnitOfTime,
 )
 from homeassistant.components.sensor import (
     SensorDeviceClass,
+    SensorEntity,
+    SensorStateClass,
 )
-from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.entity import Entity
 
-from . import DOMAIN, SIGNAL_IZZIFAST_UPDATE_RECEIVED, IzzifastBridge
+from . import DOMAIN, IzzifastBridge
 from .izzi.const import *
 from . import *
 from .izzi import *
 
 bypass_mapping = ["auto", "zawsze otwarty", "zawsze zamknięty"]
-vent_mode_mapping = ["none", "fireplace", "open windows"]
+# Same names the vent_mode service, overrides and the schedule accept
+vent_mode_mapping = list(vent_mode_list)
 
 _LOGGER = logging.getLogger(__name__)
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_entry(hass, entry, async_add_entities):
     """Set up the ComfoConnect fan platform."""
-    izzibridge = hass.data[DOMAIN]
+    izzibridge = hass.data[DOMAIN][entry.unique_id]
 
     sensors = [
         [
@@ -67,15 +73,37 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         ["iZZi Efficiency", "%", IZZY_SENSOR_EFFICIENCY_ID, None, None, None],
         ["iZZi Extract correction", "%", IZZY_SENSOR_EXTRACT_CORRECTION_STATE_ID, None, None, None],
         ["iZZi CF extract correction", "%", IZZY_SENSOR_CF_EXTRACT_CORRECTION_ID, None, None, None],
-        ["iZZi CF supply correction", "%", IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID, None, None, None]
+        ["iZZi CF supply correction", "%", IZZY_SENSOR_CF_SUPPLY_CORRECTION_ID, None, None, None],
+        ["iZZi Supply temperature rise", UnitOfTemperature.CELSIUS, IZZY_SENSOR_SUPPLY_DELTA_ID, None, "mdi:thermometer-chevron-up", None],
+        ["iZZi Extract temperature drop", UnitOfTemperature.CELSIUS, IZZY_SENSOR_EXTRACT_DELTA_ID, None, "mdi:thermometer-chevron-down", None],
+        ["iZZi Recovered heat", UnitOfPower.WATT, IZZY_SENSOR_RECOVERED_HEAT_ID, SensorDeviceClass.POWER, None, None]
         
     ]
     dev = []
 
     for sensor in sensors:
-        dev.append(IzzifastSensor(sensor[0], izzibridge, sensor[1], sensor[2], sensor[3], sensor[4], sensor[5]))
+        dev.append(IzzifastSensor(izzibridge.entity_name(sensor[0]), izzibridge, sensor[1], sensor[2], sensor[3], sensor[4], sensor[5]))
+
+    metrics = [
+        ["iZZi Frames received", "frames", None, lambda m: m.frames_status + m.frames_command],
+        ["iZZi Skipped bytes", "skipped_bytes", None, lambda m: m.skipped_bytes],
+        ["iZZi Read timeouts", "read_timeouts", None, lambda m: m.read_timeouts],
+        ["iZZi Reconnects", "reconnects", None, lambda m: max(0, m.connects - 1)],
+        ["iZZi Write failures", "write_failures", None, lambda m: m.write_failures],
+        ["iZZi CF samples", "cf_samples", None, lambda m: m.cf_samples],
+        ["iZZi Frame processing time", "frame_processing", UnitOfTime.MILLISECONDS, lambda m: _ms(m.frame_processing_seconds.mean())],
+        ["iZZi Command latency", "command_latency", UnitOfTime.MILLISECONDS, lambda m: _ms(m.command_latency_seconds.mean())],
+    ]
+    for metric in metrics:
+        dev.append(IzzifastMetricSensor(izzibridge.entity_name(metric[0]), izzibridge, metric[1], metric[2], metric[3]))
+
+    async_add_entities(dev, True)
+
 
-    add_entities(dev, True)
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000.0, 3)
 
 
 class IzzifastSensor(Entity):
@@ -97,17 +125,14 @@ class IzzifastSensor(Entity):
         _LOGGER.debug(
             "Registering for sensor %s", self._sensor_type
         )
-        self._remove_signal_update = async_dispatcher_connect(
-            self.hass,
-            SIGNAL_IZZIFAST_UPDATE_RECEIVED.format(self._sensor_type),
-            self._handle_update,
-        )
+        self._remove_signal_update = self._izzibridge.subscribe(self._sensor_type, self._handle_update)
         self._izzibridge.force_update(self._sensor_type)
         
     async def async_will_remove_from_hass(self) -> None:
         """Call when entity will be removed from hass."""
         self._remove_signal_update()
         
+    @callback
     def _handle_update(self, value):
         """Handle update callbacks."""
         _LOGGER.debug(
@@ -120,7 +145,7 @@ class IzzifastSensor(Entity):
         else:
             self._izzibridge.data[self._sensor_type] = value
         
-        self.schedule_update_ha_state()
+        self.async_write_ha_state()
 
     @property
     def state(self):
@@ -159,3 +184,26 @@ class IzzifastSensor(Entity):
     def device_class(self):
         """Return the device_class."""
         return self._device_class
+
+
+class IzzifastMetricSensor(SensorEntity):
+    """Diagnostic sensor reporting controller metrics, polled."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, name, izzibridge: IzzifastBridge, metric, unit, value_fn) -> None:
+        """Initialize the metric sensor."""
+        self._izzibridge = izzibridge
+        self._metric = metric
+        self._value_fn = value_fn
+        self._attr_name = name
+        self._attr_unique_id = f"{izzibridge.unique_id}_metric_{metric}"
+        self._attr_native_unit_of_measurement = unit
+        if unit is None:
+            self._attr_state_class = SensorStateClass.TOTAL_INCREASING
+        else:
+            self._attr_state_class = SensorStateClass.MEASUREMENT
+
+    async def async_update(self):
+        """Read current metric value."""
+        self._attr_native_value = self._value_fn(self._izzibridge.controller.collect_metrics())